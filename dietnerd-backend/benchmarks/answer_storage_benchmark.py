@@ -0,0 +1,104 @@
+"""
+Compares storage size, /db_get payload size and read latency of question_answer rows stored as JSON blobs with every
+relevant article embedded (the original format) against normalized answers that reference article_analysis by PMID.
+
+Answers are synthesized from a stored question_answer dump (default: output.json). Each answer draws its relevant
+articles from a shared pool, so summaries repeat across answers as they do in production.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.answer_storage_benchmark --answers 2000 --article-pool 5000
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from migrate_question_answer import article_analysis_row
+from storage import SQLiteStorage
+
+
+def build_answers(path, n_answers, pool_size):
+    """
+    Builds synthetic final output objects and the shared article pool from a question_answer dump.
+
+    Returns:
+    - answers (list): List of (question, final output object) tuples.
+    - pool (list): Article dictionaries shared by the answers.
+    """
+    with open(path) as f:
+        rows = json.load(f)
+    template = json.loads(rows[0][1])
+    template_articles = template.get("relevant_articles") or template.get("relevent_articles")
+    pool = [dict(random.choice(template_articles), PMID=str(20_000_000 + i)) for i in range(pool_size)]
+
+    answers = []
+    for i in range(n_answers):
+        articles = random.sample(pool, len(template_articles))
+        citations = [f"[{n}] {article['citation']}" for n, article in enumerate(articles[:12], start=1)]
+        citations_obj = {citation: {"PMID": article["PMID"], "PMCID": article["PMCID"], "URL": article["url"], "Summary": article["summary"]}
+                         for citation, article in zip(citations, articles)}
+        answers.append((f"benchmark question {i}?", {
+            "end_output": template["end_output"],
+            "relevant_articles": articles,
+            "total_runtime": template["total_runtime"],
+            "citations_obj": citations_obj,
+            "citations": citations,
+        }))
+    return answers, pool
+
+
+def read_latency(storage, questions, include_articles, reads):
+    times = []
+    payload = []
+    for _ in range(reads):
+        question = random.choice(questions)
+        start = time.perf_counter()
+        rows = storage.get_answer(question, include_articles)
+        times.append(time.perf_counter() - start)
+        payload.append(len(json.dumps(rows).encode()))
+    return statistics.median(times) * 1000, statistics.median(payload)
+
+
+def answer_bytes(storage):
+    connection = storage.connection()
+    answers = connection.execute(f"SELECT SUM(LENGTH(answer)) FROM {storage.answer_table}").fetchone()[0]
+    links = connection.execute(f"SELECT COUNT(*) FROM {storage.link_table}").fetchone()[0]
+    return answers, links
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump", default="output.json")
+    parser.add_argument("--answers", type=int, default=2000)
+    parser.add_argument("--article-pool", type=int, default=5000)
+    parser.add_argument("--reads", type=int, default=300)
+    args = parser.parse_args()
+
+    answers, pool = build_answers(args.dump, args.answers, args.article_pool)
+    questions = [question for question, _ in answers]
+    directory = tempfile.mkdtemp()
+
+    legacy = SQLiteStorage(os.path.join(directory, "legacy.sqlite3"))
+    legacy.write_answers([(question, json.dumps(obj), []) for question, obj in answers])
+
+    normalized = SQLiteStorage(os.path.join(directory, "normalized.sqlite3"))
+    normalized.upsert_articles([article_analysis_row(article) for article in pool])
+    normalized.upsert_answers(answers)
+
+    for name, storage in (("blob", legacy), ("normalized", normalized)):
+        storage.connection().execute("VACUUM")
+        size = os.path.getsize(storage.path)
+        answer_size, links = answer_bytes(storage)
+        default_ms, default_payload = read_latency(storage, questions, False, args.reads)
+        articles_ms, articles_payload = read_latency(storage, questions, True, args.reads)
+        print(f"[{name}]")
+        print(f"  database file: {size / 1e6:.1f} MB, question_answer.answer: {answer_size / 1e6:.1f} MB, link rows: {links:,}")
+        print(f"  /db_get (default): p50 {default_ms:.2f} ms, payload {default_payload / 1e3:.1f} KB")
+        print(f"  /db_get?include=articles: p50 {articles_ms:.2f} ms, payload {articles_payload / 1e3:.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
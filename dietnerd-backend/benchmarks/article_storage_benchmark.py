@@ -0,0 +1,88 @@
+"""
+Compares article_analysis rows stored as one uncompressed article_json string (the original format) against typed
+metadata columns with a zlib-compressed summary: bytes on disk, bytes returned by the database and decode time, for a
+full read and for projections that only need the citation or PMID.
+
+Rows are synthesized from a stored question_answer dump (default: output.json), so summaries match production.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.article_storage_benchmark --articles 20000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from migrate_question_answer import article_analysis_row
+from storage import SQLiteStorage, article_columns, columns_to_article
+
+
+def load_articles(path, n_articles):
+    with open(path) as f:
+        rows = json.load(f)
+    template = json.loads(rows[0][1])
+    template_articles = template.get("relevant_articles") or template.get("relevent_articles")
+    return [article_analysis_row(dict(random.choice(template_articles), PMID=str(30_000_000 + i))) for i in range(n_articles)]
+
+
+def wire_bytes(rows):
+    return sum(len(value) if isinstance(value, bytes) else len(str(value).encode()) for row in rows for value in row if value is not None)
+
+
+def read(storage, pmids, fields, repeats):
+    """
+    Selects and decodes the requested fields of the given PMIDs.
+
+    Returns:
+    - fetch_ms (float): Median time spent in the database, in milliseconds.
+    - decode_ms (float): Median time spent decoding rows into article dictionaries, in milliseconds.
+    - wire (int): Bytes returned by the database.
+    """
+    fetch_times, decode_times = [], []
+    columns = article_columns(fields)
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = storage.select_articles(columns, pmids)
+        fetched = time.perf_counter()
+        [columns_to_article(columns, row, fields) for row in rows]
+        fetch_times.append(fetched - start)
+        decode_times.append(time.perf_counter() - fetched)
+    return sorted(fetch_times)[repeats // 2] * 1000, sorted(decode_times)[repeats // 2] * 1000, wire_bytes(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump", default="output.json")
+    parser.add_argument("--articles", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    articles = load_articles(args.dump, args.articles)
+    pmids = [pmid for pmid, _ in articles]
+    directory = tempfile.mkdtemp()
+
+    legacy = SQLiteStorage(os.path.join(directory, "legacy.sqlite3"))
+    with legacy.connection() as connection:
+        connection.executemany(f"INSERT INTO {legacy.article_table} (article_id, article_json) VALUES (?, ?)",
+                               [(pmid, json.dumps(article)) for pmid, article in articles])
+
+    columnar = SQLiteStorage(os.path.join(directory, "columnar.sqlite3"))
+    columnar.upsert_articles(articles)
+
+    sample = random.sample(pmids, 50)
+    for name, storage in (("article_json", legacy), ("columns + compressed summary", columnar)):
+        storage.connection().execute("VACUUM")
+        print(f"[{name}]")
+        print(f"  on disk: {os.path.getsize(storage.path) / 1e6:.1f} MB for {args.articles:,} rows")
+        for label, pmid_list, fields in (("full table, all fields", None, None),
+                                         ("50 PMIDs, all fields", sample, None),
+                                         ("full table, citation only", None, ["citation"]),
+                                         ("full table, PMID only", None, [])):
+            fetch_ms, decode_ms, wire = read(storage, pmid_list, fields, args.repeats)
+            print(f"  {label}: {wire / 1e6:.2f} MB returned, fetch {fetch_ms:.1f} ms, decode {decode_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
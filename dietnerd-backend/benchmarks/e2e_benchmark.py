@@ -0,0 +1,512 @@
+"""
+Offline end-to-end benchmark of process_user_query, driven by the gold-standard evaluation questions.
+
+Every external dependency is replaced by a deterministic local stand-in, so runs are repeatable and need no keys:
+- OpenAI: a fake chat-completions server (OPENAI_BASE_URL) that recognises each pipeline call by its prompt and
+  answers after a configurable latency (--llm-scale times a typical latency per call).
+- NCBI: an E-utilities fixture server. Entrez requests are redirected to it, still through Biopython's rate limiter.
+  It serves recorded responses from --fixture and answers anything else from a local corpus: the gold-standard
+  articles plus --distractors synthetic ones, ranked by term overlap. With --record, misses are fetched from the real
+  E-utilities instead and saved to the fixture file, so later runs replay them offline.
+- Publishers: full-text lookups wait --publisher-latency seconds and return no link, or a synthetic PMC text.
+- MySQL: SQLite storage in a temp directory.
+
+The run reports per-stage and total latency (from the per-question pipeline records), throughput at --concurrency
+questions in flight, request counts per stand-in, and peak memory. --save-baseline writes the summary and the
+per-question results (relevant PMIDs, a hash of the cited PMIDs and answer lines) as JSON; --baseline compares a run
+against one and exits with status 1 if latency, requests or memory grew, or throughput fell, by more than
+--tolerance (timings also by more than --min-seconds).
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.e2e_benchmark --questions 20 --concurrency 4 --save-baseline e2e_baseline.json
+    python -m benchmarks.e2e_benchmark --questions 20 --concurrency 4 --baseline e2e_baseline.json
+"""
+import argparse
+import contextlib
+import hashlib
+import logging
+import json
+import os
+import random
+import re
+import resource
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+from xml.sax.saxutils import escape
+
+from benchmarks.mirror_benchmark import PROLOG, synthetic_article
+
+GOLD_STANDARD_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "evaluation-datasets", "automated_evaluatio_gold_standard_benchmark.csv")
+EUTILS = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+ESEARCH_PROLOG = ('<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+                  '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n')
+
+# Typical latency of each LLM call in seconds, scaled by --llm-scale
+LLM_LATENCY = {"validity": 1.0, "general_query": 1.5, "points_of_contention": 6.0, "relevance": 0.8,
+               "relevant_sections": 1.5, "reliability_analysis": 12.0, "synthesis": 20.0, "other": 2.0}
+# Each call is recognised by a phrase of its system prompt
+CALL_MARKERS = [("classifying user questions", "validity"), ("create a broad query", "general_query"),
+                ("points of contention", "points_of_contention"), ("yes/no only", "relevance"),
+                ("Evidence and Claims", "synthesis"), ("Sources of Funding", "reliability_analysis"),
+                ("sections", "relevant_sections")]
+STOPWORDS = set("a an and are as at be by can do does for from has have how i if in is it my of on or should the to what when which who why will with".split())
+
+
+def terms(text):
+    return [term for term in re.findall(r"[a-z0-9]+", text.lower()) if term not in STOPWORDS and len(term) > 2]
+
+
+def tokens(text):
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        messages = body.get("messages", [])
+        system = " ".join(message.get("content", "") for message in messages if message.get("role") == "system")
+        user = " ".join(message.get("content", "") for message in messages if message.get("role") != "system")
+        call = next((name for marker, name in CALL_MARKERS if marker in system), "other")
+        content = self.server.answer(call, user)
+
+        seed = int(hashlib.sha1(user.encode()).hexdigest()[:8], 16)
+        time.sleep(LLM_LATENCY[call] * self.server.scale * (0.8 + 0.4 * (seed % 1000) / 1000))
+        with self.server.lock:
+            self.server.calls[call] += 1
+
+        prompt_tokens, completion_tokens = tokens(system + user), tokens(content)
+        response = json.dumps({
+            "id": f"chatcmpl-{seed}", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, scale):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.scale = scale
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def answer(self, call, user):
+        if call == "validity":
+            return "True"
+        question = user.strip()
+        keywords = terms(question)[:3] or ["nutrition"]
+        if call == "general_query":
+            return " AND ".join(keywords)
+        if call == "points_of_contention":
+            points = []
+            for i, keyword in enumerate(keywords[:3], 1):
+                others = [other for other in keywords if other != keyword][:1]
+                query = f"{keyword} AND " + (others[0] if others else "health")
+                points.append(f"* Point of Contention {i}: {keyword}\nSummary: Studies disagree on {keyword}.\nQuery: {query}")
+            points.append(f"* Point of Contention {len(points) + 1}: Safety\nSummary: Safety of {keywords[0]}.\nQuery: {keywords[0]} AND (safety OR risk)")
+            return "\n\n".join(points)
+        if call == "relevance":
+            parts = user.split("Abstract:", 1)
+            question_terms = set(terms(parts[0].replace("Question:", "")))
+            abstract_terms = set(terms(parts[1])) if len(parts) > 1 else set()
+            return "Yes" if len(question_terms & abstract_terms) >= 2 or (question_terms and question_terms <= abstract_terms) else "No"
+        if call == "reliability_analysis":
+            return "\n".join(f"{i}. Finding {i}: the study reports an effect with a confidence interval and p-value." for i in range(1, 14))
+        if call == "synthesis":
+            evidence_ids = sorted(re.findall(r"^\s*\[(\d+)\] Title:", user, re.MULTILINE), key=int)[:20]
+            bullets = [f"* Evidence [{evidence_id}] supports part of the answer." for evidence_id in evidence_ids]
+            return "Summary of the evidence.\n\n" + "\n".join(bullets) + "\n\nConclusion\n* See a registered dietitian."
+        return "Relevant sections: Abstract, Results"
+
+
+class Fixture:
+    """
+    Recorded E-utilities responses plus a local corpus to answer unrecorded searches.
+
+    Parameters:
+    - path (str): Fixture JSON file, {"searches": {term: [pmid, ...]}, "articles": {pmid: "<PubmedArticle>...</PubmedArticle>"}}.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.searches = {}
+        self.articles = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.searches, self.articles = data.get("searches", {}), data.get("articles", {})
+        self.index = {}
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump({"searches": self.searches, "articles": self.articles}, f)
+
+    def add_corpus(self, articles):
+        for pmid, xml in articles.items():
+            self.articles.setdefault(pmid, xml)
+        self.index = {pmid: set(terms(re.sub(r"<[^>]+>", " ", xml))) for pmid, xml in self.articles.items()}
+
+    def search(self, term, retmax):
+        if term in self.searches:
+            return self.searches[term][:retmax]
+        wanted = set(terms(re.sub(r"\b(AND|OR|NOT)\b|\[[^\]]*\]", " ", term)))
+        scored = sorted(((len(wanted & words), pmid) for pmid, words in self.index.items() if wanted & words), key=lambda item: (-item[0], item[1]))
+        return [pmid for score, pmid in scored[:retmax]]
+
+
+class EutilsHandler(BaseHTTPRequestHandler):
+    server_version = "EutilsFixture/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        self.respond(parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()))
+
+    def respond(self, params):
+        tool = urlparse(self.path).path.rsplit("/", 1)[-1].split(".")[0]
+        with self.server.lock:
+            self.server.calls[tool] += 1
+        time.sleep(self.server.latency)
+        if tool == "esearch":
+            body = self.server.esearch(params["term"][0], int(params.get("retmax", ["20"])[0]))
+        elif tool == "efetch":
+            body = self.server.efetch([pmid for value in params["id"] for pmid in value.split(",")])
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class EutilsFixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, fixture, latency, record=False):
+        super().__init__(("127.0.0.1", 0), EutilsHandler)
+        self.fixture = fixture
+        self.latency = latency
+        self.record = record
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def esearch(self, term, retmax):
+        if self.record and term not in self.fixture.searches:
+            from Bio import Entrez
+            with urlopen(EUTILS + "esearch.fcgi?" + urlencode({"db": "pubmed", "term": term, "retmax": retmax, "sort": "relevance"})) as response:
+                self.fixture.searches[term] = list(Entrez.read(response)["IdList"])
+        pmids = self.fixture.search(term, retmax)
+        ids = "".join(f"<Id>{pmid}</Id>" for pmid in pmids)
+        return (f"{ESEARCH_PROLOG}<eSearchResult><Count>{len(pmids)}</Count><RetMax>{len(pmids)}</RetMax><RetStart>0</RetStart>"
+                f"<IdList>{ids}</IdList><TranslationSet/><QueryTranslation>{escape(term)}</QueryTranslation></eSearchResult>")
+
+    def efetch(self, pmids):
+        missing = [pmid for pmid in pmids if pmid not in self.fixture.articles]
+        if self.record and missing:
+            from pubmed_cache import split_articles
+            with urlopen(EUTILS + "efetch.fcgi", data=urlencode({"db": "pubmed", "id": ",".join(missing), "rettype": "xml"}).encode()) as response:
+                articles = split_articles(response.read())
+            self.fixture.articles.update({pmid: xml.decode() for pmid, xml in articles.items()})
+        body = "".join(self.fixture.articles[pmid] for pmid in pmids if pmid in self.fixture.articles)
+        return f"{PROLOG}<PubmedArticleSet>{body}</PubmedArticleSet>"
+
+
+def gold_standard_articles(rows):
+    """
+    Builds efetch XML for the articles of the gold-standard dataset.
+
+    Returns:
+    - articles (dict): PMID mapped to <PubmedArticle> XML.
+    """
+    articles = {}
+    for row in rows:
+        pmid = str(row["PMID"])
+        sections = re.split(r"\n\n(?=[A-Z][A-Z /&-]+:\n)", str(row["ABSTRACT"]))
+        abstract = ""
+        for section in sections:
+            label, _, text = section.partition(":\n")
+            if text and label.isupper():
+                abstract += f'<AbstractText Label="{escape(label)}">{escape(text.strip())}</AbstractText>'
+            else:
+                abstract += f"<AbstractText>{escape(section.strip())}</AbstractText>"
+        date = row["PUBLISHED_DATE"] if isinstance(row["PUBLISHED_DATE"], str) else ""
+        pub_date = "".join(f"<{tag}>{part}</{tag}>" for tag, part in zip(("Year", "Month", "Day"), date.split("-")) if part)
+        articles[pmid] = (f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID><Article PubModel="Print">'
+                          f'<Journal><JournalIssue CitedMedium="Internet"><PubDate>{pub_date}</PubDate>'
+                          f'</JournalIssue><Title>Gold Standard Journal</Title></Journal><ArticleTitle>{escape(str(row["ARTICLE_NAME"]))}</ArticleTitle>'
+                          f'<Abstract>{abstract}</Abstract><AuthorList><Author><LastName>Author</LastName><Initials>A</Initials></Author></AuthorList>'
+                          f'<PublicationTypeList><PublicationType UI="D017418">Meta-Analysis</PublicationType></PublicationTypeList></Article>'
+                          f'</MedlineCitation><PubmedData><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId>'
+                          f'<ArticleId IdType="doi">10.0000/gold.{pmid}</ArticleId></ArticleIdList></PubmedData></PubmedArticle>')
+    return articles
+
+
+def distractor_articles(count, seed=0):
+    rng = random.Random(seed)
+    # PMIDs far above the gold-standard ones
+    return {str(90000000 + i): synthetic_article(90000000 + i, rng).strip() for i in range(count)}
+
+
+def redirect_entrez(base_url):
+    """
+    Sends Biopython's E-utilities requests to the fixture server, keeping its rate limiting and retries.
+    """
+    from Bio import Entrez
+    original = Entrez.urlopen
+
+    def local_urlopen(request, *args, **kwargs):
+        request.full_url = request.full_url.replace(EUTILS, base_url)
+        return original(request, *args, **kwargs)
+    Entrez.urlopen = local_urlopen
+
+
+def replace_publishers(helper_functions, pipeline_metrics, latency):
+    """
+    Full-text sources wait for the publisher latency; PubMed pages list no full-text links and PMC returns synthetic text.
+    """
+    @pipeline_metrics.timed("full_text_links")
+    def get_preferred_link(url):
+        time.sleep(latency)
+        return None
+
+    @pipeline_metrics.timed("full_text_pmc")
+    def get_full_text_pubmed(article_json):
+        time.sleep(latency)
+        return (article_json["abstract"] + " ") * 8
+
+    helper_functions.get_preferred_link = get_preferred_link
+    helper_functions.get_full_text_pubmed = get_full_text_pubmed
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))] if values else 0.0
+
+
+def summarize(records, wall_seconds, llm_server, eutils_server, peak_rss_mb, concurrency):
+    stages = {}
+    for record in records:
+        for stage, seconds in record["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    totals = [record["total_seconds"] for record in records]
+    return {
+        "questions": len(records),
+        "concurrency": concurrency,
+        "ok": sum(record["status"] == "ok" for record in records),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_minute": round(60 * len(records) / wall_seconds, 3) if wall_seconds else 0.0,
+        "total_p50": round(percentile(totals, 0.5), 3),
+        "total_p95": round(percentile(totals, 0.95), 3),
+        "stage_p50": {stage: round(percentile(values, 0.5), 3) for stage, values in stages.items()},
+        "stage_p95": {stage: round(percentile(values, 0.95), 3) for stage, values in stages.items()},
+        "llm_requests": dict(sorted(llm_server.calls.items())),
+        "eutils_requests": dict(sorted(eutils_server.calls.items())),
+        "llm_tokens": sum(entry["prompt_tokens"] + entry["completion_tokens"] for record in records for entry in record["llm"].values()),
+        "cost_usd": round(sum(record["cost_usd"] for record in records), 4),
+        "articles": dict(sum((Counter(record["articles"]) for record in records), Counter())),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+
+def print_summary(summary):
+    print(f"{summary['questions']} questions ({summary['ok']} ok) at concurrency {summary['concurrency']}: "
+          f"{summary['wall_seconds']:.1f}s wall, {summary['throughput_per_minute']:.1f} questions/min")
+    print(f"total latency: p50 {summary['total_p50']:.2f}s, p95 {summary['total_p95']:.2f}s")
+    for stage in summary["stage_p50"]:
+        print(f"  {stage:26s} p50 {summary['stage_p50'][stage]:7.3f}s  p95 {summary['stage_p95'][stage]:7.3f}s")
+    print(f"LLM requests: {summary['llm_requests']} ({summary['llm_tokens']} tokens, ${summary['cost_usd']:.2f} at list prices)")
+    print(f"E-utilities requests: {summary['eutils_requests']}")
+    print(f"articles: {summary['articles']}")
+    print(f"peak RSS: {summary['peak_rss_mb']:.0f} MB")
+
+
+def answer_signature(final):
+    # Articles are numbered in the order their processing finished: compare the cited PMIDs and the answer lines
+    # without their citation numbers, as sets
+    cited = sorted(str(citation.get("PMID")) for citation in (final.get("citations_obj") or {}).values())
+    lines = sorted(re.sub(r"\[\d+\]", "[]", line).strip() for line in str(final.get("end_output")).splitlines() if line.strip())
+    return hashlib.sha1("\n".join(cited + lines).encode()).hexdigest()[:12]
+
+
+def flatten(summary, prefix=""):
+    values = {}
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(baseline, current, tolerance, min_seconds):
+    """
+    Prints the changes against a baseline.
+
+    Returns:
+    - regressions (list): Metrics that got worse by more than the tolerance.
+    """
+    regressions = []
+    old, new = flatten(baseline["summary"]), flatten(current["summary"])
+    print(f"\nAgainst baseline (tolerance {tolerance:.0%}):")
+    for key in sorted(set(old) | set(new)):
+        if key in ("questions", "concurrency"):
+            continue
+        before, after = old.get(key), new.get(key)
+        if before is None or after is None:
+            print(f"  {key:40s} {before!s:>10} -> {after!s:>10}")
+            continue
+        change = (after - before) / before if before else (0.0 if after == before else float("inf"))
+        # Throughput and successful questions should not fall; everything else measured should not grow
+        worse = -change if key in ("throughput_per_minute", "ok") or key.startswith("articles.") else change
+        flag = ""
+        # Timings of a few questions are noisy: a timing must also move by more than min_seconds
+        timing = key.startswith(("stage_", "total_", "wall_"))
+        if worse > tolerance and not key.startswith("articles.") and not (timing and abs(after - before) <= min_seconds):
+            flag = "  REGRESSION"
+            regressions.append(key)
+        if change:
+            print(f"  {key:40s} {before:>10} -> {after:>10} ({change:+.1%}){flag}")
+
+    changed = [question for question, result in current["questions"].items()
+               if question in baseline["questions"] and baseline["questions"][question] != result]
+    print(f"  results: {len(changed)} of {len(current['questions'])} questions differ from the baseline")
+    for question in changed[:5]:
+        before, after = baseline["questions"][question], current["questions"][question]
+        print(f"    {question[:70]}: relevant {len(before['relevant_pmids'])} -> {len(after['relevant_pmids'])}, "
+              f"answer {'changed' if before['answer_sha'] != after['answer_sha'] else 'same'}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=20, help="number of gold-standard questions to run")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions in flight at once")
+    parser.add_argument("--llm-scale", type=float, default=0.05, help="multiplier on the typical LLM latency of each call")
+    parser.add_argument("--eutils-latency", type=float, default=0.05, help="seconds per E-utilities response")
+    parser.add_argument("--publisher-latency", type=float, default=0.05, help="seconds per full-text lookup")
+    parser.add_argument("--distractors", type=int, default=2000, help="synthetic articles added to the search corpus")
+    parser.add_argument("--fixture", help="recorded E-utilities fixture (JSON) to replay")
+    parser.add_argument("--record", action="store_true", help="fetch fixture misses from the real E-utilities and save them to --fixture")
+    parser.add_argument("--validate", action="store_true", help="run the speculative validity check as /submit does")
+    parser.add_argument("--baseline", help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", help="write this run as a baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change of a timing or cost metric reported as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.25, help="smallest change of a timing reported as a regression")
+    parser.add_argument("--csv", default=GOLD_STANDARD_CSV)
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args()
+    if args.record and not args.fixture:
+        parser.error("--record needs --fixture")
+
+    import pandas as pd
+    rows = pd.read_csv(args.csv).dropna(subset=["QUESTION"]).to_dict("records")
+    questions = [row["QUESTION"].strip() for row in rows][:args.questions]
+
+    fixture = Fixture(args.fixture)
+    fixture.add_corpus({**distractor_articles(args.distractors), **gold_standard_articles(rows)})
+    llm_server = FakeOpenAIServer(args.llm_scale)
+    eutils_server = EutilsFixtureServer(fixture, args.eutils_latency, record=args.record)
+    for server in (llm_server, eutils_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    directory = tempfile.mkdtemp()
+    os.environ.update({
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{llm_server.server_address[1]}/v1",
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(directory, "e2e.sqlite3"),
+        "PIPELINE_RECORD_PATH": os.path.join(directory, "records.jsonl"),
+        "QUESTION_CLASSIFIER_PATH": os.path.join(directory, "missing.joblib"),
+        "PUBMED_SOURCE": "live",
+        "ENTREZ_EMAIL": os.getenv("ENTREZ_EMAIL", "e2e-benchmark@example.com"),
+        # Time runs --llm-scale times faster, so the LLM gateway's per-minute limits scale up with it
+        "LLM_TPM": str(int(int(os.getenv("LLM_TPM", 300000)) / args.llm_scale)),
+        "LLM_RPM": str(int(int(os.getenv("LLM_RPM", 3000)) / args.llm_scale)),
+    })
+    import helper_functions
+    import main as api
+    import pipeline_metrics
+    import write_behind
+    redirect_entrez(f"http://127.0.0.1:{eutils_server.server_address[1]}/entrez/eutils/")
+    replace_publishers(helper_functions, pipeline_metrics, args.publisher_latency)
+
+    finals = {}
+    api.send_update = lambda session_id, data: finals.__setitem__(session_id, data) if isinstance(data, dict) else None
+
+    def run(index):
+        api.process_user_query(questions[index], f"e2e-{index}", validate=args.validate)
+
+    print(f"running {len(questions)} questions at concurrency {args.concurrency} (LLM latency x{args.llm_scale})")
+    if not args.verbose:
+        for name in ("dietnerd.pipeline", "httpx"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    failures = []
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for future in [executor.submit(run, index) for index in range(len(questions))]:
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append(e)
+        wall_seconds = time.perf_counter() - start
+        write_behind.drain()
+    for failure in failures:
+        print("Question failed:", failure)
+
+    with open(pipeline_metrics.PIPELINE_RECORD_PATH) as f:
+        records = [json.loads(line) for line in f]
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    summary = summarize(records, wall_seconds, llm_server, eutils_server, peak_rss_mb, args.concurrency)
+    results = {}
+    for index, question in enumerate(questions):
+        final = finals.get(f"e2e-{index}") or {}
+        pmids = sorted(str(article.get("PMID") or article.get("article_id")) for article in final.get("relevant_articles", []) if article)
+        results[question] = {"relevant_pmids": pmids, "answer_sha": answer_signature(final)}
+    current = {"config": vars(args), "summary": summary, "questions": results}
+
+    print_summary(summary)
+    if args.record:
+        fixture.save()
+        print(f"saved {len(fixture.searches)} searches and {len(fixture.articles)} articles to {args.fixture}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), current, args.tolerance, args.min_seconds)
+        if regressions:
+            print(f"FAIL: {len(regressions)} regressions: {', '.join(regressions)}")
+            raise SystemExit(1)
+        print("OK: no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Checks the evidence budget's early exit in concurrent_article_processing and reports the article work it saves.
+
+--articles articles are processed on the shared article pool with --workers workers, each taking --latency seconds
+and summarizing to a high-tier article (a meta-analysis), so the budget is met after EVIDENCE_ENOUGH (--enough)
+articles while other articles are still in flight and finish after the exit. The processing call is a stand-in, so
+no API keys are needed.
+
+The run fails (exit status 1) unless the budget exited once, every article was either processed or cancelled, the
+cancelled count matches the articles that never started, and no more articles than --enough + --workers were
+processed, i.e. those finishing after the exit did not cancel or count anything again.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.early_exit_benchmark --articles 40 --workers 4 --enough 3
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import types
+
+
+def check(budget, summaries, started, args):
+    """
+    Returns the failed checks of one run.
+    """
+    failures = []
+    processed = len(summaries)
+    if not budget.exited:
+        failures.append("the budget never exited")
+    if processed + budget.cancelled != args.articles:
+        failures.append(f"{processed} processed + {budget.cancelled} cancelled != {args.articles} articles")
+    if budget.cancelled != args.articles - len(started):
+        failures.append(f"{budget.cancelled} counted as cancelled, but {args.articles - len(started)} articles never started")
+    if processed > args.enough + args.workers:
+        failures.append(f"{processed} articles processed, expected at most {args.enough + args.workers}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--articles", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--enough", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["FAIR_ARTICLE_WORKERS"] = str(args.workers)
+    import evidence_ranking
+    import helper_functions
+
+    started = []
+    lock = threading.Lock()
+
+    def process(article):
+        with lock:
+            started.append(article.pmid)
+        # Staggered, so articles keep finishing after the one that meets the budget
+        time.sleep(args.latency * (1 + (article.pmid % args.workers) / args.workers))
+        return {"PMID": article.pmid, "publication_type": ["Meta-Analysis"]}
+
+    helper_functions.process_article_with_retry = process
+    articles = [types.SimpleNamespace(pmid=pmid) for pmid in range(args.articles)]
+    budget = evidence_ranking.EvidenceBudget(enough=args.enough)
+    start = time.perf_counter()
+    summaries = helper_functions.concurrent_article_processing(articles, budget)
+    elapsed = time.perf_counter() - start
+
+    print(f"processed {len(summaries)}, cancelled {budget.cancelled} of {args.articles} articles in {elapsed:.2f}s "
+          f"(all of them would take about {args.articles * args.latency * 1.4 / args.workers:.2f}s)")
+    failures = check(budget, summaries, started, args)
+    for failure in failures:
+        print("FAIL:", failure)
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
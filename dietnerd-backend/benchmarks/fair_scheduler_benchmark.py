@@ -0,0 +1,88 @@
+"""
+Per-session latency of article work for a mix of large and small questions, with per-question thread pools (the old
+concurrent_article_processing) and with the shared deficit round-robin pool (fair_scheduler.py).
+
+--large questions with --large-articles article tasks each start first, then --small questions with
+--small-articles tasks arrive one every --arrival-gap seconds. Every task holds one of --capacity upstream slots
+for --latency seconds, standing in for the LLM capacity all sessions share. With per-question pools every question
+runs 8 tasks at once and the upstream slots go to whichever threads ask first, so small questions queue behind the
+large ones; the fair pool has --capacity workers and serves the sessions with queued tasks in turn.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.fair_scheduler_benchmark --large 3 --small 6
+"""
+import argparse
+import math
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from benchmarks.scheduler_benchmark import Upstream
+from fair_scheduler import FairExecutor
+
+
+def per_question_pool(upstream, session, tasks):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: upstream.call(), range(tasks)))
+
+
+def fair_pool(pool, upstream, session, tasks):
+    futures = [pool.submit(session, upstream.call) for _ in range(tasks)]
+    for future in as_completed(futures):
+        future.result()
+
+
+def run(args, fair):
+    upstream = Upstream(args.capacity, args.latency)
+    pool = FairExecutor("benchmark", workers=args.capacity) if fair else None
+    sessions = [("large", args.large_articles, 0.0) for _ in range(args.large)]
+    sessions += [("small", args.small_articles, args.arrival_gap * (i + 1)) for i in range(args.small)]
+    latencies = {"large": [], "small": []}
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def session(index, size, tasks, arrival):
+        time.sleep(arrival)
+        submitted = time.perf_counter()
+        if fair:
+            fair_pool(pool, upstream, f"session-{index}", tasks)
+        else:
+            per_question_pool(upstream, f"session-{index}", tasks)
+        with lock:
+            latencies[size].append(time.perf_counter() - submitted)
+
+    threads = [threading.Thread(target=session, args=(i, *spec)) for i, spec in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    print(f"{'fair pool' if fair else 'per-question pools':19s} wall {wall:5.2f}s")
+    for size, tasks in (("small", args.small_articles), ("large", args.large_articles)):
+        values = latencies[size]
+        if not values:
+            continue
+        alone = math.ceil(tasks / 8) * args.latency
+        print(f"  {size:5s} ({tasks:2d} articles, {alone:.2f}s alone with 8 threads): "
+              f"p50 {statistics.median(values):5.2f}s  max {max(values):5.2f}s  mean slowdown x{statistics.mean(values) / alone:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--large", type=int, default=3)
+    parser.add_argument("--large-articles", type=int, default=50)
+    parser.add_argument("--small", type=int, default=6)
+    parser.add_argument("--small-articles", type=int, default=8)
+    parser.add_argument("--arrival-gap", type=float, default=0.1)
+    parser.add_argument("--capacity", type=int, default=16, help="shared upstream slots")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per article task")
+    args = parser.parse_args()
+
+    run(args, fair=False)
+    run(args, fair=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Checks that SSE heartbeats keep flowing while many blocking LLM and database calls are in flight.
+
+Starts the API with uvicorn on a free local port, with the OpenAI validity check replaced by a call that blocks for
+--llm-latency seconds, the /db_get and /db_sim_search lookups replaced by calls that block for --db-latency seconds,
+and a pipeline that only waits, so no API keys or database are needed (SQLite storage in a temp directory). One
+browser-like SSE stream is opened, then --requests /check_valid calls and --db-requests database calls (half /db_get,
+half /db_sim_search) are fired at once. If any handler ran its blocking call on the event loop instead of an executor,
+the heartbeat gaps on the stream would grow to the length of that call.
+
+The run fails (exit status 1) unless every request succeeded, heartbeats arrived during the burst, and the largest
+gap between them stayed under --max-gap (default twice the heartbeat interval).
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.heartbeat_benchmark --requests 100 --llm-latency 3 --db-requests 40 --db-latency 1
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+HEARTBEAT_INTERVAL = 1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def watch_heartbeats(client, base_url, session_id, stop, gaps):
+    last = None
+    async with client.stream("GET", f"{base_url}/sse", params={"session_id": session_id}) as response:
+        async for line in response.aiter_lines():
+            now = time.perf_counter()
+            if line.startswith(":"):
+                if last is not None:
+                    gaps.append(now - last)
+                last = now
+            if stop.is_set():
+                break
+
+
+async def run(args, base_url):
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.requests + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        session_id = (await client.post(f"{base_url}/process_query", json={"user_query": "heartbeat check"})).json()["session_id"]
+        stop = asyncio.Event()
+        gaps = []
+        watcher = asyncio.create_task(watch_heartbeats(client, base_url, session_id, stop, gaps))
+        await asyncio.sleep(HEARTBEAT_INTERVAL * 2.5)
+
+        start = time.perf_counter()
+        requests = [client.get(f"{base_url}/check_valid/question {i}") for i in range(args.requests)]
+        requests += [client.get(f"{base_url}/{'db_get' if i % 2 else 'db_sim_search'}/question {i}") for i in range(args.db_requests)]
+        responses = await asyncio.gather(*requests)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(HEARTBEAT_INTERVAL * 1.5)
+        stop.set()
+        await watcher
+    return responses, elapsed, gaps
+
+
+def check(responses, gaps, elapsed, max_gap):
+    """
+    Returns the failed conditions of a run, empty if it passed.
+    """
+    failures = []
+    failed = sum(response.status_code != 200 for response in responses)
+    if failed:
+        failures.append(f"{failed} of {len(responses)} requests failed")
+    # Heartbeats must have kept arriving while the blocking calls ran, not only before and after them
+    if len(gaps) < elapsed / max_gap:
+        failures.append(f"only {len(gaps)} heartbeat gaps over {elapsed:.1f}s")
+    if gaps and max(gaps) >= max_gap:
+        failures.append(f"max heartbeat gap {max(gaps):.2f}s >= {max_gap:.2f}s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--llm-latency", type=float, default=3)
+    parser.add_argument("--db-requests", type=int, default=40)
+    parser.add_argument("--db-latency", type=float, default=1)
+    parser.add_argument("--max-gap", type=float, default=2 * HEARTBEAT_INTERVAL, help="largest heartbeat gap that passes")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["SSE_HEARTBEAT_INTERVAL"] = str(HEARTBEAT_INTERVAL)
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "heartbeat.sqlite3")
+
+    import uvicorn
+    import main as api
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    def slow_validity_check(question):
+        time.sleep(args.llm_latency)
+        return "True"
+
+    def idle_pipeline(user_query, session_id, validate=False):
+        time.sleep(args.llm_latency * (args.requests / 10 + 10))
+        api.send_update(session_id, {"end_output": ""})
+
+    def slow_db_call(query, include_articles=False):
+        time.sleep(args.db_latency)
+        return []
+
+    api.determine_question_validity = slow_validity_check
+    api.query_db_final = slow_db_call
+    api.sim_score = slow_db_call
+    api.process_user_query = idle_pipeline
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    responses, elapsed, gaps = asyncio.run(run(args, f"http://127.0.0.1:{port}"))
+    server.should_exit = True
+
+    ok = sum(response.status_code == 200 for response in responses)
+    print(f"requests: {ok}/{len(responses)} succeeded in {elapsed:.1f}s ({args.requests} /check_valid at {args.llm_latency}s, "
+          f"{args.db_requests} database calls at {args.db_latency}s)")
+    print(f"heartbeats: {len(gaps) + 1} received, max gap {max(gaps, default=float('inf')):.2f}s (interval {HEARTBEAT_INTERVAL}s)")
+    failures = check(responses, gaps, elapsed, args.max_gap)
+    if failures:
+        print(f"FAIL: the event loop was blocked: {'; '.join(failures)}")
+        sys.exit(1)
+    print("OK: heartbeats kept flowing")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Compares a burst of questions calling a rate-limited LLM API directly and through the LLM gateway (llm_gateway.py).
+
+Each simulated question has the shape of process_user_query: two query generation calls, a relevance classification
+fan-out and a reliability analysis fan-out on 8-thread pools, then one synthesis call. The simulated API serves at
+most --api-concurrency calls and --api-tpm tokens per minute, and answers anything beyond that with a 429 and a
+Retry-After, as OpenAI does. Without the gateway each call retries on its own like the OpenAI client (2 retries
+honoring Retry-After), and a reliability analysis that still fails sleeps 10 seconds and tries once more, as
+process_article_with_retry does. Through the gateway calls wait for their model's slot in priority order.
+
+All latencies are multiplied by --scale to keep the run short; the reported times are scaled back up.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.llm_gateway_benchmark --questions 8 --scale 0.05
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from benchmarks.e2e_benchmark import LLM_LATENCY, percentile
+from llm_gateway import LLMGateway
+
+# Prompt and completion tokens of each call
+CALL_TOKENS = {"general_query": (400, 30), "points_of_contention": (900, 300), "relevance": (700, 2),
+               "reliability_analysis": (6000, 700), "synthesis": (12000, 1200)}
+
+
+class RateLimitedAPI:
+    """
+    Simulated chat completions API with a concurrency limit and a tokens-per-minute bucket.
+    """
+
+    def __init__(self, concurrency, tpm, scale):
+        self.concurrency = concurrency
+        # Tokens per minute of scaled time
+        self.tpm = tpm / scale
+        self.scale = scale
+        self.tokens = float(self.tpm)
+        self.refilled = time.monotonic()
+        self.running = 0
+        self.calls = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def reject(self, retry_after):
+        self.rejected += 1
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        response = httpx.Response(429, headers={"retry-after-ms": str(int(retry_after * 1000))}, request=request)
+        return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+    def create(self, call, **kwargs):
+        prompt, completion = CALL_TOKENS[call]
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tpm, self.tokens + (now - self.refilled) * self.tpm / 60)
+            self.refilled = now
+            if self.running >= self.concurrency:
+                raise self.reject(1.0 * self.scale)
+            if self.tokens < prompt + completion:
+                raise self.reject((prompt + completion - self.tokens) * 60 / self.tpm)
+            self.tokens -= prompt + completion
+            self.running += 1
+            self.calls += 1
+        try:
+            time.sleep(LLM_LATENCY[call] * self.scale)
+        finally:
+            with self.lock:
+                self.running -= 1
+        usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+        return SimpleNamespace(usage=usage)
+
+
+def direct_call(api, call, scale):
+    # The OpenAI client's default: 2 retries, honoring Retry-After
+    for attempt in range(3):
+        try:
+            return api.create(call)
+        except openai.RateLimitError as e:
+            if attempt == 2:
+                raise
+            time.sleep(float(e.response.headers["retry-after-ms"]) / 1000)
+
+
+def question(llm, relevance_calls, processing_calls, scale, synthesis_waits):
+    """
+    Returns (seconds, articles lost to errors, whether the question failed).
+    """
+    start = time.perf_counter()
+    failures = 0
+    try:
+        llm("general_query")
+        llm("points_of_contention")
+        # Failed relevance calls drop the article, as in concurrent_relevance_classification
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            failures += sum(result is None for result in executor.map(lambda _: safe(llm, "relevance"), range(relevance_calls)))
+
+        def process(_):
+            try:
+                return llm("reliability_analysis")
+            except openai.RateLimitError:
+                time.sleep(10 * scale)
+                return llm("reliability_analysis")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            failures += sum(result is None for result in executor.map(lambda i: safe(process, i), range(processing_calls)))
+        synthesis_start = time.perf_counter()
+        llm("synthesis")
+        synthesis_waits.append(time.perf_counter() - synthesis_start)
+    except openai.RateLimitError:
+        return time.perf_counter() - start, failures, True
+    return time.perf_counter() - start, failures, False
+
+
+def safe(function, *args):
+    try:
+        return function(*args)
+    except openai.RateLimitError:
+        return None
+
+
+def run(args, through_gateway):
+    api = RateLimitedAPI(args.api_concurrency, args.api_tpm, args.scale)
+    if through_gateway:
+        # The limits of the simulated API
+        gateway = LLMGateway(limits={"in_flight": args.api_concurrency, "tpm": int(args.api_tpm / args.scale), "rpm": 0, "aging": 30 * args.scale})
+
+        def llm(call):
+            return gateway.complete(call, lambda **kwargs: api.create(call), model="simulated", messages=[{"content": "x" * CALL_TOKENS[call][0] * 4}], max_tokens=CALL_TOKENS[call][1])
+    else:
+        def llm(call):
+            return direct_call(api, call, args.scale)
+
+    synthesis_waits = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.questions) as executor:
+        results = list(executor.map(lambda _: question(llm, args.relevance_calls, args.processing_calls, args.scale, synthesis_waits), range(args.questions)))
+    wall = time.perf_counter() - start
+    durations = [duration / args.scale for duration, _, failed in results if not failed]
+    lost = sum(failures for _, failures, _ in results)
+    failed = sum(failed for _, _, failed in results)
+    print(f"{'gateway' if through_gateway else 'direct':8s} wall {wall / args.scale:7.1f}s  "
+          f"question p50 {statistics.median(durations) if durations else 0:6.1f}s max {max(durations, default=0):6.1f}s  "
+          f"synthesis p95 {percentile(synthesis_waits, 0.95) / args.scale if synthesis_waits else 0:5.1f}s  "
+          f"calls {api.calls:4d}  429s {api.rejected:5d}  articles lost {lost:3d}  questions failed {failed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=8)
+    parser.add_argument("--relevance-calls", type=int, default=40)
+    parser.add_argument("--processing-calls", type=int, default=15)
+    parser.add_argument("--api-concurrency", type=int, default=16)
+    parser.add_argument("--api-tpm", type=int, default=300000)
+    parser.add_argument("--scale", type=float, default=0.05)
+    args = parser.parse_args()
+
+    run(args, through_gateway=False)
+    run(args, through_gateway=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+HTTP load test of the serving layer: replays the browser's request sequence with a growing number of concurrent users.
+
+Each virtual user repeats the sequence of dietnerd-website/index.js until its stage ends:
+1. GET /db_get/<question>; a stored answer ends the sequence here, as it does in the browser.
+2. GET /db_sim_search/<question>.
+3. POST /submit (or, with --flow check_valid, GET /check_valid/<question> and POST /process_query, the sequence
+   before speculative validity checks).
+4. GET /sse?session_id=... until the final update, then GET /db_get/<question> again, as the page does when it
+   re-submits the question to show the new answer.
+
+The users ramp through --levels, e.g. 1,5,10,25,50 concurrent users for --stage-seconds each. Per level the run reports
+completed sequences, 429s and errors, time to first event (from the /submit response to the first SSE update), time
+to the final update (from the start of the sequence), dropped events (gaps in the SSE event ids, or streams that
+ended without a final update), and the server's peak open file descriptors and RSS.
+
+By default the API is started in a separate process (so its file descriptors and memory are measured alone) with
+stubbed backends, so no keys, MySQL or network are needed:
+- storage is SQLite in a temp directory, with answers stored for --stored gold-standard questions (a share
+  --hit-ratio of the sequences asks one of them);
+- the validity check blocks for --llm-latency seconds on the API's LLM executor;
+- the pipeline publishes the same progress updates as process_user_query over --pipeline-seconds, ends with a
+  final update built from output.json, and stores its answer through the write-behind queue.
+Pipeline workers, queue size and the other server settings come from the environment as usual (PIPELINE_WORKERS,
+PIPELINE_MAX_QUEUED, BROKER_BACKEND, ...). Pass --url to load a server that is already running instead, and
+--server-pid to sample its file descriptors and memory.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.load_benchmark --levels 1,5,10,25,50 --stage-seconds 20
+    PIPELINE_WORKERS=16 PIPELINE_MAX_QUEUED=100 python -m benchmarks.load_benchmark --levels 10,50,100
+    python -m benchmarks.load_benchmark --url http://127.0.0.1:8000 --server-pid 12345 --levels 1,5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from benchmarks.e2e_benchmark import GOLD_STANDARD_CSV, percentile
+
+PROGRESS_UPDATES = ["Generated PubMed queries...", "Retrieved {} Articles...", "Classified {} Relevant Articles...", "Processed {} Articles..."]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def load_questions(path):
+    import pandas as pd
+    return [question.strip() for question in pd.read_csv(path).dropna(subset=["QUESTION"])["QUESTION"]]
+
+
+def serve(args):
+    """
+    Runs the API with stubbed backends on --serve-port. Runs in the server process.
+    """
+    directory = tempfile.mkdtemp()
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.update({
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(directory, "load.sqlite3"),
+        "PIPELINE_RECORD_PATH": "",
+        "QUESTION_CLASSIFIER_PATH": os.path.join(directory, "missing.joblib"),
+    })
+
+    import uvicorn
+    import main as api
+    from benchmarks.answer_storage_benchmark import build_answers
+    from migrate_question_answer import article_analysis_row
+    from storage import get_storage
+    logging.getLogger().setLevel(logging.WARNING)
+
+    answers, pool = build_answers(args.dump, max(args.stored, 50), 2000)
+    storage = get_storage(api.env)
+    storage.open()
+    storage.upsert_articles([article_analysis_row(article) for article in pool])
+    questions = load_questions(args.csv)[:args.stored]
+    storage.upsert_answers([(question, answer) for question, (_, answer) in zip(questions, answers)])
+    finals = [answer for _, answer in answers]
+
+    def slow_validity_check(question):
+        time.sleep(args.llm_latency)
+        return "True"
+
+    def stub_pipeline(user_query, session_id, validate=False):
+        validity = api.start_validity_check(user_query) if validate else None
+        final = dict(random.choice(finals))
+        counts = [None, len(final["relevant_articles"]) * 2, len(final["relevant_articles"]), len(final["relevant_articles"])]
+        for i, (update, count) in enumerate(zip(PROGRESS_UPDATES, counts)):
+            time.sleep(args.pipeline_seconds / (len(PROGRESS_UPDATES) + 1))
+            if i == 2 and validity is not None:
+                validity.result()
+            api.send_update(session_id, update.format(count))
+        time.sleep(args.pipeline_seconds / (len(PROGRESS_UPDATES) + 1))
+        api.write_behind.enqueue_answer(user_query, final, api.env)
+        api.send_update(session_id, final)
+
+    api.determine_question_validity = slow_validity_check
+    api.process_user_query = stub_pipeline
+    uvicorn.run(api.app, host="127.0.0.1", port=args.serve_port, log_level="warning")
+
+
+def start_server(args):
+    port = free_port()
+    command = [sys.executable, "-m", "benchmarks.load_benchmark", "--serve-port", str(port), "--stored", str(args.stored),
+               "--llm-latency", str(args.llm_latency), "--pipeline-seconds", str(args.pipeline_seconds), "--dump", args.dump, "--csv", args.csv]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=None if args.verbose else subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    import httpx
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"server exited with status {process.returncode}; rerun with --verbose to see why")
+        try:
+            httpx.get(f"{base_url}/", timeout=1)
+            return process, base_url
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.kill()
+    sys.exit("server did not start within 120s")
+
+
+def server_usage(pid):
+    """
+    Returns (open file descriptors, RSS in MB) of a local process, or (None, None) if it cannot be read.
+    """
+    try:
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) / 1024
+        return fds, rss
+    except (OSError, StopIteration):
+        return None, None
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the server's file descriptors and RSS every `interval` seconds.
+    """
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.samples.append(server_usage(self.pid))
+            self.stopped.wait(self.interval)
+
+    def reset(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class Sequence:
+    """
+    Measurements of one browser sequence.
+    """
+
+    def __init__(self, question):
+        self.question = question
+        self.started = time.perf_counter()
+        self.outcome = None
+        self.requests = {}
+        self.first_event = None
+        self.completed = None
+        self.events = 0
+        self.dropped = 0
+
+
+async def timed_request(client, sequence, name, method, url, **kwargs):
+    start = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    sequence.requests[name] = time.perf_counter() - start
+    return response
+
+
+async def follow_stream(client, base_url, sequence, session_id, submitted):
+    """
+    Reads the session's SSE stream until the final update. Counts events and gaps in the event ids.
+    """
+    last_id = 0
+    data = []
+    async with client.stream("GET", f"{base_url}/sse", params={"session_id": session_id}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("id:"):
+                event_id = int(line[3:].strip())
+                sequence.dropped += max(0, event_id - last_id - 1)
+                last_id = event_id
+            elif line.startswith("data:"):
+                data.append(line[5:].strip())
+            elif not line and data:
+                update = json.loads("\n".join(data)).get("update")
+                data = []
+                sequence.events += 1
+                if sequence.first_event is None:
+                    sequence.first_event = time.perf_counter() - submitted
+                if isinstance(update, dict) and "end_output" in update:
+                    sequence.completed = time.perf_counter() - sequence.started
+                    return
+    # The stream closed without the final update
+    sequence.dropped += 1
+
+
+async def browser_sequence(client, base_url, question, flow):
+    sequence = Sequence(question)
+    path = quote(question, safe="")
+    try:
+        response = await timed_request(client, sequence, "db_get", "GET", f"{base_url}/db_get/{path}")
+        if response.status_code == 200 and response.json():
+            sequence.outcome = "stored"
+            return sequence
+        await timed_request(client, sequence, "db_sim_search", "GET", f"{base_url}/db_sim_search/{path}")
+        if flow == "check_valid":
+            await timed_request(client, sequence, "check_valid", "GET", f"{base_url}/check_valid/{path}")
+            response = await timed_request(client, sequence, "process_query", "POST", f"{base_url}/process_query", json={"user_query": question})
+        else:
+            response = await timed_request(client, sequence, "submit", "POST", f"{base_url}/submit", json={"user_query": question})
+        if response.status_code == 429:
+            sequence.outcome = "rejected"
+            return sequence
+        response.raise_for_status()
+        await follow_stream(client, base_url, sequence, response.json()["session_id"], time.perf_counter())
+        await timed_request(client, sequence, "db_get_answer", "GET", f"{base_url}/db_get/{path}")
+        sequence.outcome = "answered" if sequence.completed is not None else "incomplete"
+    except Exception as e:
+        logging.debug("Sequence failed: %r", e)
+        sequence.outcome = "error"
+    return sequence
+
+
+async def run_level(client, base_url, users, args, stored, new, counter):
+    deadline = time.perf_counter() + args.stage_seconds
+    sequences = []
+
+    async def user(index):
+        rng = random.Random(index)
+        while time.perf_counter() < deadline:
+            if stored and rng.random() < args.hit_ratio:
+                question = rng.choice(stored)
+            else:
+                # A unique question per sequence, so the answers stored by earlier sequences are not hit
+                counter[0] += 1
+                question = f"{rng.choice(new)} ({counter[0]})"
+            sequences.append(await browser_sequence(client, base_url, question, args.flow))
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[user(i) for i in range(users)])
+    return sequences, time.perf_counter() - start
+
+
+def report(users, sequences, seconds, samples):
+    outcomes = {}
+    for sequence in sequences:
+        outcomes[sequence.outcome] = outcomes.get(sequence.outcome, 0) + 1
+    answered = [sequence for sequence in sequences if sequence.outcome == "answered"]
+    first = [sequence.first_event for sequence in answered if sequence.first_event is not None]
+    completion = [sequence.completed for sequence in answered]
+    fds = [fd for fd, _ in samples if fd is not None]
+    rss = [mb for _, mb in samples if mb is not None]
+    stats = {
+        "users": users,
+        "sequences": len(sequences),
+        "outcomes": outcomes,
+        "answered_per_minute": round(len(answered) / seconds * 60, 2),
+        "first_event_p50": round(percentile(first, 0.5), 3) if first else None,
+        "first_event_p95": round(percentile(first, 0.95), 3) if first else None,
+        "completion_p50": round(percentile(completion, 0.5), 3) if completion else None,
+        "completion_p95": round(percentile(completion, 0.95), 3) if completion else None,
+        "events": sum(sequence.events for sequence in sequences),
+        "dropped_events": sum(sequence.dropped for sequence in sequences),
+        "max_fds": max(fds) if fds else None,
+        "max_rss_mb": round(max(rss), 1) if rss else None,
+    }
+    for name in ("db_get", "db_sim_search", "check_valid", "process_query", "submit"):
+        latencies = [sequence.requests[name] for sequence in sequences if name in sequence.requests]
+        if latencies:
+            stats[f"{name}_p95"] = round(percentile(latencies, 0.95), 3)
+
+    def seconds_text(value):
+        return f"{value:.2f}s" if value is not None else "-"
+    print(f"{users:5d} users: {len(sequences):4d} sequences {outcomes}, {stats['answered_per_minute']:.1f} answered/min")
+    print(f"             first event p50 {seconds_text(stats['first_event_p50'])} p95 {seconds_text(stats['first_event_p95'])}, "
+          f"final p50 {seconds_text(stats['completion_p50'])} p95 {seconds_text(stats['completion_p95'])}, "
+          f"{stats['events']} events, {stats['dropped_events']} dropped")
+    requests = ", ".join(f"{key[:-4]} {value * 1000:.0f}ms" for key, value in stats.items() if key.endswith("_p95") and not key.startswith(("first", "completion")))
+    print(f"             request p95: {requests}; server max fds {stats['max_fds']}, max RSS {stats['max_rss_mb']} MB")
+    return stats
+
+
+async def run(args, base_url, pid):
+    import httpx
+
+    questions = load_questions(args.csv)
+    stored, new = questions[:args.stored], questions[args.stored:] or questions
+    sampler = Sampler(pid) if pid else None
+    if sampler:
+        sampler.start()
+    levels = [int(level) for level in args.levels.split(",")]
+    limits = httpx.Limits(max_connections=max(levels) * 2 + 10, max_keepalive_connections=max(levels) * 2 + 10)
+    results = []
+    counter = [0]
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for users in levels:
+            if sampler:
+                sampler.reset()
+            sequences, seconds = await run_level(client, base_url, users, args, stored, new, counter)
+            results.append(report(users, sequences, seconds, sampler.reset() if sampler else []))
+    if sampler:
+        sampler.stopped.set()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="1,5,10,25,50", help="comma-separated numbers of concurrent users, run in turn")
+    parser.add_argument("--stage-seconds", type=float, default=20, help="how long each level starts new sequences")
+    parser.add_argument("--flow", choices=("submit", "check_valid"), default="submit")
+    parser.add_argument("--hit-ratio", type=float, default=0.2, help="share of sequences asking a question with a stored answer")
+    parser.add_argument("--think-time", type=float, default=1.0, help="maximum pause between a user's sequences")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--url", help="load a running server instead of starting one with stubbed backends")
+    parser.add_argument("--server-pid", type=int, help="with --url, the server process to sample")
+    parser.add_argument("--stored", type=int, default=20, help="gold-standard questions with a stored answer")
+    parser.add_argument("--llm-latency", type=float, default=2.0, help="seconds per stubbed validity check")
+    parser.add_argument("--pipeline-seconds", type=float, default=10.0, help="duration of a stubbed pipeline")
+    parser.add_argument("--dump", default="output.json", help="question_answer dump the stubbed answers are built from")
+    parser.add_argument("--csv", default=GOLD_STANDARD_CSV)
+    parser.add_argument("--json", help="also write the results of every level to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the server's output")
+    parser.add_argument("--serve-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_port:
+        serve(args)
+        return
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    process = None
+    if args.url:
+        base_url, pid = args.url.rstrip("/"), args.server_pid
+    else:
+        process, base_url = start_server(args)
+        pid = process.pid
+        print(f"server pid {pid} at {base_url}: validity check {args.llm_latency}s, pipeline {args.pipeline_seconds}s, "
+              f"PIPELINE_WORKERS={os.getenv('PIPELINE_WORKERS', 4)}, PIPELINE_MAX_QUEUED={os.getenv('PIPELINE_MAX_QUEUED', 20)}")
+    try:
+        results = asyncio.run(run(args, base_url, pid))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
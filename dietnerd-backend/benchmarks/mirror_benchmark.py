@@ -0,0 +1,125 @@
+"""
+Measures ingest rate and query latency of the local PubMed mirror (pubmed_mirror.py).
+
+By default a synthetic PubMed XML file of --articles articles is generated from a nutrition vocabulary, so the run needs
+no download; pass --file to use a real baseline file instead (e.g. pubmed25n0001.xml.gz). The mirror is built in a
+temp directory, then every example query of the query_generation prompts is run --repeat times, and the records of
+the top results are parsed into article records as article_retrieval would.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.mirror_benchmark --articles 30000
+    python -m benchmarks.mirror_benchmark --file pubmed25n0001.xml.gz
+"""
+import argparse
+import gzip
+import os
+import random
+import statistics
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+QUERIES = [
+    '(resveratrol OR "trans-3,5,4\'-trihydroxystilbene") AND human',
+    '(omega-3 OR "omega-3 fatty acids") AND "cardiovascular health"',
+    '("gut microbiota") AND ("diabetes management") AND ("recent"[Publication Date])',
+    '(resveratrol OR "trans-3,5,4\'-trihydroxystilbene") AND dose',
+    '(ginseng OR "Panax ginseng") AND cognition',
+    '(ginseng OR "Panax ginseng") AND immune',
+    '(Gingko OR "Gingko Biloba") AND (safety OR "side effects")',
+    'vitamin d[tiab] AND depression AND 2015:2024[dp]',
+    'intermittent fasting[tiab] AND weight loss',
+    'creatine AND (muscle OR strength) NOT adolescents',
+]
+
+TOPICS = ["resveratrol", "trans-3,5,4'-trihydroxystilbene", "omega-3 fatty acids", "omega-3", "gut microbiota", "ginseng", "Panax ginseng",
+          "Gingko Biloba", "vitamin D", "intermittent fasting", "creatine", "probiotics", "green tea", "curcumin", "magnesium", "caffeine"]
+OUTCOMES = ["cardiovascular health", "diabetes management", "cognition", "immune function", "side effects", "safety", "depression",
+            "weight loss", "muscle strength", "inflammation", "blood pressure", "sleep quality", "dose response"]
+FILLER = ("randomized controlled trial of adults in a cohort with follow up where outcomes were measured and compared against placebo "
+          "results suggest a significant association between intake and risk after adjustment for confounders in human subjects").split()
+MESH = ["Humans", "Adult", "Dietary Supplements", "Diet", "Female", "Male", "Aged", "Obesity", "Depression", "Cognition"]
+PUBLICATION_TYPES = ["Journal Article", "Randomized Controlled Trial", "Meta-Analysis", "Review", "Systematic Review"]
+PROLOG = ('<?xml version="1.0" ?>\n<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" '
+          '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">\n')
+
+
+def synthetic_article(pmid, rng):
+    topic, outcome = rng.choice(TOPICS), rng.choice(OUTCOMES)
+    title = f"Effect of {topic} on {outcome}: a {rng.choice(PUBLICATION_TYPES).lower()}"
+    abstract = " ".join(rng.choice(FILLER) for _ in range(rng.randint(120, 250)))
+    abstract = f"{abstract} {topic} {outcome} {rng.choice(TOPICS)}."
+    mesh = "".join(f'<MeshHeading><DescriptorName UI="D0{i:05d}" MajorTopicYN="N">{escape(term)}</DescriptorName></MeshHeading>'
+                   for i, term in enumerate(rng.sample(MESH, 4)))
+    pmc = f'<ArticleId IdType="pmc">PMC{pmid}</ArticleId>' if pmid % 3 == 0 else ""
+    authors = "".join(f'<Author ValidYN="Y"><LastName>Author{i}</LastName><ForeName>A</ForeName><Initials>A</Initials></Author>'
+                      for i in range(rng.randint(1, 8)))
+    return (f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID>'
+            f'<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Internet"><Volume>{rng.randint(1, 90)}</Volume><Issue>{rng.randint(1, 12)}</Issue>'
+            f'<PubDate><Year>{rng.randint(1995, 2024)}</Year><Month>Jan</Month></PubDate></JournalIssue><Title>Journal of Nutrition</Title></Journal>'
+            f'<ArticleTitle>{escape(title)}</ArticleTitle><Pagination><MedlinePgn>1-10</MedlinePgn></Pagination>'
+            f'<Abstract><AbstractText Label="BACKGROUND" NlmCategory="BACKGROUND">{escape(topic)} and {escape(outcome)}.</AbstractText>'
+            f'<AbstractText Label="RESULTS" NlmCategory="RESULTS">{escape(abstract)}</AbstractText></Abstract>'
+            f'<AuthorList CompleteYN="Y">{authors}</AuthorList><Language>eng</Language><PublicationTypeList>'
+            f'<PublicationType UI="D016428">{rng.choice(PUBLICATION_TYPES)}</PublicationType></PublicationTypeList></Article>'
+            f'<MeshHeadingList>{mesh}</MeshHeadingList></MedlineCitation><PubmedData><ArticleIdList>'
+            f'<ArticleId IdType="pubmed">{pmid}</ArticleId><ArticleId IdType="doi">10.1000/jn.{pmid}</ArticleId>'
+            f'{pmc}</ArticleIdList></PubmedData></PubmedArticle>\n')
+
+
+def write_sample(path, articles, seed=0):
+    rng = random.Random(seed)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(PROLOG + "<PubmedArticleSet>\n")
+        for pmid in range(1, articles + 1):
+            f.write(synthetic_article(pmid, rng))
+        f.write("</PubmedArticleSet>\n")
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="PubMed baseline/update file to ingest instead of a synthetic sample")
+    parser.add_argument("--articles", type=int, default=30000, help="size of the synthetic sample")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    from pubmed_cache import parse_records
+    from pubmed_mirror import PubMedMirror, translate_query
+
+    directory = tempfile.mkdtemp()
+    path = args.file
+    if path is None:
+        path = os.path.join(directory, "sample.xml.gz")
+        write_sample(path, args.articles)
+        print(f"synthetic sample: {args.articles} articles, {os.path.getsize(path) / 1e6:.1f} MB gzipped")
+
+    mirror = PubMedMirror(os.path.join(directory, "mirror.sqlite3"))
+    stats = mirror.ingest(path)
+    print(f"ingest: {stats['articles']} articles in {stats['seconds']:.1f}s ({stats['articles'] / stats['seconds']:.0f} articles/s), "
+          f"database {os.path.getsize(mirror.path) / 1e6:.1f} MB")
+
+    latencies = []
+    for query in QUERIES:
+        pmids = []
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            pmids = mirror.search(query)
+            timings.append(time.perf_counter() - start)
+        latencies += timings
+        start = time.perf_counter()
+        articles = parse_records(mirror.records(pmids))
+        parse = time.perf_counter() - start
+        print(f"{statistics.median(timings) * 1000:7.2f} ms search, {parse * 1000:6.1f} ms records ({len(articles):2d}): {query}")
+        print(f"          {translate_query(query)}")
+    print(f"search latency over {len(latencies)} queries: p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compares the streaming efetch parser (pubmed_parser.py) with Entrez.read.
+
+Parses efetch-style documents of --batch articles (synthetic by default, or taken from a PubMed XML --file) with both
+parsers and reports, per 1,000 records, the parse time, the peak memory allocated while parsing, the memory still held
+by the parsed records, and their pickled size.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.parser_benchmark --batch 1000 --repeat 5
+    python -m benchmarks.parser_benchmark --file pubmed25n0001.xml.gz
+"""
+import argparse
+import gc
+import gzip
+import io
+import pickle
+import random
+import statistics
+import time
+import tracemalloc
+
+from benchmarks.mirror_benchmark import PROLOG, synthetic_article
+
+
+def sample_document(args):
+    if args.file is None:
+        rng = random.Random(0)
+        body = "".join(synthetic_article(pmid, rng) for pmid in range(1, args.batch + 1))
+        return (PROLOG + "<PubmedArticleSet>\n" + body + "</PubmedArticleSet>\n").encode()
+    from pubmed_cache import SET_CLOSE, SET_OPEN, split_articles
+    opener = gzip.open if args.file.endswith(".gz") else open
+    with opener(args.file, "rb") as f:
+        document = f.read()
+    # Entrez.read validates against the DTD, so the file's XML declaration and DOCTYPE are kept
+    prolog = document[:document.find(SET_OPEN)]
+    articles = split_articles(document)
+    return prolog + SET_OPEN + b"".join(list(articles.values())[:args.batch]) + SET_CLOSE
+
+
+def entrez_read(document):
+    from Bio import Entrez
+    return list(Entrez.read(io.BytesIO(document))["PubmedArticle"])
+
+
+def streaming_parse(document):
+    from pubmed_parser import parse_articles
+    return list(parse_articles(document))
+
+
+def measure(parse, document, repeat):
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        records = parse(document)
+        timings.append(time.perf_counter() - start)
+        del records
+    gc.collect()
+    tracemalloc.start()
+    records = parse(document)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, statistics.median(timings), peak, held, len(pickle.dumps(records))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="PubMed XML file to take records from instead of synthetic ones")
+    parser.add_argument("--batch", type=int, default=1000, help="records per document")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    document = sample_document(args)
+    print(f"document: {len(document) / 1e6:.1f} MB")
+    results = {}
+    for name, parse in (("Entrez.read", entrez_read), ("pubmed_parser", streaming_parse)):
+        records, seconds, peak, held, pickled = measure(parse, document, args.repeat)
+        per_1000 = 1000 / len(records)
+        results[name] = seconds * per_1000
+        print(f"{name:14s} {len(records)} records | per 1,000: {seconds * per_1000 * 1000:7.1f} ms, peak {peak * per_1000 / 1e6:6.1f} MB, "
+              f"held {held * per_1000 / 1e6:6.1f} MB, pickled {pickled * per_1000 / 1e6:5.1f} MB")
+    print(f"speedup: {results['Entrez.read'] / results['pubmed_parser']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmarks completion time of a burst of questions with and without the job scheduler.
+
+Each simulated pipeline has the shape of process_user_query: one query generation call, a relevance classification
+fan-out and an article processing fan-out on 8-thread pools, then one synthesis call. Every call goes through a shared
+upstream with a fixed number of concurrent slots, standing in for the OpenAI and NCBI rate limits. Without the
+scheduler every question in the burst starts at once (the old BackgroundTasks behaviour); with it, at most
+--workers pipelines run and up to --max-queued wait. Completion time is measured from the start of the burst.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.scheduler_benchmark --burst 50 --workers 4 --max-queued 60
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from job_scheduler import JobScheduler, QueueFullError
+
+
+class Upstream:
+    """
+    Shared API with `capacity` concurrent slots and a fixed latency per call.
+    """
+
+    def __init__(self, capacity, latency):
+        self.latency = latency
+        self._slots = threading.Semaphore(capacity)
+
+    def call(self):
+        with self._slots:
+            time.sleep(self.latency)
+
+
+def pipeline(upstream, relevance_calls, processing_calls):
+    upstream.call()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: upstream.call(), range(relevance_calls)))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: upstream.call(), range(processing_calls)))
+    upstream.call()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_burst(args, scheduled):
+    """
+    Submits --burst pipelines at once and waits for all of them.
+
+    Returns:
+    - completion_times (list): Seconds from the start of the burst to the end of each accepted pipeline.
+    - rejected (int): Pipelines rejected with QueueFullError.
+    """
+    upstream = Upstream(args.capacity, args.latency)
+    completion_times = []
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+    start = time.perf_counter()
+
+    def job():
+        try:
+            pipeline(upstream, args.relevance_calls, args.processing_calls)
+        finally:
+            with lock:
+                completion_times.append(time.perf_counter() - start)
+            done.release()
+
+    accepted = 0
+    rejected = 0
+    scheduler = JobScheduler(workers=args.workers, max_queued=args.max_queued) if scheduled else None
+    for i in range(args.burst):
+        if scheduler is None:
+            threading.Thread(target=job, daemon=True).start()
+            accepted += 1
+            continue
+        try:
+            scheduler.submit(f"job-{i}", job)
+            accepted += 1
+        except QueueFullError:
+            rejected += 1
+    for _ in range(accepted):
+        done.acquire()
+    return completion_times, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-queued", type=int, default=60)
+    parser.add_argument("--capacity", type=int, default=32, help="concurrent upstream calls")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per upstream call")
+    parser.add_argument("--relevance-calls", type=int, default=40)
+    parser.add_argument("--processing-calls", type=int, default=15)
+    args = parser.parse_args()
+
+    for name, scheduled in (("unbounded background tasks", False), (f"scheduler ({args.workers} workers)", True)):
+        completion_times, rejected = run_burst(args, scheduled)
+        print(f"[{name}] burst of {args.burst}")
+        print(f"  completed: {len(completion_times)}, rejected: {rejected}")
+        print(f"  p50: {statistics.median(completion_times):.2f}s, p99: {percentile(completion_times, 0.99):.2f}s, "
+              f"max: {max(completion_times):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Measures the speculative pipeline start of /submit against the old /check_valid-then-/process_query sequence.
+
+The pipeline stages of main.process_user_query are replaced with sleeps of realistic relative length (seconds, scaled
+by --scale), so the run needs no API keys, network or database. For a valid question it reports the wall-clock time
+from submission to the final update both ways; for a refused question it reports how long the speculative pipeline
+ran and which billable work it started before the refusal.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.speculative_benchmark --scale 0.1
+"""
+import argparse
+import os
+import tempfile
+import time
+
+
+def install_stubs(api, args, calls):
+    """
+    Replaces the pipeline stages in main with sleeps and records which stages ran.
+    """
+    import pandas as pd
+    from pubmed_parser import PubMedArticle
+
+    def stage(name, seconds, result):
+        def run(*_args, **_kwargs):
+            calls.append(name)
+            time.sleep(seconds * args.scale)
+            return result() if callable(result) else result
+        return run
+
+    article = PubMedArticle(pmid="1", abstract="abstract")
+    api.determine_question_validity = lambda question: (calls.append("validity_llm"), time.sleep(args.validity * args.scale),
+                                                        "False - Recipe" if "recipe" in question else "True")[-1]
+    api.query_generation = stage("query_generation_llm", args.query_generation, ("general", "contention", ["query"]))
+    api.collect_articles = stage("pubmed_search", args.retrieval, lambda: [article])
+    api.concurrent_relevance_classification = stage("relevance_llm", args.relevance, lambda: ([article], []))
+    api.connect_to_reliability_analysis_db = lambda pmids: pd.DataFrame()
+    api.article_matching = lambda relevant, df: ([], relevant)
+    api.concurrent_article_processing = stage("processing_llm", args.processing, lambda: [{"PMID": "1"}])
+    api.generate_final_response_structured = stage("synthesis_llm", args.synthesis, ("answer", [], []))
+    api.write_behind.enqueue_articles = lambda *a: None
+    api.write_behind.enqueue_answer = lambda *a: None
+    api.build_output_record = lambda *a, **k: {}
+    api.SYNTHESIS_CITATION_MODE = "pmid"
+
+
+def run_question(api, question, speculative):
+    """
+    Returns:
+    - elapsed (float): Seconds from submission to the final update.
+    - final (dict): The final update.
+    """
+    updates = []
+    api.send_update = lambda session_id, data: updates.append(data)
+    start = time.perf_counter()
+    if speculative:
+        api.process_user_query(question, "bench", validate=True)
+    else:
+        # The browser waited for /check_valid before posting /process_query
+        if api.refusal_message(api.check_question_validity(question, api.determine_question_validity)) is None:
+            api.process_user_query(question, "bench")
+        else:
+            updates.append({"end_output": "refused", "refusal": True})
+    elapsed = time.perf_counter() - start
+    return elapsed, updates[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=0.1, help="multiplier applied to every stage duration")
+    parser.add_argument("--validity", type=float, default=1.5)
+    parser.add_argument("--query-generation", type=float, default=5)
+    parser.add_argument("--retrieval", type=float, default=4)
+    parser.add_argument("--relevance", type=float, default=8)
+    parser.add_argument("--processing", type=float, default=12)
+    parser.add_argument("--synthesis", type=float, default=15)
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "speculative.sqlite3")
+    os.environ["QUESTION_CLASSIFIER_PATH"] = os.path.join(tempfile.mkdtemp(), "missing.joblib")
+    import main as api
+
+    calls = []
+    install_stubs(api, args, calls)
+
+    print(f"stage durations scaled by {args.scale}")
+    serial, _ = run_question(api, "Does vitamin D help depression?", speculative=False)
+    speculative, final = run_question(api, "Does vitamin D help depression?", speculative=True)
+    print(f"[valid question] serial: {serial:.2f}s, speculative: {speculative:.2f}s, "
+          f"gain: {serial - speculative:.2f}s ({(serial - speculative) / serial:.1%})")
+
+    calls.clear()
+    serial, _ = run_question(api, "Give me a recipe for brownies", speculative=False)
+    serial_calls = list(calls)
+    calls.clear()
+    speculative, final = run_question(api, "Give me a recipe for brownies", speculative=True)
+    wasted = [call for call in calls if call not in serial_calls]
+    print(f"[refused question] serial: {serial:.2f}s, speculative: {speculative:.2f}s (refusal sent: {final.get('refusal', False)})")
+    print(f"  work started only by the speculative pipeline: {', '.join(wasted) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmarks article_analysis and question_answer throughput of the storage backends at realistic table sizes.
+
+Rows are synthesized from a stored question_answer dump (default: output.json), so article JSON and answer sizes match
+production. The MySQL backend writes to separate bench_* tables and is only run when requested.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.storage_benchmark --backends sqlite --articles 20000 --answers 2000
+    python -m benchmarks.storage_benchmark --backends sqlite,mysql
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from storage import MySQLStorage, SQLiteStorage
+
+
+def load_templates(path):
+    """
+    Loads article JSON and answer templates from a question_answer dump.
+
+    Parameters:
+    - path (str): Path to a JSON dump of question_answer rows.
+
+    Returns:
+    - article_templates (list): Article JSON dictionaries in the article_analysis format.
+    - answer_template (dict): A stored final output object.
+    """
+    with open(path) as f:
+        rows = json.load(f)
+    answer = json.loads(rows[0][1])
+    articles = answer.get("relevant_articles") or answer.get("relevent_articles") or []
+    article_templates = [{
+        "url": article.get("url"),
+        "PMID": article.get("PMID"),
+        "PMCID": article.get("PMCID"),
+        "summary": article.get("summary"),
+        "citation": article.get("citation"),
+        "article_type": article.get("publication_type") or article.get("article_type"),
+    } for article in articles]
+    return article_templates, answer
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def run(storage, article_templates, answer_template, n_articles, n_answers, batch_size, lookups):
+    """
+    Fills the tables and measures upsert, lookup and scan throughput.
+
+    Returns:
+    - results (dict): Benchmark name mapped to a result string.
+    """
+    results = {}
+    pmids = [str(10_000_000 + i) for i in range(n_articles)]
+
+    def article_row(pmid):
+        article = dict(random.choice(article_templates), PMID=pmid)
+        return (pmid, article)
+
+    batch_times = []
+    for i in range(0, n_articles, batch_size):
+        batch = [article_row(pmid) for pmid in pmids[i:i + batch_size]]
+        batch_times.append(timed(storage.upsert_articles, batch))
+    results["article upsert"] = f"{n_articles / sum(batch_times):,.0f} rows/s (batches of {batch_size})"
+
+    lookup_times = []
+    for _ in range(lookups):
+        sample = random.sample(pmids, 50)
+        lookup_times.append(timed(storage.get_articles, sample))
+    results["article lookup (50 PMIDs)"] = (f"p50 {statistics.median(lookup_times) * 1000:.2f} ms, "
+                                            f"p99 {sorted(lookup_times)[int(len(lookup_times) * 0.99) - 1] * 1000:.2f} ms")
+
+    scan_times = [timed(storage.get_articles) for _ in range(3)]
+    results["article full scan"] = f"{statistics.median(scan_times) * 1000:.0f} ms for {n_articles:,} rows"
+
+    questions = [f"benchmark question {i}?" for i in range(n_answers)]
+    answer_times = [timed(storage.upsert_answers, [(question, answer_template)]) for question in questions]
+    results["answer upsert"] = f"{n_answers / sum(answer_times):,.0f} rows/s (single row)"
+
+    get_times = [timed(storage.get_answer, random.choice(questions)) for _ in range(lookups)]
+    results["answer exact lookup"] = f"p50 {statistics.median(get_times) * 1000:.2f} ms"
+
+    list_times = [timed(storage.list_questions) for _ in range(10)]
+    results["similarity corpus load"] = f"{statistics.median(list_times) * 1000:.1f} ms for {n_answers:,} questions"
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump", default="output.json")
+    parser.add_argument("--backends", default="sqlite")
+    parser.add_argument("--articles", type=int, default=20000)
+    parser.add_argument("--answers", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    article_templates, answer_template = load_templates(args.dump)
+    for backend in args.backends.split(","):
+        if backend == "sqlite":
+            directory = tempfile.mkdtemp()
+            storage = SQLiteStorage(os.path.join(directory, "bench.sqlite3"))
+        elif backend == "mysql":
+            storage = MySQLStorage("ATT81274.env", article_table="bench_article_analysis", answer_table="bench_question_answer")
+            storage.create_schema()
+            storage._execute(f"TRUNCATE TABLE {storage.article_table}", commit=True)
+            storage._execute(f"TRUNCATE TABLE {storage.answer_table}", commit=True)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+
+        print(f"[{backend}]")
+        results = run(storage, article_templates, answer_template, args.articles, args.answers, args.batch_size, args.lookups)
+        for name, result in results.items():
+            print(f"  {name}: {result}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Offline comparison of reliability summary models on captured article inputs (summary_routing.py).
+
+Run the API or the e2e benchmark with SUMMARY_CAPTURE_PATH set to collect the exact system prompt and content of
+every article summary, then replay them here with each --models candidate. Each summary is compared against the
+reference, by default the captured summary (the model production used), or a fresh one from --reference-model:
+- sections: share of the prompt's numbered points (9 for reviews, 13 for studies) present and non-empty;
+- numbers: share of the reference's numbers (p-values, confidence intervals, sample sizes, ...) that the candidate
+  also reports;
+- length relative to the reference, latency, tokens and estimated cost.
+Results are grouped by content class (abstract, short full text, long full text), and the routing policy (the
+current SUMMARY_ROUTES or --routes) is priced against sending everything to the reference model.
+
+--dry-run makes no API calls and only shows how the routes split the captured inputs, with estimated costs.
+Calls go through the LLM gateway, so OPENAI_API_KEY / OPENAI_BASE_URL and the LLM_* limits apply.
+
+Usage (from dietnerd-backend/):
+    SUMMARY_CAPTURE_PATH=summaries.jsonl python -m benchmarks.e2e_benchmark --questions 20
+    python -m benchmarks.summary_cascade_benchmark --capture summaries.jsonl --models gpt-4o-mini,gpt-4-turbo
+    python -m benchmarks.summary_cascade_benchmark --capture summaries.jsonl --dry-run --routes '[{"full_text": false, "model": "gpt-4o-mini"}]'
+"""
+import argparse
+import json
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+NUMBER = re.compile(r"\d+(?:\.\d+)?%?")
+SHORT_FULL_TEXT = 6000
+
+
+def content_class(item):
+    if not item["full_text"]:
+        return "abstract"
+    return "short full text" if len(item["content"]) <= SHORT_FULL_TEXT else "long full text"
+
+
+def section_coverage(summary, review):
+    """
+    Returns the share of the prompt's numbered points that the summary answers.
+    """
+    expected = 9 if review else 13
+    found = 0
+    for number in range(1, expected + 1):
+        match = re.search(rf"(?m)^\s*\**{number}\.\s*(.*)$", summary or "")
+        if match and len(match.group(1).split(":", 1)[-1].strip()) > 3:
+            found += 1
+    return found / expected
+
+
+def number_recall(reference, candidate):
+    wanted = set(NUMBER.findall(reference or ""))
+    if not wanted:
+        return 1.0
+    return len(wanted & set(NUMBER.findall(candidate or ""))) / len(wanted)
+
+
+def summarize(client, gateway, model, item):
+    start = time.perf_counter()
+    response = gateway.complete("summary_comparison", client.chat.completions.create, model=model,
+                                messages=[{"role": "system", "content": item["system_prompt"]},
+                                          {"role": "user", "content": f"Paper: {item['content']}"}],
+                                temperature=0.6, top_p=1)
+    usage = response.usage
+    return {"summary": response.choices[0].message.content, "seconds": time.perf_counter() - start,
+            "prompt_tokens": usage.prompt_tokens if usage else 0, "completion_tokens": usage.completion_tokens if usage else 0}
+
+
+def estimated_cost(model, item):
+    from llm_gateway import estimate_tokens
+    from pipeline_metrics import llm_cost
+    prompt = estimate_tokens({"messages": [{"content": item["system_prompt"]}, {"content": item["content"]}], "max_tokens": 1}) - 1
+    completion = len(item.get("summary") or "") // 4 or 500
+    return llm_cost(model, prompt, completion)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture", required=True, help="JSON-lines file written with SUMMARY_CAPTURE_PATH")
+    parser.add_argument("--models", default="gpt-4o-mini,gpt-4-turbo", help="comma-separated candidate models")
+    parser.add_argument("--reference-model", help="summarize every input with this model as the reference instead of using the captured summary")
+    parser.add_argument("--routes", help="JSON list of routes to price instead of SUMMARY_ROUTES")
+    parser.add_argument("--limit", type=int, default=100, help="captured inputs to replay")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    import summary_routing
+    with open(args.capture) as f:
+        items = [json.loads(line) for line in f if line.strip()][:args.limit]
+    routes = json.loads(args.routes) if args.routes else summary_routing.SUMMARY_ROUTES
+    reference_model = args.reference_model or summary_routing.DEFAULT_SUMMARY_MODEL
+    models = [model for model in args.models.split(",") if model]
+
+    print(f"{len(items)} captured summaries")
+    routed = {}
+    for item in items:
+        model = summary_routing.choose_summary_model(item["full_text"], item["content"], item["review"], routes)
+        routed.setdefault((content_class(item), model), []).append(item)
+    routed_cost = sum(estimated_cost(model, item) for (_, model), group in routed.items() for item in group)
+    reference_cost = sum(estimated_cost(reference_model, item) for item in items)
+    for (kind, model), group in sorted(routed.items()):
+        print(f"  {kind:16s} -> {model:14s} {len(group):4d} articles, median {statistics.median(len(item['content']) for item in group):7.0f} chars")
+    print(f"estimated cost of the routes ${routed_cost:.3f} vs ${reference_cost:.3f} all {reference_model} "
+          f"({1 - routed_cost / reference_cost if reference_cost else 0:.0%} saved)")
+    if args.dry_run:
+        return
+
+    from openai import OpenAI
+    from llm_gateway import get_gateway
+    from pipeline_metrics import llm_cost
+    client, gateway = OpenAI(max_retries=0), get_gateway()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        if args.reference_model:
+            references = list(executor.map(lambda item: summarize(client, gateway, args.reference_model, item)["summary"], items))
+        else:
+            references = [item["summary"] for item in items]
+        results = {model: list(executor.map(lambda item: summarize(client, gateway, model, item), items)) for model in models}
+
+    print(f"\nagainst {'fresh ' + args.reference_model if args.reference_model else 'captured'} summaries:")
+    classes = sorted({content_class(item) for item in items})
+    for kind in classes:
+        indices = [i for i, item in enumerate(items) if content_class(item) == kind]
+        print(f"  {kind} ({len(indices)} articles)")
+        for model in models:
+            rows = [results[model][i] for i in indices]
+            sections = statistics.mean(section_coverage(row["summary"], items[i]["review"]) for row, i in zip(rows, indices))
+            numbers = statistics.mean(number_recall(references[i], row["summary"]) for row, i in zip(rows, indices))
+            length = statistics.mean(len(row["summary"] or "") / max(1, len(references[i] or "")) for row, i in zip(rows, indices))
+            cost = sum(llm_cost(model, row["prompt_tokens"], row["completion_tokens"]) for row in rows)
+            print(f"    {model:14s} sections {sections:4.0%}  numbers {numbers:4.0%}  length x{length:4.2f}  "
+                  f"p50 {statistics.median(row['seconds'] for row in rows):5.1f}s  ${cost:.3f}")
+
+
+if __name__ == "__main__":
+    main()
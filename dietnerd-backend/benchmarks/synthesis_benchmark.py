@@ -0,0 +1,97 @@
+"""
+Compares output tokens and latency of the final synthesis step with full AMA citations written by the model
+(`generate_final_response`) against evidence ID citations rendered locally (`generate_final_response_structured`).
+
+The evidence comes from a stored question_answer dump (default: output.json), so only the synthesis call is measured.
+Note that you will need an OpenAI API key to run this benchmark.
+
+Usage (from dietnerd-backend/):
+    python -m benchmarks.synthesis_benchmark --runs 3
+"""
+import argparse
+import json
+import statistics
+import time
+
+import helper_functions
+from helper_functions import generate_final_response, generate_final_response_structured
+
+
+def load_dump(path):
+    """
+    Loads the question and relevant articles of the first row of a question_answer dump.
+
+    Parameters:
+    - path (str): Path to a JSON dump of question_answer rows.
+
+    Returns:
+    - question (str): The stored question.
+    - articles (list): The stored relevant articles.
+    """
+    with open(path) as f:
+        rows = json.load(f)
+    question, answer = rows[0][0], json.loads(rows[0][1])
+    articles = answer.get("relevant_articles") or answer.get("relevent_articles") or []
+    return question.strip(), articles
+
+
+def measure(synthesize, articles, question):
+    """
+    Runs one synthesis call and records its wall-clock time and token usage.
+
+    Parameters:
+    - synthesize (function): The synthesis function to measure.
+    - articles (list): Relevant articles passed to the synthesis function.
+    - question (str): User question.
+
+    Returns:
+    - result (dict): Latency in seconds, prompt tokens and completion tokens.
+    """
+    usage = {}
+    create = helper_functions.client.chat.completions.create
+
+    def recording_create(*args, **kwargs):
+        response = create(*args, **kwargs)
+        usage["prompt_tokens"] = response.usage.prompt_tokens
+        usage["completion_tokens"] = response.usage.completion_tokens
+        return response
+
+    helper_functions.client.chat.completions.create = recording_create
+    try:
+        start = time.time()
+        synthesize(articles, question)
+        usage["latency"] = time.time() - start
+    finally:
+        helper_functions.client.chat.completions.create = create
+    return usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump", default="output.json")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    question, articles = load_dump(args.dump)
+    print(f"Question: {question}")
+    print(f"Articles: {len(articles)}")
+
+    results = {"full": [], "pmid": []}
+    for _ in range(args.runs):
+        results["full"].append(measure(generate_final_response, articles, question))
+        results["pmid"].append(measure(generate_final_response_structured, articles, question))
+
+    summary = {}
+    for mode, runs in results.items():
+        summary[mode] = {key: statistics.median(run[key] for run in runs) for key in ("latency", "prompt_tokens", "completion_tokens")}
+        print(f"[{mode}] median latency: {summary[mode]['latency']:.2f}s, "
+              f"prompt tokens: {summary[mode]['prompt_tokens']}, completion tokens: {summary[mode]['completion_tokens']}")
+
+    saved_tokens = summary["full"]["completion_tokens"] - summary["pmid"]["completion_tokens"]
+    saved_latency = summary["full"]["latency"] - summary["pmid"]["latency"]
+    print(f"Output tokens saved: {saved_tokens} ({saved_tokens / summary['full']['completion_tokens']:.0%})")
+    print(f"Synthesis latency saved: {saved_latency:.2f}s ({saved_latency / summary['full']['latency']:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,557 @@
+"""
+Job dispatch and SSE event fan-out, behind one interface so the API can run as several processes.
+
+With the default in-process broker, sessions live in this process's session hub and pipelines run on its job
+scheduler, so `/process_query` and `/sse` must be served by the same process. The TCP broker moves both to a small
+broker server: any API worker can create a session, any worker's pipeline threads can take the job, and any worker can
+stream the session's events to the browser. Run one broker server per deployment:
+
+    python broker.py --host 0.0.0.0 --port 8765
+
+For local runs and tests, `start_local_server()` starts the same server on a background thread.
+
+The wire protocol is newline-delimited JSON. Each request is an object with an "op"; `take` and `subscribe` keep the
+connection open, every other op gets exactly one reply line. A pipeline thread keeps its `take` connection open while
+it runs the job: it sends `started` when it receives the job and `done` when the job has finished. The job stays
+leased to that connection until then: if the connection drops first, e.g. because the worker process died, the job
+goes back to the front of the queue, and after BROKER_MAX_ATTEMPTS lost attempts that had started, its session is
+ended with an error instead. Idle pipeline threads whose connection drops are forgotten right away.
+
+Background jobs (see warmer.py) wait in a second queue that is only served when no user job is waiting, and `load`
+counts only user jobs, so the warmer sees the load of the whole deployment rather than of one process.
+
+Configuration (env):
+- BROKER_BACKEND: "inprocess" (default) or "tcp".
+- BROKER_HOST, BROKER_PORT: address of the broker server (default 127.0.0.1:8765).
+- BROKER_MAX_ATTEMPTS: times a job is handed out before a lost job is given up (default 3).
+- PIPELINE_WORKERS, PIPELINE_MAX_QUEUED: as in job_scheduler; with the TCP broker, PIPELINE_WORKERS is per API process
+  and PIPELINE_MAX_QUEUED applies to the shared queue.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+import metrics
+from job_scheduler import QueueFullError, get_scheduler, JOB_DURATION, JOB_FAILED
+from session_hub import hub, SessionHub
+
+# Final answers include every relevant article, so lines can be much larger than asyncio's 64 KiB default
+MAX_LINE = 64 * 1024 * 1024
+BROKER_MAX_ATTEMPTS = int(os.getenv('BROKER_MAX_ATTEMPTS', 3))
+
+BROKER_QUEUE_DEPTH = metrics.gauge("dietnerd_broker_queue_depth", "Jobs waiting in the broker server's queue.")
+BROKER_IDLE_WORKERS = metrics.gauge("dietnerd_broker_idle_workers", "Pipeline threads waiting on the broker server for a job.")
+BROKER_REQUEUED = metrics.counter("dietnerd_broker_requeued_jobs_total", "Jobs put back on the queue because their pipeline thread's connection dropped.")
+BROKER_ERRORS = metrics.counter("dietnerd_broker_errors_total", "Failed requests from this process to the broker server.", ("op",))
+
+
+def queue_position_message(position):
+    return f"Waiting in queue (position {position})..."
+
+
+def error_update():
+    """
+    Returns the final update of a session whose pipeline raised, so the browser's stream ends instead of timing out.
+    """
+    return {"end_output": "Sorry, something went wrong while answering your question. Please try again.",
+            "error": True, "citations": [], "citations_obj": []}
+
+
+class Broker:
+    """
+    Interface between the API and wherever sessions and jobs live.
+    """
+
+    def start(self, handler):
+        """
+        Starts delivering jobs to this process. Called once from the server's event loop at startup.
+
+        Parameters:
+        - handler (function): The pipeline, called on a worker thread as handler(user_query, session_id, validate).
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    async def submit(self, session_id, user_query, validate=False, background=False):
+        """
+        Creates the session and queues its job.
+
+        Parameters:
+        - session_id (str): The new session.
+        - user_query (str): The user's question.
+        - validate (bool): Run the validity check inside the pipeline, for questions that were not checked before submission.
+        - background (bool): Queue the job behind every user job, without queue positions.
+
+        Returns:
+        - position (int): 0 if the job starts right away, otherwise its 1-based queue position.
+
+        Raises:
+        - QueueFullError: If the job queue is full.
+        """
+        raise NotImplementedError
+
+    def load(self):
+        """
+        Returns the number of user jobs running or waiting, wherever they run. Blocking, so call it off the event loop.
+        """
+        raise NotImplementedError
+
+    def publish(self, session_id, data):
+        """
+        Publishes one update to a session. Safe to call from any thread.
+        """
+        raise NotImplementedError
+
+    async def exists(self, session_id):
+        raise NotImplementedError
+
+    def subscribe(self, session_id, last_event_id=0):
+        """
+        Returns an async generator of SSE event dictionaries, ending after the final update.
+        """
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """
+    Keeps sessions in the local session hub and runs jobs on the local job scheduler.
+    """
+
+    def __init__(self, session_hub=hub):
+        self.hub = session_hub
+        self.handler = None
+        self._sweeper = None
+
+    def start(self, handler):
+        self.handler = handler
+        # Updates are published from worker threads and delivered on this loop
+        self.hub.bind_loop(asyncio.get_running_loop())
+        self._sweeper = asyncio.get_running_loop().create_task(self.hub.run_sweeper())
+        self._scheduler().start()
+
+    def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+
+    def _scheduler(self):
+        return get_scheduler(on_position=lambda session_id, position: self.publish(session_id, queue_position_message(position)),
+                             on_error=lambda session_id, error: self.publish(session_id, error_update()))
+
+    async def submit(self, session_id, user_query, validate=False, background=False):
+        self.hub.create(session_id)
+        try:
+            position = self._scheduler().submit(session_id, self.handler, user_query, session_id, validate, background=background)
+        except QueueFullError:
+            self.hub.discard(session_id)
+            raise
+        if position:
+            self.publish(session_id, queue_position_message(position))
+        return position
+
+    def load(self):
+        return self._scheduler().load()
+
+    def publish(self, session_id, data):
+        self.hub.publish(session_id, data)
+
+    async def exists(self, session_id):
+        return self.hub.exists(session_id)
+
+    def subscribe(self, session_id, last_event_id=0):
+        return self.hub.subscribe(session_id, last_event_id)
+
+
+class BrokerServer:
+    """
+    Shared session hub and bounded FIFO job queue served over TCP.
+
+    Parameters:
+    - session_hub (SessionHub): Holds the sessions' replay buffers.
+    - max_queued (int): Jobs allowed to wait when no pipeline thread is idle.
+    """
+
+    def __init__(self, session_hub, max_queued=20):
+        self.hub = session_hub
+        self.max_queued = max_queued
+        self._jobs = deque()
+        self._background = deque()
+        # User jobs handed to a pipeline thread and not reported done yet
+        self._leased = 0
+        self._takers = deque()
+        self._average_duration = None
+        self._server = None
+        BROKER_QUEUE_DEPTH.set_function(lambda: len(self._jobs) + len(self._background))
+        BROKER_IDLE_WORKERS.set_function(lambda: len(self._takers))
+
+    async def start(self, host, port):
+        self.hub.bind_loop(asyncio.get_running_loop())
+        asyncio.get_running_loop().create_task(self.hub.run_sweeper())
+        self._server = await asyncio.start_server(self._handle, host, port, limit=MAX_LINE)
+        return self._server
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "take":
+                    await self._take(reader, writer)
+                elif op == "subscribe":
+                    await self._subscribe(writer, message["session_id"], message.get("last_event_id", 0))
+                    break
+                else:
+                    await self._send(writer, self._reply(op, message))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logging.exception("Broker connection failed")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send(writer, message):
+        writer.write(json.dumps(message).encode() + b"\n")
+        await writer.drain()
+
+    def _reply(self, op, message):
+        if op == "create":
+            self.hub.create(message["session_id"])
+            return {"ok": True}
+        if op == "exists":
+            return {"exists": self.hub.exists(message["session_id"])}
+        if op == "publish":
+            self.hub.publish(message["session_id"], message["data"])
+            return {"ok": True}
+        if op == "submit":
+            return self._submit(message["session_id"], message["user_query"], message.get("validate", False), message.get("background", False))
+        if op == "load":
+            return {"load": self._leased + len(self._jobs)}
+        if op == "done":
+            self._record_duration(message["duration"])
+            return {"ok": True}
+        return {"error": f"unknown op {op}"}
+
+    def _record_duration(self, duration):
+        self._average_duration = duration if self._average_duration is None else 0.8 * self._average_duration + 0.2 * duration
+
+    def _hand_to_taker(self, job):
+        """
+        Gives a job to a waiting pipeline thread, if there is one.
+        """
+        while self._takers:
+            taker = self._takers.popleft()
+            if not taker.done():
+                taker.set_result(job)
+                return True
+        return False
+
+    def _submit(self, session_id, user_query, validate=False, background=False):
+        job = {"session_id": session_id, "user_query": user_query, "validate": validate, "background": background, "attempts": 0}
+        if any(not taker.done() for taker in self._takers):
+            self.hub.create(session_id)
+            self._hand_to_taker(job)
+            return {"position": 0}
+        queue = self._background if background else self._jobs
+        if len(queue) >= self.max_queued:
+            retry_after = max(1, math.ceil((self._average_duration or 30) / max(1, len(self._takers))))
+            return {"error": "queue_full", "retry_after": retry_after}
+        self.hub.create(session_id)
+        if background:
+            self._background.append(job)
+            return {"position": 0}
+        self._jobs.append(job)
+        position = len(self._jobs)
+        self.hub.publish(session_id, queue_position_message(position))
+        return {"position": position}
+
+    async def _take(self, reader, writer):
+        if self._jobs:
+            job = self._jobs.popleft()
+            self._publish_positions()
+        elif self._background:
+            job = self._background.popleft()
+        else:
+            job = await self._wait_for_job(reader)
+        background = job.get("background", False)
+        # The job is leased to this connection until the pipeline thread reports it done
+        self._leased += not background
+        try:
+            await self._send(writer, {"job": job})
+            line = await reader.readline()
+            if line:
+                # Only a job the pipeline thread confirmed it started counts as an attempt, not one handed to a
+                # connection that was already dead
+                job["attempts"] = job.get("attempts", 0) + 1
+                line = await reader.readline()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            line = b""
+        finally:
+            self._leased -= not background
+        if not line:
+            self._requeue(job)
+            raise ConnectionError("Pipeline thread disconnected before finishing its job")
+        message = json.loads(line)
+        if message.get("op") == "done":
+            self._record_duration(message["duration"])
+        await self._send(writer, {"ok": True})
+
+    async def _wait_for_job(self, reader):
+        """
+        Waits as an idle taker until a job is handed over, watching the connection so a pipeline thread that
+        disconnects while idle stops counting as a taker.
+        """
+        taker = asyncio.get_running_loop().create_future()
+        self._takers.append(taker)
+        # An idle pipeline thread sends nothing, so this read only completes when the connection closes
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            await asyncio.wait({taker, closed}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not taker.done():
+                taker.cancel()
+            if taker in self._takers:
+                self._takers.remove(taker)
+            if not closed.done():
+                closed.cancel()
+                # The reader takes one waiter at a time, so the read must be gone before the job's readline
+                await asyncio.gather(closed, return_exceptions=True)
+        if not closed.cancelled():
+            if taker.done() and not taker.cancelled():
+                # Handed over just as the connection closed: it never reached the pipeline thread
+                self._requeue(taker.result())
+            raise ConnectionError("Idle pipeline thread disconnected")
+        return taker.result()
+
+    def _requeue(self, job):
+        session_id = job["session_id"]
+        if job["attempts"] >= BROKER_MAX_ATTEMPTS:
+            logging.error("Giving up on job %s after %s lost attempts", session_id, job["attempts"])
+            self.hub.publish(session_id, error_update())
+            return
+        BROKER_REQUEUED.inc()
+        logging.warning("Pipeline thread of job %s disconnected, requeueing it", session_id)
+        if self._hand_to_taker(job):
+            return
+        if job.get("background"):
+            self._background.appendleft(job)
+        else:
+            self._jobs.appendleft(job)
+            self._publish_positions()
+
+    def _publish_positions(self):
+        for position, waiting in enumerate(self._jobs, start=1):
+            self.hub.publish(waiting["session_id"], queue_position_message(position))
+
+    async def _subscribe(self, writer, session_id, last_event_id):
+        if not self.hub.exists(session_id):
+            await self._send(writer, {"end": True})
+            return
+        async for event in self.hub.subscribe(session_id, last_event_id):
+            await self._send(writer, {"event": event})
+        await self._send(writer, {"end": True})
+
+
+class TCPBroker(Broker):
+    """
+    Client of a BrokerServer. Runs `workers` pipeline threads that take jobs from the shared queue.
+
+    Parameters:
+    - host (str): Broker server host.
+    - port (int): Broker server port.
+    - workers (int): Pipeline threads in this process.
+    """
+
+    def __init__(self, host, port, workers=4):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self._local = threading.local()
+        self._threads = []
+
+    def _connect(self):
+        connection = socket.create_connection((self.host, self.port))
+        return connection, connection.makefile("rb")
+
+    def _request(self, message):
+        """
+        Sends one request on this thread's connection and returns the reply, reconnecting once if the connection was lost.
+        """
+        for attempt in (1, 2):
+            if getattr(self._local, "connection", None) is None:
+                self._local.connection, self._local.reader = self._connect()
+            try:
+                self._local.connection.sendall(json.dumps(message).encode() + b"\n")
+                line = self._local.reader.readline()
+                if not line:
+                    raise ConnectionError("Broker closed the connection")
+                return json.loads(line)
+            except OSError:
+                self._local.connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    BROKER_ERRORS.inc(op=message["op"])
+                    raise
+
+    def start(self, handler):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(handler,), name=f"pipeline-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self, handler):
+        while True:
+            try:
+                connection, reader = self._connect()
+            except OSError as e:
+                BROKER_ERRORS.inc(op="take")
+                logging.warning("Could not connect to the broker: %s", e)
+                time.sleep(1)
+                continue
+            with connection:
+                try:
+                    # Lets the broker notice a dead worker host while the job runs
+                    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    connection.sendall(b'{"op": "take"}\n')
+                    line = reader.readline()
+                    if not line:
+                        raise ConnectionError("Broker closed the connection")
+                except OSError as e:
+                    BROKER_ERRORS.inc(op="take")
+                    logging.warning("Could not take a job from the broker: %s", e)
+                    time.sleep(1)
+                    continue
+                job = json.loads(line)["job"]
+                try:
+                    connection.sendall(b'{"op": "started"}\n')
+                except OSError as e:
+                    BROKER_ERRORS.inc(op="take")
+                    logging.warning("Could not confirm job %s to the broker: %s", job["session_id"], e)
+                    continue
+                start = time.time()
+                try:
+                    handler(job["user_query"], job["session_id"], job.get("validate", False))
+                except Exception:
+                    JOB_FAILED.inc()
+                    logging.exception("Pipeline %s failed", job["session_id"])
+                    self.publish(job["session_id"], error_update())
+                duration = time.time() - start
+                JOB_DURATION.observe(duration)
+                try:
+                    # Ends the lease; until then the broker would hand the job to another thread if this connection dropped
+                    connection.sendall(json.dumps({"op": "done", "duration": duration}).encode() + b"\n")
+                    reader.readline()
+                except OSError:
+                    BROKER_ERRORS.inc(op="done")
+
+    async def submit(self, session_id, user_query, validate=False, background=False):
+        reply = await asyncio.to_thread(self._request, {"op": "submit", "session_id": session_id, "user_query": user_query,
+                                                         "validate": validate, "background": background})
+        if reply.get("error") == "queue_full":
+            raise QueueFullError(reply["retry_after"])
+        return reply["position"]
+
+    def load(self):
+        return self._request({"op": "load"})["load"]
+
+    def publish(self, session_id, data):
+        try:
+            self._request({"op": "publish", "session_id": session_id, "data": data})
+        except OSError as e:
+            logging.warning("Could not publish update for session %s: %s", session_id, e)
+
+    async def exists(self, session_id):
+        reply = await asyncio.to_thread(self._request, {"op": "exists", "session_id": session_id})
+        return reply["exists"]
+
+    async def subscribe(self, session_id, last_event_id=0):
+        reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_LINE)
+        try:
+            writer.write(json.dumps({"op": "subscribe", "session_id": session_id, "last_event_id": last_event_id}).encode() + b"\n")
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get("end"):
+                    break
+                yield message["event"]
+        finally:
+            writer.close()
+
+
+def start_local_server(host="127.0.0.1", port=0, max_queued=20):
+    """
+    Starts a broker server with its own session hub on a background thread, for local runs and tests.
+
+    Parameters:
+    - host (str): Interface to listen on.
+    - port (int): Port to listen on, 0 for any free port.
+    - max_queued (int): Jobs allowed to wait when no pipeline thread is idle.
+
+    Returns:
+    - address (tuple): (host, port) the server is listening on.
+    """
+    started = threading.Event()
+    address = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        server = BrokerServer(SessionHub(), max_queued=max_queued)
+        tcp_server = loop.run_until_complete(server.start(host, port))
+        address.extend(tcp_server.sockets[0].getsockname()[:2])
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="broker-server", daemon=True).start()
+    started.wait()
+    return tuple(address)
+
+
+_broker = None
+
+
+def get_broker():
+    """
+    Returns the process-wide broker selected by BROKER_BACKEND.
+    """
+    global _broker
+    if _broker is None:
+        backend = os.getenv('BROKER_BACKEND', 'inprocess')
+        if backend == 'inprocess':
+            _broker = InProcessBroker()
+        elif backend == 'tcp':
+            _broker = TCPBroker(os.getenv('BROKER_HOST', '127.0.0.1'), int(os.getenv('BROKER_PORT', 8765)),
+                                workers=int(os.getenv('PIPELINE_WORKERS', 4)))
+        else:
+            raise ValueError(f"Unknown BROKER_BACKEND: {backend}")
+    return _broker
+
+
+async def serve(host, port, max_queued):
+    server = await BrokerServer(hub, max_queued=max_queued).start(host, port)
+    logging.info("Broker listening on %s:%s", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="DietNerd session and job broker server.")
+    parser.add_argument("--host", default=os.getenv('BROKER_HOST', '127.0.0.1'))
+    parser.add_argument("--port", type=int, default=int(os.getenv('BROKER_PORT', 8765)))
+    parser.add_argument("--max-queued", type=int, default=int(os.getenv('PIPELINE_MAX_QUEUED', 20)))
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.max_queued))
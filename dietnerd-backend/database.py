@@ -0,0 +1,128 @@
+"""
+Shared MySQL connection pool used by every read and write path.
+
+The pool is created once at startup (or on first use) from the credentials in the env file, instead of opening a new
+connection and re-reading the env file on every request. Connections are health checked when they are checked out,
+and the time spent waiting for a free connection is exported as a metric.
+
+Configuration (env):
+- DB_POOL_SIZE: number of pooled connections (default 10, max 32).
+- DB_POOL_TIMEOUT: seconds to wait for a free connection before raising PoolTimeoutError (default 30).
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+from dotenv import load_dotenv
+
+import metrics
+
+DB_POOL_WAIT = metrics.histogram("dietnerd_db_pool_wait_seconds", "Time spent waiting for a pooled MySQL connection.")
+DB_POOL_TIMEOUTS = metrics.counter("dietnerd_db_pool_timeouts_total", "Checkouts that timed out waiting for a pooled MySQL connection.")
+DB_POOL_RECONNECTS = metrics.counter("dietnerd_db_pool_reconnects_total", "Pooled MySQL connections that failed their health check and were reconnected.")
+DB_POOL_SIZE = metrics.gauge("dietnerd_db_pool_size", "Configured size of the MySQL connection pool.")
+DB_POOL_IN_USE = metrics.gauge("dietnerd_db_pool_in_use", "MySQL connections currently checked out of the pool.")
+
+
+class PoolTimeoutError(PoolError):
+    """
+    Raised when no pooled connection becomes free within DB_POOL_TIMEOUT seconds.
+    """
+
+
+class ConnectionPool:
+    """
+    Blocking wrapper around mysql.connector's MySQLConnectionPool.
+
+    MySQLConnectionPool raises immediately when it is exhausted, so checkouts are gated by a semaphore of the same size
+    and callers wait (up to `timeout` seconds) for a connection to be returned instead.
+
+    Parameters:
+    - size (int): Number of pooled connections.
+    - timeout (float): Seconds to wait for a free connection.
+    - connect_args (dict): Keyword arguments for mysql.connector.connect (host, port, user, password, database).
+    """
+
+    def __init__(self, size, timeout, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._pool = pooling.MySQLConnectionPool(pool_name="dietnerd", pool_size=size, pool_reset_session=True, **connect_args)
+        DB_POOL_SIZE.set(size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks a healthy connection out of the pool and returns it to the pool on exit.
+        Uncommitted work is rolled back when the block raises.
+        """
+        start = time.time()
+        if not self._slots.acquire(timeout=self.timeout):
+            DB_POOL_TIMEOUTS.inc()
+            raise PoolTimeoutError(f"No MySQL connection available after {self.timeout}s")
+        DB_POOL_WAIT.observe(time.time() - start)
+        DB_POOL_IN_USE.inc()
+        connection = None
+        try:
+            connection = self._pool.get_connection()
+            if not connection.is_connected():
+                DB_POOL_RECONNECTS.inc()
+                connection.reconnect(attempts=3, delay=1)
+            try:
+                yield connection
+            except Exception:
+                connection.rollback()
+                raise
+        finally:
+            if connection is not None:
+                # Returns the connection to the pool
+                connection.close()
+            DB_POOL_IN_USE.dec()
+            self._slots.release()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(credentials=None):
+    """
+    Creates the shared connection pool if it does not exist yet.
+
+    Parameters:
+    - credentials (str): Name of env file with host, port, user, password, database. Only read when the pool is created.
+
+    Returns:
+    - pool (ConnectionPool): The shared connection pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if credentials:
+                load_dotenv(credentials)
+            _pool = ConnectionPool(
+                size=int(os.getenv('DB_POOL_SIZE', 10)),
+                timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+                host=os.getenv('host'),
+                port=os.getenv('port'),
+                user=os.getenv('user'),
+                password=os.getenv('password'),
+                database=os.getenv('database'))
+        return _pool
+
+
+def get_connection(credentials=None):
+    """
+    Checks a connection out of the shared pool, creating the pool on first use.
+    Use as a context manager:
+
+        with get_connection() as connection:
+            cursor = connection.cursor()
+
+    Parameters:
+    - credentials (str): Name of env file, only read if the pool has not been created yet.
+    """
+    return init_pool(credentials).connection()
@@ -0,0 +1,178 @@
+"""
+Ranks relevant articles by strength of evidence before article processing, and bounds how many get processed.
+
+Every relevant article that is not in article_analysis yet used to be processed, up to ~50 per question, although the
+synthesis prompt only asks the model to prioritize the strongest evidence. Articles are now scored on:
+- tier: the strongest of their publication types (meta-analyses and RCTs over cohort studies over case reports and
+  editorials), from TIER_WEIGHTS;
+- recency: 1 for this year, falling to 0 over RECENCY_YEARS;
+- full text: whether a PMC copy exists, so the summary can use more than the abstract;
+- relevance: share of the question's terms found in the title (counting double) and abstract.
+The weighted sum orders the articles; only the first EVIDENCE_TOP_K are processed, in that order, and processing
+stops early once EVIDENCE_ENOUGH high-tier articles (tier >= EVIDENCE_HIGH_TIER) are available, counting the ones
+already matched in article_analysis. Tasks that have not started then are cancelled.
+
+Configuration (env):
+- EVIDENCE_TOP_K: most articles processed per question (default 25, 0 for no limit).
+- EVIDENCE_ENOUGH: high-tier articles after which processing stops early (default 12, 0 to never stop early).
+- EVIDENCE_HIGH_TIER: tier from which an article counts as high-tier evidence (default 0.85).
+- EVIDENCE_TIER_WEIGHTS: JSON object overriding the tier of single publication types, e.g. {"Review": 0.6}.
+- EVIDENCE_SCORE_WEIGHTS: JSON object overriding the weights of tier, recency, full_text and relevance.
+"""
+import datetime
+import json
+import os
+import re
+import threading
+
+import metrics
+
+TIER_WEIGHTS = {
+    "Meta-Analysis": 1.0,
+    "Systematic Review": 0.95,
+    "Randomized Controlled Trial": 0.9,
+    "Pragmatic Clinical Trial": 0.85,
+    "Equivalence Trial": 0.85,
+    "Controlled Clinical Trial": 0.8,
+    "Clinical Trial, Phase III": 0.8,
+    "Clinical Trial, Phase IV": 0.8,
+    "Multicenter Study": 0.75,
+    "Clinical Trial, Phase II": 0.7,
+    "Clinical Trial": 0.7,
+    "Adaptive Clinical Trial": 0.7,
+    "Observational Study": 0.6,
+    "Twin Study": 0.6,
+    "Comparative Study": 0.55,
+    "Validation Study": 0.5,
+    "Evaluation Study": 0.5,
+    "Review": 0.5,
+    "Clinical Trial, Phase I": 0.45,
+    "Journal Article": 0.4,
+    "Clinical Trial Protocol": 0.3,
+    "Preprint": 0.3,
+    "Case Reports": 0.2,
+    "Comment": 0.1,
+    "Editorial": 0.1,
+    "Letter": 0.1,
+    "Published Erratum": 0.05,
+}
+TIER_WEIGHTS.update(json.loads(os.getenv('EVIDENCE_TIER_WEIGHTS', '{}')))
+DEFAULT_TIER = 0.4
+SCORE_WEIGHTS = {"tier": 0.55, "recency": 0.15, "full_text": 0.1, "relevance": 0.2}
+SCORE_WEIGHTS.update(json.loads(os.getenv('EVIDENCE_SCORE_WEIGHTS', '{}')))
+RECENCY_YEARS = 20
+
+EVIDENCE_TOP_K = int(os.getenv('EVIDENCE_TOP_K', 25))
+EVIDENCE_ENOUGH = int(os.getenv('EVIDENCE_ENOUGH', 12))
+EVIDENCE_HIGH_TIER = float(os.getenv('EVIDENCE_HIGH_TIER', 0.85))
+
+STOPWORDS = set("a an and are as at be by can do does for from has have how i if in is it my of on or should the to "
+                "what when which who why will with".split())
+
+EVIDENCE_SELECTED = metrics.histogram("dietnerd_evidence_selected_articles", "Articles selected for processing per question.",
+                                      buckets=(0, 5, 10, 15, 20, 25, 30, 40, 50, 75, 100))
+EVIDENCE_EARLY_EXITS = metrics.counter("dietnerd_evidence_early_exits_total", "Questions whose article processing stopped early with enough high-tier evidence.")
+
+
+def terms(text):
+    return {word for word in re.findall(r"[a-z0-9]+", (text or "").lower()) if word not in STOPWORDS and len(word) > 1}
+
+
+def tier(publication_types):
+    """
+    Returns the tier of the strongest of an article's publication types.
+    """
+    return max((TIER_WEIGHTS.get(kind, DEFAULT_TIER) for kind in publication_types or ()), default=DEFAULT_TIER)
+
+
+def is_high_tier(publication_types):
+    return tier(publication_types) >= EVIDENCE_HIGH_TIER
+
+
+def score_article(article, question_terms, year=None):
+    """
+    Scores one article's strength of evidence for a question.
+
+    Parameters:
+    - article (PubMedArticle): The article.
+    - question_terms (set): Terms of the user's question, from terms().
+    - year (int): The current year.
+
+    Returns:
+    - score (float): Weighted sum of tier, recency, full-text availability and relevance, between 0 and 1.
+    """
+    year = year or datetime.date.today().year
+    try:
+        recency = max(0.0, 1 - (year - int(article.pub_year)) / RECENCY_YEARS)
+    except (TypeError, ValueError):
+        recency = 0.5
+    if question_terms:
+        title, abstract = terms(article.title), terms(article.abstract)
+        relevance = min(1.0, (2 * len(question_terms & title) + len(question_terms & abstract)) / (2 * len(question_terms)))
+    else:
+        relevance = 0.0
+    return (SCORE_WEIGHTS["tier"] * tier(article.publication_types)
+            + SCORE_WEIGHTS["recency"] * recency
+            + SCORE_WEIGHTS["full_text"] * (1.0 if article.pmcid else 0.0)
+            + SCORE_WEIGHTS["relevance"] * relevance)
+
+
+def select_articles(articles, user_query, top_k=None):
+    """
+    Orders articles by score and keeps the first top_k.
+
+    Parameters:
+    - articles (list): PubMedArticle records to process.
+    - user_query (str): The user's question.
+    - top_k (int): Articles to keep, or 0 for all. Defaults to EVIDENCE_TOP_K.
+
+    Returns:
+    - selected (list): Articles to process, strongest first.
+    - skipped (list): Articles ranked out.
+    """
+    top_k = EVIDENCE_TOP_K if top_k is None else top_k
+    question_terms = terms(user_query)
+    year = datetime.date.today().year
+    ranked = sorted(articles, key=lambda article: score_article(article, question_terms, year), reverse=True)
+    selected, skipped = (ranked[:top_k], ranked[top_k:]) if top_k else (ranked, [])
+    EVIDENCE_SELECTED.observe(len(selected))
+    return selected, skipped
+
+
+class EvidenceBudget:
+    """
+    Counts high-tier articles as their summaries come in, to stop article processing once there are enough.
+
+    Parameters:
+    - high_tier (int): High-tier articles already available, e.g. matched in article_analysis.
+    - enough (int): High-tier articles to stop at, or 0 to never stop. Defaults to EVIDENCE_ENOUGH.
+
+    concurrent_article_processing adds the articles it cancelled to `cancelled`.
+    """
+
+    def __init__(self, high_tier=0, enough=None):
+        self.high_tier = high_tier
+        self.enough = EVIDENCE_ENOUGH if enough is None else enough
+        self.exited = False
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def add(self, summary):
+        """
+        Counts one processed article.
+
+        Parameters:
+        - summary (dict): The article JSON from process_article, or None.
+
+        Returns:
+        - stop (bool): True for the article that completes enough high-tier evidence, so the caller cancels the rest
+          once; False before and after it.
+        """
+        with self._lock:
+            if summary and is_high_tier(summary.get("publication_type")):
+                self.high_tier += 1
+            if self.enough and self.high_tier >= self.enough and not self.exited:
+                self.exited = True
+                EVIDENCE_EARLY_EXITS.inc()
+                return True
+            return False
@@ -0,0 +1,173 @@
+"""
+Shared worker pools that divide article-level work fairly between the sessions submitting it.
+
+concurrent_relevance_classification and concurrent_article_processing used to start their own 8-thread pools per
+question, so a broad question with 50 articles kept its threads (and the LLM capacity behind them) busy while a
+question with 8 articles ran alongside it at the same 8-wide pace, and both slowed down with every question added.
+Their tasks now go to two process-wide pools, one per kind of work. Each pool keeps one FIFO queue per session and
+picks the next task by deficit round-robin: every pass over the sessions with queued work adds `quantum x weight` to
+a session's deficit, and the session's tasks run while their cost fits in it. With unit costs and equal weights this
+is plain round-robin, so a question's article tasks finish in time proportional to its own work rather than to the
+work queued ahead of it.
+
+    pool = get_pool("relevance")
+    futures = [pool.submit(session_id, relevance_classifier, article, user_query) for article in articles]
+
+Configuration (env):
+- FAIR_RELEVANCE_WORKERS: threads of the relevance classification pool (default 32).
+- FAIR_ARTICLE_WORKERS: threads of the article processing pool (default 32).
+- FAIR_QUANTUM: cost added to a session's deficit per round (default 1).
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+import pipeline_metrics
+
+FAIR_QUEUED = metrics.gauge("dietnerd_fair_queued_tasks", "Tasks waiting in a fair-share pool.", ("pool",))
+FAIR_SESSIONS = metrics.gauge("dietnerd_fair_active_sessions", "Sessions with tasks waiting in a fair-share pool.", ("pool",))
+FAIR_TASK_WAIT = metrics.histogram("dietnerd_fair_task_wait_seconds", "Time a task waited in a fair-share pool.", ("pool",))
+
+
+class Flow:
+    """
+    Queued tasks and deficit of one session.
+    """
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.deficit = 0.0
+        self.tasks = deque()
+
+
+class FairExecutor:
+    """
+    Thread pool serving per-session queues by deficit round-robin.
+
+    Parameters:
+    - name (str): Pool name, used for thread names and metric labels.
+    - workers (int): Worker threads.
+    - quantum (float): Cost added to a session's deficit per round.
+    """
+
+    def __init__(self, name, workers=32, quantum=1.0):
+        self.name = name
+        self.workers = workers
+        self.quantum = quantum
+        self._flows = {}
+        # Sessions with queued tasks, in round-robin order; the session being served is first
+        self._active = deque()
+        self._queued = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        FAIR_QUEUED.set_function(lambda: self._queued, pool=name)
+        FAIR_SESSIONS.set_function(lambda: len(self._active), pool=name)
+
+    def start(self):
+        with self._condition:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, session, function, *args, cost=1.0, weight=1.0, **kwargs):
+        """
+        Queues a task of a session.
+
+        Parameters:
+        - session (str): The session the task belongs to, e.g. its session id.
+        - function (function): The task.
+        - cost (float): Relative cost of the task, charged against the session's deficit.
+        - weight (float): Share of the session relative to others, taken from its first queued task.
+        - *args, **kwargs: Arguments for the function.
+
+        Returns:
+        - future (Future): Resolves to the function's result.
+        """
+        self.start()
+        future = Future()
+        with self._condition:
+            flow = self._flows.get(session)
+            if flow is None:
+                flow = self._flows[session] = Flow(weight)
+                self._active.append(session)
+                if len(self._active) == 1:
+                    self._start_round()
+            flow.tasks.append((future, function, args, kwargs, cost, time.perf_counter()))
+            self._queued += 1
+            self._condition.notify()
+        return future
+
+    def _next(self):
+        """
+        Picks the next task by deficit round-robin. Called with the condition held and at least one task queued.
+        """
+        while True:
+            session = self._active[0]
+            flow = self._flows[session]
+            cost = flow.tasks[0][4]
+            if flow.deficit >= cost:
+                flow.deficit -= cost
+                task = flow.tasks.popleft()
+                if not flow.tasks:
+                    # An idle session does not keep its unused deficit
+                    del self._flows[session]
+                    self._active.popleft()
+                    if self._active:
+                        self._start_round()
+                return task
+            # The session has used its share of this round: move it to the back
+            self._active.rotate(-1)
+            self._start_round()
+
+    def _start_round(self):
+        # The session at the front gets its quantum when its turn starts
+        flow = self._flows[self._active[0]]
+        flow.deficit += self.quantum * flow.weight
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queued:
+                    self._condition.wait()
+                future, function, args, kwargs, cost, queued_at = self._next()
+                self._queued -= 1
+            FAIR_TASK_WAIT.observe(time.perf_counter() - queued_at, pool=self.name)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+def current_session():
+    """
+    Returns the session of the running question, for work submitted from its pipeline thread.
+    """
+    record = pipeline_metrics.current()
+    if record is not None and record.session_id:
+        return record.session_id
+    return f"thread-{threading.get_ident()}"
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+POOL_WORKERS = {"relevance": "FAIR_RELEVANCE_WORKERS", "article": "FAIR_ARTICLE_WORKERS"}
+
+
+def get_pool(name):
+    """
+    Returns the process-wide pool for one kind of article work ("relevance" or "article"), creating it on first use.
+    """
+    with _pools_lock:
+        if name not in _pools:
+            workers = int(os.getenv(POOL_WORKERS[name], 32))
+            _pools[name] = FairExecutor(name, workers=workers, quantum=float(os.getenv('FAIR_QUANTUM', 1)))
+            logging.info("Started fair-share pool %s with %d workers", name, workers)
+        return _pools[name]
@@ -19,6 +19,14 @@ from openai import OpenAI
 import ast
 import mysql.connector
 from mysql.connector import Error
+from storage import get_storage
+import metrics
+import pipeline_metrics
+import llm_gateway
+import fair_scheduler
+import summary_routing
+import pubmed_cache
+import pubmed_mirror
 from scipy import spatial # for calculating vector similarities for search
 import json
 import itertools
@@ -29,6 +37,7 @@ from Bio import Entrez
 from Bio.Entrez import efetch, esearch
 from metapub import PubMedFetcher
 import re
+import random
 import requests
 from bs4 import BeautifulSoup
 
@@ -36,6 +45,8 @@ from bs4 import BeautifulSoup
 # Summarizer
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import string
+import threading
+from cachetools import TTLCache
 from tenacity import retry # Exponential Backoff
 # wait_random_exponential stop_after_attempt
 
@@ -54,7 +65,34 @@ import textwrap
 # If No Similar Questions:
 """
 
-client = OpenAI()
+# Retries go through the LLM gateway, which pauses every call of a rate-limited model rather than one request
+client = OpenAI(max_retries=0)
+
+#@title create_chat_completion
+def create_chat_completion(call, **kwargs):
+  """
+  Calls the chat completions API through the process-wide LLM gateway (see llm_gateway.py), which applies the
+  per-model concurrency and rate limits, call priorities and retries, and records the call's latency, token usage
+  and estimated cost (see pipeline_metrics.py).
+
+  Parameters:
+  - call (str): Name of the pipeline call, e.g. "relevance" or "synthesis", used for its priority and as a metric label.
+  - kwargs: Arguments of client.chat.completions.create.
+
+  Returns:
+  - response (ChatCompletion): The API response.
+  """
+  try:
+    return llm_gateway.get_gateway().complete(call, client.chat.completions.create, **kwargs)
+  except Exception:
+    pipeline_metrics.LLM_ERRORS.inc(call=call, model=kwargs.get("model"))
+    raise
+
+# Section 1 (query generation) results by normalized question
+query_generation_cache = TTLCache(maxsize=int(os.getenv('QUERY_GENERATION_CACHE_SIZE', 1000)), ttl=float(os.getenv('QUERY_GENERATION_CACHE_TTL', 24 * 3600)))
+query_generation_cache_lock = threading.Lock()
+QUERY_GENERATION_SECONDS = metrics.histogram("dietnerd_query_generation_seconds", "Latency of each query generation LLM call.", ("call",))
+QUERY_GENERATION_CACHE = metrics.counter("dietnerd_query_generation_cache_total", "Query generation cache lookups.", ("result",))
 
 """# Step1. Evaluate Question Validity
 We do not answer questions related to meal-planning or recipe creation.
@@ -76,7 +114,7 @@ def determine_question_validity(query):
   Returns:
   - question_validity (str): A string indicating whether the question is valid or not. Possible responses can only either be "True", "False - Recipe", or "False - Animal".
   """
-  valid_question_response = client.chat.completions.create(
+  valid_question_response = create_chat_completion("validity",
     model="gpt-4-turbo",
     messages=[
       {
@@ -124,24 +162,31 @@ def determine_question_validity(query):
 ## Step2. Query Generation
 """
 
-#@title query_generation
-def query_generation(query):
+#@title query_cache_key
+def query_cache_key(query):
   """
-  Generates a total of 5 PubMed queries that are aggregated together into a list:
-  - 1 query built directly from the user's question that is meant to retrieve articles that provide general context
-  - 4 queries to represent the top points of contention around the topic and retrieve articles that may provide more clarity
+  Normalizes a question for the query generation cache, so questions that only differ in case, punctuation or spacing share an entry.
 
   Parameters:
   - query (str): The user's question.
 
   Returns:
-  - general_query (str): The broad query that will retrieve articles related to a specific topic.
-  - query_contention (str): A list of 4 queries to represent the top points of contention around the topic.
-  - query_list (list): A list of all 5 queries generated.
+  - key (str): The normalized question.
   """
+  return " ".join(query.lower().translate(str.maketrans(string.punctuation, " " * len(string.punctuation))).split())
 
-  #### GENERAL QUERY
-  general_query_response = client.chat.completions.create(
+#@title generate_general_query
+def generate_general_query(query):
+  """
+  Generates 1 broad PubMed query built directly from the user's question.
+
+  Parameters:
+  - query (str): The user's question.
+
+  Returns:
+  - general_query (str): The broad query that will retrieve articles related to a specific topic.
+  """
+  general_query_response = create_chat_completion("general_query",
     model="gpt-4-turbo",
     messages=[
       {
@@ -170,10 +215,20 @@ def query_generation(query):
   )
 
   general_query = general_query_response.choices[0].message.content
+  return general_query
 
+#@title generate_points_of_contention
+def generate_points_of_contention(query):
+  """
+  Generates up to 4 points of contention around the user's question, each with a PubMed query.
 
-  #### POINTS OF CONTENTION QUERIES
-  poc_response = client.chat.completions.create(
+  Parameters:
+  - query (str): The user's question.
+
+  Returns:
+  - query_contention (str): The points of contention, each with a title, summary and query.
+  """
+  poc_response = create_chat_completion("points_of_contention",
     model="gpt-4-turbo",
     messages=[
       {
@@ -228,6 +283,48 @@ def query_generation(query):
   )
 
   query_contention = poc_response.choices[0].message.content
+  return query_contention
+
+#@title query_generation
+def query_generation(query):
+  """
+  Generates a total of 5 PubMed queries that are aggregated together into a list:
+  - 1 query built directly from the user's question that is meant to retrieve articles that provide general context
+  - 4 queries to represent the top points of contention around the topic and retrieve articles that may provide more clarity
+  The two LLM calls run concurrently, and the result is cached by normalized question (QUERY_GENERATION_CACHE_SIZE entries for QUERY_GENERATION_CACHE_TTL seconds),
+  so reruns and near-identical questions skip this step.
+
+  Parameters:
+  - query (str): The user's question.
+
+  Returns:
+  - general_query (str): The broad query that will retrieve articles related to a specific topic.
+  - query_contention (str): A list of 4 queries to represent the top points of contention around the topic.
+  - query_list (list): A list of all 5 queries generated.
+  """
+  key = query_cache_key(query)
+  with query_generation_cache_lock:
+    cached = query_generation_cache.get(key)
+  if cached is not None:
+    QUERY_GENERATION_CACHE.inc(result="hit")
+    print("Section 1: query generation cache hit")
+    general_query, query_contention, query_list = cached
+    return general_query, query_contention, list(query_list)
+  QUERY_GENERATION_CACHE.inc(result="miss")
+
+  def timed(function):
+    start = time.time()
+    result = function(query)
+    return result, time.time() - start
+
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    general_future = executor.submit(pipeline_metrics.in_context(timed), generate_general_query)
+    poc_future = executor.submit(pipeline_metrics.in_context(timed), generate_points_of_contention)
+    general_query, general_duration = general_future.result()
+    query_contention, poc_duration = poc_future.result()
+  QUERY_GENERATION_SECONDS.observe(general_duration, call="general_query")
+  QUERY_GENERATION_SECONDS.observe(poc_duration, call="points_of_contention")
+  print(f"Section 1: general query {general_duration:.2f}s, points of contention {poc_duration:.2f}s (run concurrently)")
 
   #### AGGREGATE ALL 5 QUERIES
   pattern = r"Query: (.*)"
@@ -237,6 +334,8 @@ def query_generation(query):
       query_list.append(match)
 
   query_list.append(general_query)
+  with query_generation_cache_lock:
+    query_generation_cache[key] = (general_query, query_contention, tuple(query_list))
   return general_query, query_contention, query_list
 
 """## Step3. Information Retrieval"""
@@ -256,6 +355,86 @@ def exponential_backoff(func, *args, **kwargs):
                 wait *= 2 ** i + (random.uniform(0, 1) * 0.1) 
         return None
 
+#@title search_pubmed
+def search_pubmed(query, stats=None):
+  """
+  Retrieves the PMIDs of up to 10 of the most relevant PubMed articles for a query. Depending on PUBMED_SOURCE, the query is answered by the local
+  PubMed mirror (see pubmed_mirror.py), by E-utilities through the esearch cache, or by E-utilities when the mirror finds nothing.
+
+  Parameters:
+  - query (str): A PubMed query.
+  - stats (NCBIRequestStats): Request counters of the current question.
+
+  Returns:
+  - pmids (list): A list of PMIDs, most relevant first.
+  """
+  mirror = pubmed_mirror.get_mirror()
+  if mirror is not None:
+    with pipeline_metrics.step("mirror_search"):
+      pmids = mirror.search(query)
+    if pmids or not pubmed_mirror.live_fallback():
+      return pmids
+
+  pmids = pubmed_cache.get_search(query, stats)
+  if pmids is not None:
+    return pmids
+
+  Entrez.email = os.getenv('ENTREZ_EMAIL')
+  with pipeline_metrics.step("esearch"):
+    search_results = exponential_backoff(Entrez.esearch, db="pubmed", term=query, retmax=10, sort="relevance")
+    pmids = [str(pmid) for pmid in Entrez.read(search_results)["IdList"]]
+  pubmed_cache.NCBI_REQUESTS.inc(kind="esearch")
+  if stats is not None:
+    stats.esearch += 1
+  pubmed_cache.put_search(query, pmids)
+  return pmids
+
+#@title fetch_pubmed_articles
+def fetch_pubmed_articles(pmids, stats=None):
+  """
+  Fetches PubMed articles by PMID. Records held by the local PubMed mirror are used first when PUBMED_SOURCE is not live. Otherwise records younger than
+  PUBMED_RECORD_TTL come from the pubmed_record table, and only the others are fetched from NCBI, in one efetch request per 200 PMIDs.
+
+  Parameters:
+  - pmids (list): PMIDs to fetch.
+  - stats (NCBIRequestStats): Request counters of the current question.
+
+  Returns:
+  - articles (dict): PMID mapped to its PubMedArticle record. PMIDs that NCBI did not return are left out.
+  """
+  records = {}
+  mirror = pubmed_mirror.get_mirror()
+  if mirror is not None:
+    with pipeline_metrics.step("mirror_records"):
+      records = mirror.records(pmids)
+    if not pubmed_mirror.live_fallback():
+      return pubmed_cache.parse_records(records)
+
+  storage = get_storage(env)
+  missing = [pmid for pmid in pmids if pmid not in records]
+  with pipeline_metrics.step("db_read_pubmed_records"):
+    cached = pubmed_cache.load_records(storage, missing)
+  records.update(cached)
+  missing = [pmid for pmid in missing if pmid not in records]
+  if stats is not None:
+    stats.records_cached += len(cached)
+
+  Entrez.email = os.getenv('ENTREZ_EMAIL')
+  for i in range(0, len(missing), 200):
+    with pipeline_metrics.step("efetch"):
+      articles = exponential_backoff(Entrez.efetch, db="pubmed", id=missing[i:i + 200], rettype="xml")
+      fetched = pubmed_cache.split_articles(articles.read())
+    pubmed_cache.NCBI_REQUESTS.inc(kind="efetch")
+    if stats is not None:
+      stats.efetch += 1
+    with pipeline_metrics.step("db_write_pubmed_records"):
+      pubmed_cache.save_records(storage, fetched)
+    records.update(fetched)
+    if stats is not None:
+      stats.records_fetched += len(fetched)
+
+  return pubmed_cache.parse_records(records)
+
 #@title article_retrieval
 def article_retrieval(query):
   """
@@ -266,50 +445,39 @@ def article_retrieval(query):
   - query (str): The user's question.
 
   Returns:
-  - article_data (list): A list of PubMed articles.
+  - article_data (list): A list of PubMedArticle records.
   """
-  Entrez.email = os.getenv('ENTREZ_EMAIL')
-
-  search_results = exponential_backoff(Entrez.esearch, db="pubmed", term=query, retmax=10, sort="relevance")
-  # search_results = esearch(db="pubmed", term=query, retmax=10, sort="relevance")
-  retrieved_ids = Entrez.read(search_results)["IdList"]
-
-  if not retrieved_ids:
-      return []
-
-  articles = exponential_backoff(Entrez.efetch, db="pubmed", id=retrieved_ids, rettype="xml")
-  # articles = efetch(db="pubmed", id=retrieved_ids, rettype="xml")
-  article_data = Entrez.read(articles)["PubmedArticle"]
-  return article_data
+  pmids = search_pubmed(query)
+  articles_by_pmid = fetch_pubmed_articles(pmids)
+  return [articles_by_pmid[pmid] for pmid in pmids if pmid in articles_by_pmid]
 
 
 #@title collect_articles
 def collect_articles(query_list):
   """
-  Runs through each of the PubMed queries and aggregates the articles into a single list of lists, where each list element contains up to 10 of the most relevant articles per query.
-  This nested list is then flattened and de-duplicated by PMID.
+  Runs through each of the PubMed queries and aggregates up to 10 of the most relevant articles per query into a single list, de-duplicated by PMID.
+  Search results and article records are cached (see pubmed_cache.py), so only PMIDs that have not been fetched before are requested from NCBI,
+  and the NCBI requests made for the question are reported.
 
   Parameters:
   - query_list (list): List of up to 5 PubMed queries as outputted by the query_generation function.
 
   Returns:
-  - deduplicated_articles_collected (list): A list of up to 50 dictionaries, where each dictionary represents an article and it's fetched information.
+  - deduplicated_articles_collected (list): A list of up to 50 PubMedArticle records.
   """
-  # list of lists, each list element contains the group of articles pulled per query
-  articles_collected = []
+  stats = pubmed_cache.NCBIRequestStats()
+  pmids = []
   seen_pmids = set()
 
   for query in query_list:
-      article_group = article_retrieval(query)
-      if not article_group:
-          continue
-
-      for article in article_group:
-          pmid = article['MedlineCitation']['PMID']
+      for pmid in search_pubmed(query, stats):
           if pmid not in seen_pmids:
-              articles_collected.append(article)
+              pmids.append(pmid)
               seen_pmids.add(pmid)
 
+  articles_by_pmid = fetch_pubmed_articles(pmids, stats)
+  articles_collected = [articles_by_pmid[pmid] for pmid in pmids if pmid in articles_by_pmid]
+  stats.report()
   return articles_collected
 #@title relevance_classifier
 #@title relevance_classifier
@@ -322,29 +490,20 @@ def relevance_classifier(article, user_query):
   - it is NOT an animal-based study
 
   Parameters:
-  - article (dict): A dictionary containing the fetched PubMed article data.
+  - article (PubMedArticle): The fetched PubMed article.
 
   Returns:
   - pmid (str): PubMed ID of the article.
   - article_is_relevant (str): Whether the article is relevant or not. Returns only "yes" or "no".
-  - article (dict): The input article dictionary.
+  - article (PubMedArticle): The input article.
   """
-  abstract = article["MedlineCitation"]["Article"]["Abstract"]["AbstractText"]
-  pmid = str(article["MedlineCitation"]["PMID"])
-
-  ### Clean-Up Abstract ###
-  reconstructed_abstract = ""
-  for element in abstract:
-      label = element.attributes.get("Label", "")
-      if reconstructed_abstract:
-        reconstructed_abstract += "\n\n"
-      if label:
-        reconstructed_abstract += f"{label}:\n"
-      reconstructed_abstract += str(element)
-
+  pmid = article.pmid
+  reconstructed_abstract = article.abstract
+  if not reconstructed_abstract:
+    raise ValueError(f"Article {pmid} has no abstract")
 
   ### Pointwise-Relevance of Article to Query ###
-  relevance_response = client.chat.completions.create(
+  relevance_response = create_chat_completion("relevance",
       model="gpt-3.5-turbo-0125",
       messages=[
         {
@@ -377,27 +536,29 @@ def concurrent_relevance_classification(articles, user_query):
   Concurrent classification of articles as relevant or irrelevant using the relevance_classifier function.
 
   Parameters:
-  - articles (list): A list of article dictionaries to classify.
+  - articles (list): A list of PubMedArticle records to classify.
 
   Returns:
-  - relevant_articles (list): A list of dictionaries of relevant articles.
-  - irrelevant_articles (list): A list of dictionaries of irrelevant articles.
+  - relevant_articles (list): A list of relevant PubMedArticle records.
+  - irrelevant_articles (list): A list of irrelevant PubMedArticle records.
   """
   relevant_articles = []
   irrelevant_articles = []
 
-  with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(relevance_classifier, article_tmp, user_query) for article_tmp in articles]
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                # Bucket articles as relevant vs irrelevant
-                if result[1]:
-                    relevant_articles.append(result[2])
-                else:
-                    irrelevant_articles.append(result[2])
-            except Exception as e:
-                print("Error processing article:", e)
+  # Shared with every other session's classification, which gets an equal share of the pool (see fair_scheduler.py)
+  pool = fair_scheduler.get_pool("relevance")
+  session = fair_scheduler.current_session()
+  futures = [pool.submit(session, pipeline_metrics.in_context(relevance_classifier), article_tmp, user_query) for article_tmp in articles]
+  for future in as_completed(futures):
+      try:
+          result = future.result()
+          # Bucket articles as relevant vs irrelevant
+          if result[1]:
+              relevant_articles.append(result[2])
+          else:
+              irrelevant_articles.append(result[2])
+      except Exception as e:
+          print("Error processing article:", e)
 
   return relevant_articles, irrelevant_articles
 """## Step4. Research Processing
@@ -428,41 +589,24 @@ def string_to_dict(string):
       return {}
 
 #@title connect_to_reliability_analysis_db
-def connect_to_reliability_analysis_db():
+@pipeline_metrics.timed("db_read_articles")
+def connect_to_reliability_analysis_db(pmids=None):
   """
-  Connects to our MySQL database and returns a DataFrame of the reliability analysis table.
+  Connects to our database and returns a DataFrame of the reliability analysis table.
   Note that you will need to input MySQL credentials before running this function.
 
+  Parameters:
+  - pmids (list): Only load the rows of these PMIDs. If None, the whole table is loaded.
+
   Returns:
   - reliability_analysis_df (DataFrame): DataFrame of the reliability analysis table.
   """
-  mydb = mysql.connector.connect(
-    host=os.getenv('host'),
-    port=os.getenv('port'),
-    user=os.getenv('user'),
-    password=os.getenv('password'),
-    database=os.getenv('database')
-  )
+  # output: list of article dictionaries
+  myresult = get_storage(env).get_articles(pmids)
 
-  mycursor = mydb.cursor()
-
-  sql = f"SELECT * FROM article_analysis"
-
-  mycursor.execute(sql)
-
-  # output: list of tuples
-  myresult = mycursor.fetchall()
-
-  reliability_analysis_mysql = pd.DataFrame(myresult, columns=['article_id', 'article_json'])
-
-  # Apply the function to each row in the "Summary" column to convert from string to dictionary
-  reliability_analysis_mysql['article_json'] = reliability_analysis_mysql['article_json'].apply(json.loads)
-
-  # Normalize the column of dictionaries to a DataFrame
-  articles_df = pd.json_normalize(reliability_analysis_mysql['article_json'])
-
-  # Concatenate the new DataFrame with the original one, excluding the original "Summary" column
-  reliability_analysis_df = pd.concat([reliability_analysis_mysql.drop(columns=['article_json']), articles_df], axis=1)
+  # Normalize the list of dictionaries to a DataFrame, keyed by article_id
+  articles_df = pd.json_normalize(myresult) if myresult else pd.DataFrame(columns=['PMID'])
+  reliability_analysis_df = pd.concat([articles_df['PMID'].rename('article_id'), articles_df], axis=1)
   return reliability_analysis_df
 
 """#### Article Matching
@@ -488,7 +632,7 @@ def article_matching(articles_collected, reliability_analysis_df):
 
   # seen_article_ids = {}
   for article_data in articles_collected:
-    article_id = str(article_data['MedlineCitation']['PMID'])
+    article_id = article_data.pmid
     #if reliability_analysis_df['PMID'].isin([article_id]).any():
     if reliability_analysis_df['article_id'].isin([str(article_id)]).any():
       ### bring in matched article JSON that includes reliability analysis as a dictionary
@@ -517,32 +661,24 @@ def generate_ama_citation(article):
   - doi
 
   Parameters:
-  - article (dict): A dictionary containing the fetched PubMed article data.
+  - article (PubMedArticle): The fetched PubMed article.
 
   Returns:
   - ama_citation (str): The generated AMA citation.
   """
-  try:
-    authors = article["MedlineCitation"]["Article"]["AuthorList"]
-    author_names = ", ".join([f"{author['LastName']} {author['Initials']}" for author in authors])
-  except KeyError:
+  # Collective authors have no last name and initials, so the author list is left out
+  if all(last_name and initials for last_name, initials in article.authors):
+    author_names = ", ".join([f"{last_name} {initials}" for last_name, initials in article.authors])
+  else:
     author_names = ""
 
-  try:
-    title = article["MedlineCitation"]["Article"]["ArticleTitle"]
-  except KeyError:
-    title = ""
-
-  try:
-    journal = article["MedlineCitation"]["Article"]["Journal"]["Title"]
-  except KeyError:
-    journal = ""
+  title = article.title
+  journal = article.journal
 
   # Published Date
-  captured_pub_date = article.get('MedlineCitation', {}).get('Article', {}).get('Journal', {}).get('JournalIssue', {}).get('PubDate', {})
-  pub_year = captured_pub_date.get('Year', None)
-  pub_month = captured_pub_date.get('Month', None)
-  pub_day = captured_pub_date.get('Day', None)
+  pub_year = article.pub_year
+  pub_month = article.pub_month
+  pub_day = article.pub_day
   if (pub_month != None and pub_month != "None") and (pub_day != None and pub_day != "None"):
     pub_date = f"{pub_month} {pub_day}, {pub_year}"
   elif (pub_month != None and pub_month != "None") and (pub_day == None or pub_day == "None"):
@@ -552,37 +688,10 @@ def generate_ama_citation(article):
   else:
     pub_date = ""
 
-  try:
-    volume = article["MedlineCitation"]["Article"]["Journal"]["JournalIssue"]["Volume"]
-  except KeyError:
-    volume = ""
-
-  try:
-    issue = article["MedlineCitation"]["Article"]["Journal"]["JournalIssue"]["Issue"]
-  except KeyError:
-    issue = ""
-
-  try:
-    pages = article["MedlineCitation"]["Article"]["Pagination"]["MedlinePgn"]
-  except KeyError:
-    pages = ""
-
-  try:
-    article_ids = article.get('PubmedData', {}).get('ArticleIdList', [])
-    elocation_ids = article["MedlineCitation"]["Article"]["ELocationID"]
-    if article_ids != [] and article_ids != None:
-      article_ids = article.get('PubmedData', {}).get('ArticleIdList', [])
-      for article_id in article_ids:
-        if article_id.attributes.get('IdType') == "doi":
-          doi = article_id
-    elif (article_ids == [] or article_ids == None) and elocation_ids != []:
-      for elocation in elocation_ids:
-        if elocation.attributes.get('EIdType') == 'doi':
-          doi = elocation
-    else:
-      doi = ""
-  except KeyError:
-    doi = ""
+  volume = article.volume
+  issue = article.issue
+  pages = article.pages
+  doi = article.doi or ""
 
   if title.endswith('.'):
     ama_citation = f"{author_names}. {title} {journal}. {pub_date};{volume}({issue}):{pages}. {doi}"
@@ -792,7 +901,7 @@ def section_match(list_of_strings, required_titles):
       ### Identify the most important columns
       list_of_strings_str = ', '.join(list_of_strings)
 
-      relevant_sections_response = client.chat.completions.create(
+      relevant_sections_response = create_chat_completion("relevant_sections",
           model="gpt-3.5-turbo-0125",
           messages=[
             {
@@ -861,6 +970,7 @@ def relevant_sections_capture(article_text):
   return true_sections_to_pull
 
 
+@pipeline_metrics.timed("full_text_pmc")
 def get_full_text_pubmed(article_json):
   """
   Captures all text and tables from an article's full text, then cleans it up to only show the most relevant and helpful sections.
@@ -918,6 +1028,7 @@ def rank_links_by_preference(links_dict, preferred_sources):
     return None
 
 #@title get_preferred_link
+@pipeline_metrics.timed("full_text_links")
 def get_preferred_link(url):
   """
   Grabs the link of the full-text source based on ranked preference.
@@ -955,6 +1066,7 @@ def extract_pii(url):
       # Return None if no PII is found in the URL
       return None
 
+@pipeline_metrics.timed("full_text_elsevier")
 def get_full_text_elsevier(pii):
   """
   Fetches the full text of an article from Elsevier's API given a PII.
@@ -1002,6 +1114,7 @@ def extract_doi_springer(url):
     return doi
 
 
+@pipeline_metrics.timed("full_text_springer")
 def get_full_text_springer(url):
     """
     Fetches the full text PDF of a Springer article.
@@ -1050,6 +1163,7 @@ def get_full_text_springer(url):
         return {"error": "Failed to fetch full text", "status_code": response.status_code}
 
 #@title Full Article Text - JAMA
+@pipeline_metrics.timed("full_text_jama")
 def get_full_text_jama(url):
     """
     Fetches and parses all text from the provided URL of a JAMA article, including paragraphs and headers.
@@ -1103,6 +1217,7 @@ def extract_doi_wiley(url):
         return ""  # Return empty string if 'doi/' is not in the URL
 
 
+@pipeline_metrics.timed("full_text_wiley")
 def get_full_text_wiley(url):
     """
     Fetches the full text of an article from Wiley's API given a DOI.
@@ -1163,52 +1278,31 @@ def process_article(article):
   This is the helper function for ThreadPoolExecutor.
 
   Parameters:
-  - article (dict): A dictionary containing the article data.
+  - article (PubMedArticle): The fetched PubMed article.
 
   Returns:
   - article_json (dict): A dictionary containing the article information.
   """
 
   try:
-    ### Retrieve the abstract ###
-    abstract = article["MedlineCitation"]["Article"]["Abstract"]["AbstractText"]
-
-
-    ### Clean-Up Abstract ###
-    reconstructed_abstract = ""
-    for element in abstract:
-        label = element.attributes.get("Label", "")
-        if reconstructed_abstract:
-          reconstructed_abstract += "\n\n"
-        if label:
-          reconstructed_abstract += f"{label}:\n"
-        reconstructed_abstract += str(element)
+    if not article.abstract:
+      print("No abstract provided")
+      return None
 
     ### Citation ###
     citation = generate_ama_citation(article)
 
 
     ### Article JSON ###
-    title = article["MedlineCitation"]["Article"]["ArticleTitle"]
-    url = (f"https://pubmed.ncbi.nlm.nih.gov/"
-              f"{article['MedlineCitation']['PMID']}/")
-
-    types_html = article['MedlineCitation']['Article']['PublicationTypeList']
-    publication_types = []
-    for pub_type in types_html:
-      publication_types.append(str(pub_type))
-
-    pmc_id = next((element for element in article['PubmedData']['ArticleIdList'] if element.attributes.get('IdType') == 'pmc'), None)
-
     article_json =  {
-                      "title": title,
-                      "publication_type": publication_types,
-                      "url": url,
-                      "abstract": reconstructed_abstract,
+                      "title": article.title,
+                      "publication_type": list(article.publication_types),
+                      "url": article.url,
+                      "abstract": article.abstract,
                       "is_relevant": True,
                       "citation": citation,
-                      "PMID": str(article['MedlineCitation']['PMID']),
-                      "PMCID": str(pmc_id)
+                      "PMID": article.pmid,
+                      "PMCID": str(article.pmcid)
                     }
 
     preferred_link = get_preferred_link(article_json['url'])
@@ -1237,18 +1331,21 @@ def process_article(article):
         article_json["full_text"] = True
       except:
         article_content = article_json['abstract']
+        article_json["full_text"] = False
     elif preferred_link and "jamanetwork" in preferred_link:
       try:
         article_content = clean_extracted_text(str(get_full_text_jama(preferred_link)))
         article_json["full_text"] = True
       except:
         article_content = article_json['abstract']
+        article_json["full_text"] = False
     elif preferred_link and "wiley" in preferred_link:
       try:
         article_content = clean_extracted_text(str(get_full_text_wiley(preferred_link)))
         article_json["full_text"] = True
       except:
         article_content = article_json['abstract']
+        article_json["full_text"] = False
     else:
       article_content = article_json['abstract']
       article_json["full_text"] = False
@@ -1317,8 +1414,10 @@ def process_article(article):
             13. Sources of Funding or Conflict of Interest (Identify any sources of funding and possible conflicts of interest.):
             """
 
-    reliability_analysis_response = client.chat.completions.create(
-        model="gpt-4-turbo",
+    review = article_type.isdisjoint(study_types)
+    summary_model = summary_routing.choose_summary_model(article_json["full_text"], article_content, review)
+    reliability_analysis_response = create_chat_completion("reliability_analysis",
+        model=summary_model,
         messages = [
             {
                 "role": "system",
@@ -1336,6 +1435,8 @@ def process_article(article):
     # Extract the generated summary
     answer_summary = reliability_analysis_response.choices[0].message.content
     article_json["summary"] = answer_summary
+    article_json["summary_model"] = summary_model
+    summary_routing.capture_summary(article_json["PMID"], article_json["full_text"], review, system_prompt_summarize, article_content, summary_model, answer_summary)
 
     return article_json
   except KeyError:
@@ -1348,7 +1449,7 @@ def process_article_with_retry(article):
   Include a retry decorator and buffer for the article processing function.
 
   Parameters:
-  - article (dict): A dictionary containing the article data.
+  - article (PubMedArticle): The fetched PubMed article.
 
   Returns:
   - article_json (dict): A dictionary containing the article information.
@@ -1362,28 +1463,41 @@ def process_article_with_retry(article):
       return process_article(article)
 
 
-def concurrent_article_processing(articles_to_process):
+def concurrent_article_processing(articles_to_process, budget=None):
   """
-  Concurrent article processing using ThreadPoolExecutor.
+  Concurrent article processing on the shared article pool, which gives every session an equal share of its
+  workers (see fair_scheduler.py).
 
   Parameters:
-  - articles_to_process (list): A list of articles to process.
+  - articles_to_process (list): A list of PubMedArticle records to process, in the order they should start.
+  - budget (EvidenceBudget): Stops processing once it has counted enough high-tier evidence (see evidence_ranking.py).
+    Articles that have not started by then are cancelled.
 
   Returns:
   - relevant_article_summaries (list): A list of relevant article summaries.
   """
   relevant_article_summaries = []
 
-  with ThreadPoolExecutor(max_workers=8) as executor:
-      futures = [executor.submit(process_article_with_retry, article) for article in articles_to_process]
-      for future in as_completed(futures):
-          try:
-              result = future.result()
-              relevant_article_summaries.append(result)
-              print(result)
-              print('-----------------------------------------------------------')
-          except Exception as e:
-              print("Error processing article:", e)
+  pool = fair_scheduler.get_pool("article")
+  session = fair_scheduler.current_session()
+  futures = [pool.submit(session, pipeline_metrics.in_context(process_article_with_retry), article) for article in articles_to_process]
+  for future in as_completed(futures):
+      if future.cancelled():
+          continue
+      try:
+          result = future.result()
+          relevant_article_summaries.append(result)
+          print(result)
+          print('-----------------------------------------------------------')
+      except Exception as e:
+          print("Error processing article:", e)
+          continue
+      if budget is not None and budget.add(result):
+          # cancel() is True again for a future that is already cancelled
+          cancelled = sum(not other.cancelled() and other.cancel() for other in futures)
+          budget.cancelled += cancelled
+          if cancelled:
+              print(f"Enough high-tier evidence: skipping {cancelled} articles")
   return relevant_article_summaries
 
 """#### Write Articles to DB"""
@@ -1413,57 +1527,38 @@ def dict_to_tuple(data):
             'citation': article_json['citation'],
             'article_type': article_json['publication_type']  # Renaming 'publication_type' to 'article_type'
       }
+      if article_json.get('summary_model'):
+        new_dict['summary_model'] = article_json['summary_model']
 
       # Appending the tuple (PMID, new_dict) to the transformed data list
-      transformed_data.append((pmid, json.dumps(new_dict)))
+      transformed_data.append((pmid, new_dict))
   return transformed_data
 
 #@title upload_articles_to_db
-def upload_articles_to_db(credentials, table_name, data):
+def upload_articles_to_db(credentials, table_name, data, raise_errors=False):
   """
   Upserts article analyses to our reliability analysis MySQL table.
   Note that you will need to input MySQL credentials before running this function.
 
   Parameters:
-    - credentials (str): Name of env file with host, port, user, password, database
-    - table_name (str): Name of the table to insert the new row into.
-    - data (str): Tuple with 2 elements (str, JSON file)
+    - credentials (str): Name of env file with host, port, user, password, database. Only read when the shared connection pool is created.
+    - table_name (str): Name of the table to insert the new row into. Must be the article table of the configured storage backend.
+    - data (list): Tuples with 2 elements (PMID, article dictionary), as built by dict_to_tuple
+    - raise_errors (bool): Re-raise database errors instead of printing them, so the caller can retry.
   """
-
-  # Load Credentials
-  load_dotenv(credentials)
-
   try:
-      connection = mysql.connector.connect(
-            host=os.getenv('host'),
-            port=os.getenv('port'),
-            user=os.getenv('user'),
-            password=os.getenv('password'),
-            database=os.getenv('database'))
-      if connection.is_connected():
-          print('Connected to MySQL database')
-
-
-          cursor = connection.cursor()
-          # Upsert
-          query = f"INSERT INTO {table_name} (article_id, article_json) VALUES (%s, %s) ON DUPLICATE KEY UPDATE article_id = VALUES(article_id)"
+      storage = get_storage(credentials)
+      if table_name != storage.article_table:
+        raise ValueError(f"Storage backend writes articles to {storage.article_table}, not {table_name}")
+      # Upsert
+      prepared_data = [(item[0], item[1]) for item in data]
+      storage.upsert_articles(prepared_data)
+      print(f"Row inserted into {table_name}")
 
-          prepared_data = [(item[0], item[1]) for item in data]
-          cursor.executemany(query, prepared_data)
-
-          # Committing the transaction
-          connection.commit()
-          print(f"Row inserted into {table_name}")
-
-  except Error as e:
+  except Exception as e:
       print(f"Error: {e}")
-
-  finally:
-      # Step 6: Close the Connection
-      if connection.is_connected():
-          cursor.close()
-          connection.close()
-          print('MySQL connection is closed')
+      if raise_errors:
+        raise
 
 #@title write_articles_to_db
 def write_articles_to_db(relevant_article_summaries, env_file):
@@ -1585,7 +1680,7 @@ def generate_final_response(all_relevant_articles, query):
       User Question: {query}
   """
 
-  output_response = client.chat.completions.create(
+  output_response = create_chat_completion("synthesis",
     model="gpt-4-turbo",
     messages = [
       {
@@ -1605,6 +1700,173 @@ def generate_final_response(all_relevant_articles, query):
   final_output = output + "\n" + disclaimer
   return final_output
 
+"""### Final Synthesis - Evidence ID Citations
+Instead of having the model retype every AMA citation, each article is given an evidence ID and the model only cites `[n]`.
+The reference list and `citations_obj` are then rendered locally from the citations produced by `generate_ama_citation`.
+* `SYNTHESIS_CITATION_MODE=pmid` (default) uses evidence ID citations.
+* `SYNTHESIS_CITATION_MODE=full` keeps the original behaviour where the model writes out the reference list.
+"""
+
+SYNTHESIS_CITATION_MODE = os.getenv('SYNTHESIS_CITATION_MODE', 'pmid')
+
+#@title build_evidence_list
+def build_evidence_list(all_relevant_articles):
+  """
+  Assigns an evidence ID to each relevant article, de-duplicated by PMID.
+
+  Parameters:
+  - all_relevant_articles (list): List of all relevant article summaries.
+
+  Returns:
+  - evidence (dict): A dictionary with evidence IDs (int) as keys and article dictionaries as values.
+  """
+  evidence = {}
+  seen_pmids = set()
+  for article in all_relevant_articles:
+    if not article:
+      continue
+    pmid = str(article.get('PMID') or article.get('article_id'))
+    if pmid in seen_pmids:
+      continue
+    seen_pmids.add(pmid)
+    evidence[len(evidence) + 1] = article
+  return evidence
+
+#@title format_evidence
+def format_evidence(evidence):
+  """
+  Formats the evidence list for the synthesis prompt.
+  Only the evidence ID, title, publication type and summary are sent; the citation text stays local.
+
+  Parameters:
+  - evidence (dict): Evidence IDs mapped to article dictionaries, as returned by build_evidence_list.
+
+  Returns:
+  - evidence_str (str): The evidence list as prompt text.
+  """
+  blocks = []
+  for evidence_id, article in evidence.items():
+    title = article.get('title') or article.get('citation') or ''
+    publication_type = article.get('publication_type') or article.get('article_type') or ''
+    if isinstance(publication_type, list):
+      publication_type = ', '.join(publication_type)
+    blocks.append(f"[{evidence_id}] Title: {title}\n"
+                  f"Publication Type: {publication_type}\n"
+                  f"Summary: {article.get('summary')}")
+  return "\n\n".join(blocks)
+
+#@title render_cited_response
+def render_cited_response(output, evidence):
+  """
+  Renumbers the evidence IDs cited in the model output by order of first appearance, then renders
+  the reference list and the citations object from the stored article citations.
+
+  Parameters:
+  - output (str): The model output, citing evidence IDs in brackets (e.g. [3], [3][12], [3, 12] or [3-5]).
+  - evidence (dict): Evidence IDs mapped to article dictionaries, as returned by build_evidence_list.
+
+  Returns:
+  - final_output (str): Final response with the reference list and disclaimer appended.
+  - citations (list): List of rendered citations, e.g. "[1] <AMA_citation>".
+  - citations_obj (dict): Dictionary of citations with the matched article's PMID, PMCID, URL and summary.
+  """
+  renumbered = {}
+
+  def expand(group):
+    evidence_ids = []
+    for part in re.split(r'\s*,\s*', group):
+      bounds = re.split(r'\s*[-–]\s*', part)
+      if len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit():
+        evidence_ids.extend(range(int(bounds[0]), int(bounds[1]) + 1))
+      elif part.isdigit():
+        evidence_ids.append(int(part))
+    return evidence_ids
+
+  def replace(match):
+    numbers = []
+    for evidence_id in expand(match.group(1)):
+      if evidence_id not in evidence:
+        continue
+      if evidence_id not in renumbered:
+        renumbered[evidence_id] = len(renumbered) + 1
+      if renumbered[evidence_id] not in numbers:
+        numbers.append(renumbered[evidence_id])
+    return ''.join(f"[{number}]" for number in numbers)
+
+  # Drop any reference list the model wrote anyway
+  main_output = re.split(r'\n\s*\#*\s*\**References?\**:?\s*\n', output)[0]
+  main_output = re.sub(r'\[(\d+(?:\s*[,\-–]\s*\d+)*)\]', replace, main_output).strip()
+
+  citations = []
+  citations_obj = {}
+  for evidence_id, number in renumbered.items():
+    article = evidence[evidence_id]
+    citation = f"[{number}] {article.get('citation')}"
+    citations.append(citation)
+    citations_obj[citation] = {
+        "PMID": article.get("PMID"),
+        "PMCID": article.get("PMCID"),
+        "URL": article.get("url"),
+        "Summary": article.get("summary")
+    }
+
+  final_output = main_output + "\n\nReferences:\n" + "\n".join(citations) + "\n" + "\n" + disclaimer
+  return final_output, citations, citations_obj
+
+#@title generate_final_response_structured
+def generate_final_response_structured(all_relevant_articles, query):
+  """
+  Generate the final response with the model citing evidence IDs only.
+  The reference list is rendered locally with render_cited_response, so the model never retypes citations.
+
+  Parameters:
+  - all_relevant_articles (list): List of all relevant article summaries.
+  - query (str): User question.
+
+  Returns:
+  - final_output (str): Final response to the user question.
+  - citations (list): List of rendered citations.
+  - citations_obj (dict): Dictionary of citations with matched article information.
+  """
+  evidence = build_evidence_list(all_relevant_articles)
+
+  system_prompt_response = """
+      You are an expert in evaluating research articles and summarizing findings based on the strength of evidence. Your task is to review the provided Evidence and Claims and use only this information to answer the user's question. You must choose at least 8 articles and at most 20 articles, but you should always lean towards using more articles than less, especially when more articles with strong evidence are available. Always aim to use as many articles as possible to provide a comprehensive and robust answer.
+      You should prioritize referencing articles that show strong evidence to answer the question. Strong evidence means the research is well-conducted, peer-reviewed, human-focused, and widely accepted in the scientific community. Provide a direct, research-backed answer to the question and focus on identifying the pros and cons of the topic in question. The answer should highlight when there are potential risks or dangers present.
+      If the user question is dangeorus, harmful, or malicious, absolutely do not offer advice or strategies and absolutely do not address the pros, benefits, or potential results/outcomes. You must only focus on deterring this behavior, addressing the risks, and offering safe alternatives. The answer should also try to include as many different demographics as possible. Absolutely NO animal studies should be referenced or included in the final response. Mention dosage amounts when the information is available. Medical terms and technical concepts must be explained to a layman audience. Be sure to emphasize that you should always go and see a registered dietitian or a registered dietitian nutritionist.
+      Each article in Evidence and Claims starts with its evidence ID in brackets, e.g. [12]. Cite articles in-line using only their evidence ID in brackets, e.g. [12] or [3][12]. Include section titles like "Conclusion" and organize sections as a bulleted list using an asterisk.
+      Do NOT write a reference list, citations, author names, or journal names. The reference list is generated automatically from the evidence IDs you cite.
+
+      The output must follow this format:
+      <summary_of_evidence>
+      """
+
+  human_prompt_response = f"""
+      Evidence and Claims:
+      {format_evidence(evidence)}
+
+      User Question: {query}
+  """
+
+  output_response = create_chat_completion("synthesis",
+    model="gpt-4-turbo",
+    messages = [
+      {
+          "role": "system",
+          "content": system_prompt_response
+      },
+      {
+          "role": "user",
+          "content": human_prompt_response
+      }
+  ],
+    temperature=0.5,
+    top_p=1
+  )
+
+  output = output_response.choices[0].message.content
+  return render_cited_response(output, evidence)
+
 """### Write Final Output to Database"""
 
 def split_end_output(end_output: str):
@@ -1678,37 +1940,28 @@ def upload_to_final(credentials, question, obj):
   Uploads the final output to the question-answer table in the MySQL database which holds the final outputs.
 
   Parameters:
-    - credentials (str): Name of env file with host, port, user, password, database
+    - credentials (str): Name of env file with host, port, user, password, database. Only read when the shared connection pool is created.
     - question (str): The question being answered.
     - obj (dict): The final output object.
   """
-  load_dotenv(credentials)
+  upload_answers_to_db(credentials, [(question, obj)])
+
+def upload_answers_to_db(credentials, data, raise_errors=False):
+  """
+  Uploads a batch of final outputs to the question-answer table in a single transaction.
 
+  Parameters:
+    - credentials (str): Name of env file with host, port, user, password, database. Only read when the shared connection pool is created.
+    - data (list): List of (question, final output object) tuples.
+    - raise_errors (bool): Re-raise database errors instead of printing them, so the caller can retry.
+  """
   try:
-      connection = mysql.connector.connect(
-          host=os.getenv('host'),
-          port=os.getenv('port'),
-          user=os.getenv('user'),
-          password=os.getenv('password'),
-          database=os.getenv('database'))
-      if connection.is_connected():
-          # Create a Cursor Object
-          cursor = connection.cursor()
-          json_string = json.dumps(obj)
-          # Upsert
-          query = f"INSERT INTO question_answer (question, answer) VALUES (%s, %s) ON DUPLICATE KEY UPDATE question = VALUES(question)"
-          # Executing the query
-          cursor.execute(query, (question, json_string))
-          # Committing the transaction
-          connection.commit()
-  except Error as e:
+      # Upsert
+      get_storage(credentials).upsert_answers(data)
+  except Exception as e:
       print(f"Error: {e}")
-  finally:
-      # Step 6: Close the Connection
-      if connection.is_connected():
-          cursor.close()
-          connection.close()
-          #print('MySQL connection is closed')
+      if raise_errors:
+        raise
 
 
 def normalize_citation(citation):
@@ -1758,25 +2011,48 @@ def match_citations_with_articles(citations, articles):
                 break  # Stop searching once a match is found
   return citation_dict
   
-def write_output_to_db(user_query, final_output, all_relevant_articles, total_runtime, env_file):
+def write_output_to_db(user_query, final_output, all_relevant_articles, total_runtime, env_file, citations=None, citations_obj=None):
   """
   Write the output to the question-answer table in the MySQL database.
 
   Parameters:
     - user_query (str): The user's query.
     - final_output (str): The final output.
+    - citations (list): Rendered citations, if already built by generate_final_response_structured. Otherwise parsed from final_output.
+    - citations_obj (dict): Citations matched with articles, if already built by generate_final_response_structured.
+  """
+  return_obj = build_output_record(final_output, all_relevant_articles, total_runtime, citations, citations_obj)
+  upload_to_final(env_file, user_query, return_obj)
+
+def build_output_record(final_output, all_relevant_articles, total_runtime, citations=None, citations_obj=None, screened_pmids=None):
+  """
+  Build the final output object stored in the question-answer table.
+
+  Parameters:
+    - final_output (str): The final output.
+    - all_relevant_articles (list): List of all relevant article summaries.
+    - total_runtime (float): Total pipeline runtime in seconds.
+    - citations (list): Rendered citations, if already built by generate_final_response_structured. Otherwise parsed from final_output.
+    - citations_obj (dict): Citations matched with articles, if already built by generate_final_response_structured.
+    - screened_pmids (list): PMIDs of the articles classified irrelevant or matched or processed, so refresh.py only classifies the others.
+
+  Returns:
+    - return_obj (dict): The final output object.
   """
   return_obj = {
         "end_output": final_output,
         "relevant_articles": all_relevant_articles,
-        "total_runtime": total_runtime
+        "total_runtime": total_runtime,
+        "answered_at": time.time()
       }
+  if screened_pmids is not None:
+    return_obj["screened_pmids"] = [str(pmid) for pmid in screened_pmids]
 
-
-  main_output, citations = split_end_output(return_obj["end_output"])
-
-  relevant_articles = return_obj.get("relevant_articles", [])
-  updated_citations = match_citations_with_articles(citations, all_relevant_articles)
+  if citations is None or citations_obj is None:
+    main_output, citations = split_end_output(return_obj["end_output"])
+    updated_citations = match_citations_with_articles(citations, all_relevant_articles)
+  else:
+    updated_citations = citations_obj
 
 
   return_obj["end_output"] = final_output
@@ -1786,4 +2062,4 @@ def write_output_to_db(user_query, final_output, all_relevant_articles, total_ru
   # with open("output.json", "w") as f:
   #     json.dump(return_obj, f, indent=4)
 
-  upload_to_final(env_file, user_query, return_obj)
+  return return_obj
@@ -0,0 +1,197 @@
+"""
+Admission control for question pipelines.
+
+`/process_query` used to start every pipeline immediately in a FastAPI background task, so a burst of questions ran
+all at once, each with its own thread pools, and every one of them slowed down together. The scheduler runs at most
+PIPELINE_WORKERS pipelines at a time and keeps up to PIPELINE_MAX_QUEUED more waiting in FIFO order. Waiting jobs are
+told their queue position whenever it changes. When the queue is full, `submit` raises QueueFullError with a
+Retry-After estimate based on recent pipeline durations, which the API returns as a 429. Background jobs (see
+warmer.py) wait in a queue of their own and only start when no user job is waiting.
+
+Configuration (env):
+- PIPELINE_WORKERS: pipelines run concurrently (default 4).
+- PIPELINE_MAX_QUEUED: pipelines waiting for a worker before new ones are rejected (default 20).
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+JOB_QUEUE_DEPTH = metrics.gauge("dietnerd_job_queue_depth", "Pipelines waiting for a worker.")
+JOB_RUNNING = metrics.gauge("dietnerd_job_running", "Pipelines currently running.")
+JOB_QUEUE_WAIT = metrics.histogram("dietnerd_job_queue_wait_seconds", "Time a pipeline waited for a worker.")
+JOB_DURATION = metrics.histogram("dietnerd_job_duration_seconds", "Run time of one pipeline, excluding queue wait.")
+JOB_REJECTED = metrics.counter("dietnerd_job_rejected_total", "Pipelines rejected because the queue was full.")
+JOB_FAILED = metrics.counter("dietnerd_job_failed_total", "Pipelines that raised an exception.")
+
+
+class QueueFullError(Exception):
+    """
+    Raised by JobScheduler.submit when no worker is free and the waiting queue is full.
+
+    Parameters:
+    - retry_after (int): Suggested seconds before the client tries again.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobScheduler:
+    """
+    Fixed pool of pipeline worker threads fed from a bounded FIFO queue, and a second one for background jobs.
+
+    Parameters:
+    - workers (int): Pipelines run concurrently.
+    - max_queued (int): Pipelines allowed to wait for a worker.
+    - on_position (function): Called as on_position(job_id, position) when a waiting job's 1-based position changes.
+    - on_error (function): Called as on_error(job_id, error) when a job raises, e.g. to end its session.
+    """
+
+    def __init__(self, workers=4, max_queued=20, on_position=None, on_error=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.on_position = on_position
+        self.on_error = on_error
+        self._waiting = OrderedDict()
+        self._background = OrderedDict()
+        self._running = 0
+        self._running_background = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        # Exponential moving average of pipeline run time, used for Retry-After
+        self._average_duration = None
+        JOB_QUEUE_DEPTH.set_function(lambda: len(self._waiting) + len(self._background))
+        JOB_RUNNING.set_function(lambda: self._running)
+
+    def start(self):
+        with self._condition:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"pipeline-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, job_id, function, *args, background=False):
+        """
+        Queues a job, or raises QueueFullError if the queue is full.
+
+        Parameters:
+        - job_id (str): Unique id of the job, e.g. the session id.
+        - function (function): The pipeline to run on a worker thread.
+        - *args: Arguments for the function.
+        - background (bool): Queue the job behind every user job. Background jobs have no queue position.
+
+        Returns:
+        - position (int): 0 if a worker is free and the job starts right away, otherwise its 1-based queue position.
+        """
+        self.start()
+        with self._condition:
+            if background:
+                if len(self._background) >= self.max_queued:
+                    JOB_REJECTED.inc()
+                    raise QueueFullError(self.retry_after())
+                self._background[job_id] = (function, args, time.time())
+                self._condition.notify()
+                return 0
+            # Jobs that idle workers have not picked up yet are not really waiting
+            free_workers = self.workers - self._running
+            if len(self._waiting) - free_workers >= self.max_queued:
+                JOB_REJECTED.inc()
+                raise QueueFullError(self.retry_after())
+            self._waiting[job_id] = (function, args, time.time())
+            position = max(0, len(self._waiting) - free_workers)
+            self._condition.notify()
+        return position
+
+    def position(self, job_id):
+        """
+        Returns the 1-based queue position of a waiting job, or 0 if it is not waiting.
+        """
+        with self._condition:
+            for position, waiting_id in enumerate(self._waiting, start=1):
+                if waiting_id == job_id:
+                    return position
+        return 0
+
+    def load(self):
+        """
+        Returns the number of user pipelines running or waiting for a worker. Background jobs are not counted.
+        """
+        with self._condition:
+            return self._running - self._running_background + len(self._waiting)
+
+    def retry_after(self):
+        """
+        Estimates the seconds until a queue slot frees up, from the average pipeline duration.
+        """
+        average = self._average_duration or 30
+        return max(1, math.ceil(average / self.workers))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._waiting and not self._background:
+                    self._condition.wait()
+                background = not self._waiting
+                job_id, (function, args, queued_at) = (self._background if background else self._waiting).popitem(last=False)
+                self._running += 1
+                self._running_background += background
+                positions = list(enumerate(self._waiting, start=1))
+            JOB_QUEUE_WAIT.observe(time.time() - queued_at)
+            self._notify_positions(positions)
+            start = time.time()
+            try:
+                function(*args)
+            except Exception as e:
+                JOB_FAILED.inc()
+                logging.exception("Pipeline %s failed", job_id)
+                if self.on_error is not None:
+                    try:
+                        self.on_error(job_id, e)
+                    except Exception as callback_error:
+                        logging.warning("Could not report the failure of %s: %s", job_id, callback_error)
+            finally:
+                duration = time.time() - start
+                JOB_DURATION.observe(duration)
+                with self._condition:
+                    self._running -= 1
+                    self._running_background -= background
+                    self._average_duration = duration if self._average_duration is None else 0.8 * self._average_duration + 0.2 * duration
+
+    def _notify_positions(self, positions):
+        if self.on_position is None:
+            return
+        for position, job_id in positions:
+            try:
+                self.on_position(job_id, position)
+            except Exception as e:
+                logging.warning("Could not report queue position of %s: %s", job_id, e)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(on_position=None, on_error=None):
+    """
+    Returns the process-wide scheduler, creating it on first use.
+
+    Parameters:
+    - on_position (function): Queue position callback, only used when the scheduler is created.
+    - on_error (function): Job failure callback, only used when the scheduler is created.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = JobScheduler(
+                workers=int(os.getenv('PIPELINE_WORKERS', 4)),
+                max_queued=int(os.getenv('PIPELINE_MAX_QUEUED', 20)),
+                on_position=on_position,
+                on_error=on_error)
+        return _scheduler
@@ -0,0 +1,296 @@
+"""
+Process-wide gateway in front of the chat completions API.
+
+Every question fans relevance classification and article processing out on its own 8-thread pools, so N questions
+in flight make up to 8xN simultaneous OpenAI calls. Past the account's rate limits those calls fail with 429s, and
+process_article_with_retry then sleeps 10 seconds per article. The gateway makes every call wait for a slot of its
+model first:
+
+- at most `in_flight` calls of a model run at once;
+- token and request buckets refill at `tpm` tokens and `rpm` requests per minute. A call takes its estimated tokens
+  (prompt characters / 4 plus max_tokens or COMPLETION_ESTIMATE) when it starts and is charged its real usage when
+  it returns;
+- a 429 pauses the whole model for its Retry-After (or an exponential backoff) and the call is retried, instead of
+  every thread retrying on its own. Connection errors and 5xx responses are retried the same way;
+- waiting calls start in priority order, so a user's final synthesis goes ahead of another user's bulk relevance
+  checks. A call gains one priority level per LLM_PRIORITY_AGING seconds of waiting, so bulk calls still progress.
+
+Queue wait is exported as dietnerd_llm_queue_wait_seconds and recorded as the "llm_queue" step of the current
+question (see pipeline_metrics.py).
+
+Configuration (env):
+- LLM_MAX_IN_FLIGHT: concurrent calls per model (default 32, the fan-out of PIPELINE_WORKERS=4 questions).
+- LLM_TPM: tokens per minute per model (default 300000, 0 for no limit).
+- LLM_RPM: requests per minute per model (default 3000, 0 for no limit).
+- LLM_LIMITS: JSON object overriding the limits of single models, e.g. {"gpt-4-turbo": {"in_flight": 8, "tpm": 150000}}.
+- LLM_MAX_RETRIES: retries of a rate-limited or failed call (default 4).
+- LLM_PRIORITY_AGING: seconds of waiting that raise a call by one priority level (default 30).
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import openai
+
+import metrics
+import pipeline_metrics
+
+# Lower runs first. Calls a user is waiting on right now outrank the per-article fan-outs.
+CALL_PRIORITIES = {
+    "validity": 0,
+    "synthesis": 0,
+    "general_query": 1,
+    "points_of_contention": 1,
+    "relevant_sections": 2,
+    "reliability_analysis": 2,
+    "relevance": 3,
+}
+DEFAULT_PRIORITY = 2
+COMPLETION_ESTIMATE = 500
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+LLM_QUEUE_WAIT = metrics.histogram("dietnerd_llm_queue_wait_seconds", "Time an LLM call waited for the gateway, by call and model.", ("call", "model"))
+LLM_QUEUED = metrics.gauge("dietnerd_llm_queued", "LLM calls waiting for the gateway.", ("model",))
+LLM_IN_FLIGHT = metrics.gauge("dietnerd_llm_in_flight", "LLM calls running.", ("model",))
+LLM_RATE_LIMITED = metrics.counter("dietnerd_llm_rate_limited_total", "429 responses from the LLM API.", ("model",))
+LLM_RETRIES = metrics.counter("dietnerd_llm_retries_total", "LLM calls retried by the gateway, by error.", ("model", "error"))
+
+
+def estimate_tokens(kwargs):
+    """
+    Estimates the tokens of a chat completion request before it is sent.
+
+    Parameters:
+    - kwargs (dict): Arguments of client.chat.completions.create.
+
+    Returns:
+    - tokens (int): Estimated prompt plus completion tokens.
+    """
+    characters = sum(len(message.get("content") or "") for message in kwargs.get("messages", []))
+    return characters // 4 + (kwargs.get("max_tokens") or COMPLETION_ESTIMATE)
+
+
+def retry_after(error):
+    """
+    Returns the seconds the API asked to wait before retrying, or None.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class ModelLimiter:
+    """
+    Slots of one model: in-flight limit, token and request buckets, and the queue of waiting calls.
+
+    Parameters:
+    - model (str): The model.
+    - in_flight (int): Concurrent calls.
+    - tpm (int): Tokens per minute, or 0 for no limit.
+    - rpm (int): Requests per minute, or 0 for no limit.
+    - aging (float): Seconds of waiting that raise a call by one priority level.
+    """
+
+    def __init__(self, model, in_flight=32, tpm=300000, rpm=3000, aging=30):
+        self.model = model
+        self.in_flight = in_flight
+        self.tpm = tpm
+        self.rpm = rpm
+        self.aging = aging
+        self.tokens = float(tpm)
+        self.requests = float(rpm)
+        self.running = 0
+        self.paused_until = 0.0
+        self._refilled = time.monotonic()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        LLM_QUEUED.set_function(lambda: len(self._waiting), model=model)
+        LLM_IN_FLIGHT.set_function(lambda: self.running, model=model)
+
+    def _refill(self, now):
+        elapsed = now - self._refilled
+        self._refilled = now
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+
+    def _delay(self, tokens, now):
+        """
+        Returns 0 if a call of `tokens` can start now, otherwise the seconds until it might.
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.running >= self.in_flight:
+            # Woken up by release()
+            return None
+        # A call larger than the whole bucket waits for a full bucket instead of forever
+        needed = min(tokens, self.tpm)
+        if self.tpm and self.tokens < needed:
+            return (needed - self.tokens) * 60 / self.tpm
+        if self.rpm and self.requests < 1:
+            return (1 - self.requests) * 60 / self.rpm
+        return 0
+
+    def acquire(self, tokens, priority):
+        """
+        Blocks until the call may start, then takes its tokens and request.
+
+        Parameters:
+        - tokens (int): Estimated tokens of the call.
+        - priority (int): Lower starts first.
+        """
+        now = time.monotonic()
+        # Ordering by priority + enqueue time / aging is the same as aging every waiter continuously
+        entry = (priority + now / self.aging, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._delay(tokens, now) if self._waiting[0] == entry else None
+                    if delay == 0:
+                        break
+                    self._condition.wait(delay)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self.running += 1
+            self.tokens -= tokens
+            self.requests -= 1
+            # The next waiter may be able to start as well
+            self._condition.notify_all()
+
+    def release(self, estimated, used):
+        """
+        Frees the call's slot and charges the difference between its real and estimated tokens.
+        """
+        with self._condition:
+            self.running -= 1
+            if self.tpm and used is not None:
+                self.tokens -= used - estimated
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Stops new calls of this model from starting for `seconds`.
+        """
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            # Whatever the bucket says, the API has just told us it is empty
+            self.tokens = min(self.tokens, 0)
+
+
+class LLMGateway:
+    """
+    Per-model limiters shared by every LLM call of the process.
+
+    Parameters:
+    - limits (dict): Default limits, as keyword arguments of ModelLimiter.
+    - model_limits (dict): Limits of single models, overriding the defaults.
+    - max_retries (int): Retries of a rate-limited or failed call.
+    """
+
+    def __init__(self, limits=None, model_limits=None, max_retries=4):
+        self.limits = limits or {}
+        self.model_limits = model_limits or {}
+        self.max_retries = max_retries
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model):
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = ModelLimiter(model, **{**self.limits, **self.model_limits.get(model, {})})
+            return self._limiters[model]
+
+    def complete(self, call, create, **kwargs):
+        """
+        Runs one chat completion through the gateway and records it with pipeline_metrics.record_llm_call.
+
+        Parameters:
+        - call (str): Name of the pipeline call, which sets its priority.
+        - create (function): client.chat.completions.create.
+        - kwargs: Arguments of create.
+
+        Returns:
+        - response (ChatCompletion): The API response.
+        """
+        model = kwargs.get("model")
+        limiter = self.limiter(model)
+        tokens = estimate_tokens(kwargs)
+        priority = CALL_PRIORITIES.get(call, DEFAULT_PRIORITY)
+        record = pipeline_metrics.current()
+        if record is not None:
+            priority += record.priority
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            with pipeline_metrics.step("llm_queue"):
+                limiter.acquire(tokens, priority)
+            start = time.perf_counter()
+            LLM_QUEUE_WAIT.observe(start - queued, call=call, model=model)
+            used = None
+            try:
+                response = create(**kwargs)
+                usage = getattr(response, "usage", None)
+                used = getattr(usage, "total_tokens", None)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = retry_after(e)
+                if wait is None:
+                    wait = min(30, 2 ** attempt) * random.uniform(0.5, 1.0)
+                if isinstance(e, openai.RateLimitError):
+                    LLM_RATE_LIMITED.inc(model=model)
+                    limiter.pause(wait)
+                else:
+                    time.sleep(wait)
+                LLM_RETRIES.inc(model=model, error=type(e).__name__)
+                logging.warning("%s call to %s failed (%s), retrying in %.1fs", call, model, type(e).__name__, wait)
+                continue
+            finally:
+                limiter.release(tokens, used)
+            pipeline_metrics.record_llm_call(call, model, time.perf_counter() - start, usage)
+            return response
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    """
+    Returns the process-wide gateway, configured from the environment on first use.
+    """
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway(
+                limits={
+                    "in_flight": int(os.getenv('LLM_MAX_IN_FLIGHT', 32)),
+                    "tpm": int(os.getenv('LLM_TPM', 300000)),
+                    "rpm": int(os.getenv('LLM_RPM', 3000)),
+                    "aging": float(os.getenv('LLM_PRIORITY_AGING', 30)),
+                },
+                model_limits=json.loads(os.getenv('LLM_LIMITS', '{}')),
+                max_retries=int(os.getenv('LLM_MAX_RETRIES', 4)))
+        return _gateway
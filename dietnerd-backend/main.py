@@ -1,7 +1,7 @@
 from helper_functions import *
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Query
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from starlette.responses import JSONResponse
 
 import asyncio
@@ -26,11 +26,20 @@ import logging
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
-from collections import defaultdict
 
-logging.basicConfig(level=logging.INFO)
+import metrics
+import pipeline_metrics
+import evidence_ranking
+import pubmed_mirror
+import write_behind
+import warmer
+from storage import get_storage
+from session_hub import SSE_HEARTBEAT_INTERVAL
+from job_scheduler import QueueFullError
+from broker import get_broker
+from question_classifier import check_question_validity
 
-update_queues = defaultdict(asyncio.Queue)
+logging.basicConfig(level=logging.INFO)
 
 app = FastAPI()
 
@@ -53,14 +62,40 @@ Please be aware that the insights provided by DietNerd may not fully take into c
 To find a local expert near you, use this website: https://www.eatright.org/find-a-nutrition-expert
 """
 
-executor = ThreadPoolExecutor()
-
-# Create a global event loop
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
-
-def run_in_executor(func, *args):
-    return loop.run_in_executor(executor, func, *args)
+# Blocking calls are offloaded to bounded pools so handlers never block the event loop (and every open SSE stream).
+# LLM calls and database calls get separate pools so slow OpenAI requests cannot starve /db_get.
+executors = {
+    "llm": ThreadPoolExecutor(max_workers=int(os.getenv('API_LLM_THREADS', 32)), thread_name_prefix="api-llm"),
+    "db": ThreadPoolExecutor(max_workers=int(os.getenv('API_DB_THREADS', os.getenv('DB_POOL_SIZE', 10))), thread_name_prefix="api-db"),
+}
+
+API_OFFLOAD_WAIT = metrics.histogram("dietnerd_api_offload_wait_seconds", "Time a blocking API call waited for a free executor thread.", ("pool",))
+
+async def run_in_executor(pool, func, *args):
+    submitted = time.time()
+    def run():
+        API_OFFLOAD_WAIT.observe(time.time() - submitted, pool=pool)
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executors[pool], run)
+
+@app.on_event("startup")
+async def startup():
+    pubmed_mirror.check_source()
+    await run_in_executor("db", get_storage(env).open)
+    get_broker().start(process_user_query)
+    warmer.start(get_broker(), get_storage(env))
+
+@app.on_event("shutdown")
+def shutdown():
+    get_broker().stop()
+    warmer.stop()
+    write_behind.drain()
+    for executor in executors.values():
+        executor.shutdown(wait=False)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def root():
@@ -70,114 +105,228 @@ async def root():
 @app.get("/db_sim_search/{question:str}")
 async def sim_search(question:str):
    decoded_query = unquote(question)
-   result = await sim_score(decoded_query)
+   result = await run_in_executor("db", sim_score, decoded_query)
    return result
 
 @app.get("/db_get/{query:str}")
-async def db_get_endpoint(query: str):
+async def db_get_endpoint(query: str, include: str = Query(default=None)):
    decoded_query = unquote(query)
-   result = await query_db_final(decoded_query)
+   result = await run_in_executor("db", query_db_final, decoded_query, include == "articles")
    return result
 
+SPECULATIVE_OUTCOMES = metrics.counter("dietnerd_speculative_outcomes_total", "Questions submitted with a speculative pipeline start, by validity outcome and the stage reached when it was known.", ("outcome",))
+SPECULATIVE_VALIDITY_WAIT = metrics.histogram("dietnerd_speculative_validity_wait_seconds", "Time a speculative pipeline waited for the validity check before relevance classification.")
+SPECULATIVE_OVERLAP = metrics.histogram("dietnerd_speculative_overlap_seconds", "Validity check time hidden behind query generation and article retrieval (wall-clock gain on valid questions).")
+SPECULATIVE_WASTED = metrics.histogram("dietnerd_speculative_wasted_seconds", "Pipeline time spent on questions the validity check refused.")
+
+def refusal_message(question_validity):
+   """
+   Returns the message shown instead of an answer, or None if the question is valid.
+   """
+   if not question_validity.startswith('False'):
+      return None
+   if 'Animal' in question_validity:
+      return ("I'm sorry, I cannot help you with this question. For any questions regarding an animal, please speak to a veterinarian.\n"
+              "To find a local expert near you, use this website: https://vetlocator.com/.")
+   return ("I'm sorry, I cannot help you with this question. For any questions or advice around meal planning or recipes, please speak to a registered dietitian or registered dietitian nutritionist.\n"
+           "To find a local expert near you, use this website: https://www.eatright.org/find-a-nutrition-expert.")
+
 @app.get("/check_valid/{question:str}")
 async def check_valid(question:str):
-   question_validity = determine_question_validity(question)
-   if question_validity == 'False - Meal Plan/Recipe':
-    final_output = ("I'm sorry, I cannot help you with this question. For any questions or advice around meal planning or recipes, please speak to a registered dietitian or registered dietitian nutritionist.\n"
-                    "To find a local expert near you, use this website: https://www.eatright.org/find-a-nutrition-expert.")
-    print(final_output)
-   elif question_validity == 'False - Animal':
-    final_output = ("I'm sorry, I cannot help you with this question. For any questions regarding an animal, please speak to a veterinarian.\n"
-                   "To find a local expert near you, use this website: https://vetlocator.com/.")
-   else:
+   question_validity = await run_in_executor("llm", check_question_validity, question, determine_question_validity, get_storage(env))
+   final_output = refusal_message(question_validity)
+   if final_output is None:
     final_output = "good"
+   else:
+    print(final_output)
    return {"response" : final_output}
 
-@app.post("/process_query")
-async def process_query(query: QueryModel, background_tasks: BackgroundTasks):
+async def submit_query(user_query, validate):
     session_id = str(uuid.uuid4())
-    background_tasks.add_task(process_user_query, query.user_query, session_id)
+    warmer.note_activity()
+    try:
+        await get_broker().submit(session_id, user_query, validate)
+    except QueueFullError as e:
+        return JSONResponse({"detail": "DietNerd is busy answering other questions. Please try again shortly."},
+                            status_code=429, headers={"Retry-After": str(e.retry_after)})
     return JSONResponse({"session_id": session_id})
 
+@app.post("/process_query")
+async def process_query(query: QueryModel):
+    return await submit_query(query.user_query, validate=False)
+
+@app.post("/submit")
+async def submit(query: QueryModel):
+    """
+    Validity check and pipeline in one request: the pipeline starts right away and the check runs alongside query
+    generation and article retrieval. A refused question ends the stream with {"end_output": <message>, "refusal": true}.
+    """
+    return await submit_query(query.user_query, validate=True)
+
 @app.get("/sse")
-async def sse(session_id: str = Query(default=None)):
+async def sse(request: Request, session_id: str = Query(default=None)):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id is required")
-    return EventSourceResponse(event_generator(session_id))
-
-async def event_generator(session_id: str):
-    queue = asyncio.Queue()
-    update_queues[session_id] = queue
+    if not await get_broker().exists(session_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired session_id")
+    # Browsers send the id of the last event they received when EventSource reconnects
+    last_event_id = request.headers.get("last-event-id", "0")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else 0
+    return EventSourceResponse(get_broker().subscribe(session_id, last_event_id), ping=SSE_HEARTBEAT_INTERVAL)
+
+def start_validity_check(user_query):
+    """
+    Starts the validity check on the LLM executor.
+
+    Returns:
+    - validity (Future): Resolves to (question_validity, seconds the check took).
+    """
+    def run():
+        start = time.time()
+        return check_question_validity(user_query, determine_question_validity, get_storage(env)), time.time() - start
+    return executors["llm"].submit(pipeline_metrics.in_context(run))
+
+def refuse_if_invalid(session_id, validity, stage, started, wait=False):
+    """
+    Ends a speculative session with the refusal message if its validity check has come back invalid.
+
+    Parameters:
+    - session_id (str): The session.
+    - validity (Future): As returned by start_validity_check, or None when the question was checked before submission.
+    - stage (str): The last pipeline stage that finished, for metrics.
+    - started (float): When the pipeline started.
+    - wait (bool): Wait for the check instead of only looking at a finished one.
+
+    Returns:
+    - refused (bool): True if the pipeline must stop.
+    """
+    if validity is None or (not wait and not validity.done()):
+        return False
     try:
-        while True:
-            data = await queue.get()
-            if isinstance(data, dict) and "final_output" in data:
-                yield {"event": "message", "data": json.dumps(data)}
-                break
-            else:
-                yield {"event": "message", "data": json.dumps({"update": data})}
-    finally:
-        del update_queues[session_id]
-
-def process_user_query(user_query, session_id):
+        question_validity, _ = validity.result()
+    except Exception as e:
+        # The check used to be a separate request whose failure was shown as an error; here answering is the safe default
+        logging.warning("Validity check failed, continuing with the pipeline: %s", e)
+        return False
+    message = refusal_message(question_validity)
+    if message is None:
+        return False
+    SPECULATIVE_OUTCOMES.inc(outcome=f"refused_after_{stage}")
+    record = pipeline_metrics.current()
+    if record is not None:
+        record.status = "refused"
+    SPECULATIVE_WASTED.observe(time.time() - started)
+    send_update(session_id, {"end_output": message, "refusal": True, "citations": [], "citations_obj": []})
+    return True
+
+def process_user_query(user_query, session_id, validate=False):
+    if warmer.is_warm_session(session_id):
+        return warmer.answer(run_pipeline, user_query, session_id, get_broker().publish)
+    write_behind.enqueue_question(user_query, "submit", env)
+    with pipeline_metrics.question(user_query, session_id) as record:
+        return run_pipeline(user_query, session_id, record, validate)
+
+def run_pipeline(user_query, session_id, record, validate=False):
+    # Validity check, overlapped with query generation and article retrieval
+    started = time.time()
+    validity = start_validity_check(user_query) if validate else None
+
     # Query Generation 
-    start_poc = time.time()
-    general_query, query_contention, query_list = query_generation(user_query)
-    end_poc = time.time()
+    with pipeline_metrics.stage("query_generation"):
+        general_query, query_contention, query_list = query_generation(user_query)
+    if refuse_if_invalid(session_id, validity, "query_generation", started):
+        return None
 
     print("Generated PubMed queries")
     print(query_list)
-    loop.run_until_complete(send_update(session_id, "Generated PubMed queries..."))
+    send_update(session_id, "Generated PubMed queries...")
     # Article Retrieval
-    start_api = time.time()
-    deduplicated_articles_collected = collect_articles(query_list)
-    end_api = time.time()
+    with pipeline_metrics.stage("retrieval"):
+        deduplicated_articles_collected = collect_articles(query_list)
+    pipeline_metrics.count_articles("retrieved", len(deduplicated_articles_collected))
+
+    # Relevance classification is the first stage with large LLM cost, so it waits for the verdict
+    if validity is not None:
+        wait_start = time.time()
+        with pipeline_metrics.stage("validity_wait"):
+            refused = refuse_if_invalid(session_id, validity, "retrieval", started, wait=True)
+        if refused:
+            return None
+        waited = time.time() - wait_start
+        SPECULATIVE_VALIDITY_WAIT.observe(waited)
+        try:
+            SPECULATIVE_OVERLAP.observe(max(0.0, validity.result()[1] - waited))
+        except Exception:
+            pass
+        SPECULATIVE_OUTCOMES.inc(outcome="valid")
 
     print("Retrieved Articles")
-    loop.run_until_complete(send_update(session_id, f"Retrieved {len(deduplicated_articles_collected)} Articles..."))
+    send_update(session_id, f"Retrieved {len(deduplicated_articles_collected)} Articles...")
     # Relevance Classifier
-    start_relevant = time.time()
-    relevant_articles, irrelevant_articles = concurrent_relevance_classification(deduplicated_articles_collected, user_query)
-    end_relevant = time.time()
+    with pipeline_metrics.stage("relevance_classification"):
+        relevant_articles, irrelevant_articles = concurrent_relevance_classification(deduplicated_articles_collected, user_query)
+    pipeline_metrics.count_articles("relevant", len(relevant_articles))
+    pipeline_metrics.count_articles("irrelevant", len(irrelevant_articles))
+    # Articles whose classification failed, e.g. because they have no abstract
+    pipeline_metrics.count_articles("dropped", len(deduplicated_articles_collected) - len(relevant_articles) - len(irrelevant_articles))
 
     print("relevant articles")
-    loop.run_until_complete(send_update(session_id, f"Classified {len(relevant_articles)} Relevant Articles..."))
-
-    # Article Match
-    start_processing = time.time()
-    reliability_analysis_df = connect_to_reliability_analysis_db()
-    reliability_analysis_df = reliability_analysis_df.where(pd.notnull(reliability_analysis_df), None)
-    for col in reliability_analysis_df.select_dtypes(include=np.number).columns:
-        reliability_analysis_df[col] = reliability_analysis_df[col].astype(object).where(reliability_analysis_df[col].notnull(), None)
-    matched_articles, articles_to_process = article_matching(relevant_articles, reliability_analysis_df)
-
-    print("matched articles")
-    # Article Processing
-    relevant_article_summaries = concurrent_article_processing(articles_to_process)
-
-    # Write Processed Articles to DB
-    write_articles_to_db(relevant_article_summaries, env)
-
-    all_relevant_articles = list(itertools.chain(relevant_article_summaries, matched_articles))
-    end_processing = time.time()
+    send_update(session_id, f"Classified {len(relevant_articles)} Relevant Articles...")
+
+    with pipeline_metrics.stage("article_processing"):
+        # Article Match
+        reliability_analysis_df = connect_to_reliability_analysis_db([article.pmid for article in relevant_articles])
+        reliability_analysis_df = reliability_analysis_df.where(pd.notnull(reliability_analysis_df), None)
+        for col in reliability_analysis_df.select_dtypes(include=np.number).columns:
+            reliability_analysis_df[col] = reliability_analysis_df[col].astype(object).where(reliability_analysis_df[col].notnull(), None)
+        matched_articles, articles_to_process = article_matching(relevant_articles, reliability_analysis_df)
+
+        print("matched articles")
+        # Strongest evidence first, at most EVIDENCE_TOP_K articles, until there is enough high-tier evidence
+        with pipeline_metrics.step("evidence_ranking"):
+            articles_to_process, ranked_out = evidence_ranking.select_articles(articles_to_process, user_query)
+            unmatched = {article.pmid for article in articles_to_process} | {article.pmid for article in ranked_out}
+            budget = evidence_ranking.EvidenceBudget(high_tier=sum(evidence_ranking.is_high_tier(article.publication_types)
+                                                                   for article in relevant_articles if article.pmid not in unmatched))
+        # Article Processing
+        relevant_article_summaries = concurrent_article_processing(articles_to_process, budget)
+
+        # Write Processed Articles to DB (in the background)
+        with pipeline_metrics.step("db_write_articles"):
+            write_behind.enqueue_articles(relevant_article_summaries, env)
+
+        all_relevant_articles = list(itertools.chain(relevant_article_summaries, matched_articles))
+    processed = sum(summary is not None for summary in relevant_article_summaries)
+    pipeline_metrics.count_articles("matched", len(matched_articles))
+    pipeline_metrics.count_articles("processed", processed)
+    pipeline_metrics.count_articles("failed", len(articles_to_process) - budget.cancelled - processed)
+    pipeline_metrics.count_articles("ranked_out", len(ranked_out))
+    pipeline_metrics.count_articles("early_exit", budget.cancelled)
 
     print(f"Processed {len(all_relevant_articles)} Articles...")
-    loop.run_until_complete(send_update(session_id, f"Processed {len(all_relevant_articles)} Articles..."))
+    send_update(session_id, f"Processed {len(all_relevant_articles)} Articles...")
 
     # Final Output
-    start_output = time.time()
-    final_output = generate_final_response(all_relevant_articles, user_query)
-    end_output = time.time()
-
-    poc_duration = end_poc - start_poc
-    api_duration = end_api - start_api
-    relevance_classifier_duration = end_relevant - start_relevant
-    article_processing_duration = end_processing - start_processing
-    final_output_duration = end_output - start_output
+    with pipeline_metrics.stage("synthesis"):
+        if SYNTHESIS_CITATION_MODE == 'pmid':
+            final_output, citations, updated_citations = generate_final_response_structured(all_relevant_articles, user_query)
+        else:
+            final_output = generate_final_response(all_relevant_articles, user_query)
+            main_output, citations = split_end_output(final_output)
+            updated_citations = match_citations_with_articles(citations, all_relevant_articles)
+
+    poc_duration = record.stages["query_generation"]
+    api_duration = record.stages["retrieval"]
+    relevance_classifier_duration = record.stages["relevance_classification"]
+    article_processing_duration = record.stages["article_processing"]
+    final_output_duration = record.stages["synthesis"]
     total_runtime = poc_duration + api_duration + article_processing_duration + final_output_duration
 
-    write_output_to_db(user_query, final_output, all_relevant_articles, total_runtime, env)
-    end_output = time.time()
+    with pipeline_metrics.step("db_write_answer"):
+        # Ranked-out, cancelled and failed articles are not screened: refresh.py retries them
+        screened_pmids = [article.pmid for article in irrelevant_articles] + \
+                         [summary.get('PMID') or summary.get('article_id') for summary in all_relevant_articles if summary]
+        write_behind.enqueue_answer(user_query, build_output_record(final_output, all_relevant_articles, total_runtime, citations, updated_citations, screened_pmids), env)
 
     print('-'*200)
     print(final_output)
@@ -209,58 +358,28 @@ def process_user_query(user_query, session_id):
        "relevant_articles": all_relevant_articles
     }
 
-    main_output, citations = split_end_output(return_obj["end_output"])
-    relevant_articles = return_obj.get("relevant_articles", [])
-    updated_citations = match_citations_with_articles(citations, all_relevant_articles)
     return_obj["end_output"] = final_output
     return_obj["citations_obj"] = updated_citations
     return_obj["citations"] = citations
     
-    loop.run_until_complete(send_update(session_id, return_obj))
+    send_update(session_id, return_obj)
 
     return return_obj
 
-async def send_update(session_id, data):
-    if session_id in update_queues:
-        await update_queues[session_id].put(data)
-
-async def query_db_final(query: str):
-   load_dotenv("ATT81274.env")
-   mydb = mysql.connector.connect(
-    host=os.getenv('host'),
-    port=os.getenv('port'),
-    user=os.getenv('user'),
-    password=os.getenv('password'),
-    database=os.getenv('database')
-    )
-
-   mycursor = mydb.cursor()
-   sql = f"SELECT * FROM question_answer WHERE question = '{query}'"
-
-   mycursor.execute(sql)
+def send_update(session_id, data):
+    # The warmer only waits for the report warmer.answer publishes at the end
+    if warmer.is_warm_session(session_id):
+        return
+    get_broker().publish(session_id, data)
 
-   myresult = mycursor.fetchall()
-   with open("output.json", "w") as f:
-      json.dump(myresult, f, indent=4)
+def query_db_final(query: str, include_articles: bool = False):
+   myresult = get_storage(env).get_answer(query, include_articles)
    return myresult
 
 
-async def sim_score(question: str):
-   mydb = mysql.connector.connect(
-    host=os.getenv("host"),
-    port=os.getenv("port"),
-    user=os.getenv("user"),
-    password=os.getenv("password"),
-    database=os.getenv("database")
-  )
-   mycursor = mydb.cursor()
-   sql = f"SELECT question FROM question_answer;"
-   mycursor.execute(sql)
-   myresult = mycursor.fetchall()
-   resultdict = []
-
-   for x in myresult:
-      resultdict.append(x[0])
+def sim_score(question: str):
+   write_behind.enqueue_question(question, "similar", env)
+   resultdict = get_storage(env).list_questions()
 
    scores_dict = calculate_similarity(resultdict, question)
    print(scores_dict)
@@ -0,0 +1,56 @@
+"""
+Migrates article_analysis rows from a single uncompressed article_json string to typed metadata columns with a
+zlib-compressed summary (see storage.py). Opening the storage upgrades the schema, as the API does at startup, and
+new articles are written to the typed columns from then on; this script rewrites the existing rows in batches and
+clears their article_json. Rows that are already migrated are skipped, so the migration can be re-run safely. It can
+run before or after migrate_question_answer.py.
+
+Usage (from dietnerd-backend/):
+    python migrate_article_analysis.py --dry-run
+    python migrate_article_analysis.py
+"""
+import argparse
+import json
+
+from storage import article_to_columns, get_storage
+
+
+def migrate(dry_run=False, batch_size=500):
+  """
+  Migrates every legacy article_analysis row and prints the storage saved.
+
+  Parameters:
+  - dry_run (bool): Only report what would be written.
+  - batch_size (int): Rows read per query.
+  """
+  storage = get_storage('ATT81274.env')
+  storage.open()
+
+  pmids = [row[0] for row in storage.select_articles(['article_id'])]
+  migrated = skipped = 0
+  bytes_before = bytes_after = 0
+  for i in range(0, len(pmids), batch_size):
+    rows = []
+    for pmid, article_json in storage.select_articles(['article_id', 'article_json'], pmids[i:i + batch_size]):
+      if article_json is None:
+        skipped += 1
+        continue
+      row = article_to_columns(pmid, json.loads(article_json))
+      bytes_before += len(article_json.encode())
+      bytes_after += sum(len(value) if isinstance(value, bytes) else len(value.encode()) for value in row if value is not None)
+      rows.append(row)
+    if rows and not dry_run:
+      storage.write_articles(rows, replace=True)
+    migrated += len(rows)
+
+  print(f"Migrated: {migrated}, already migrated: {skipped}")
+  if migrated:
+    print(f"Article bytes: {bytes_before:,} -> {bytes_after:,} ({1 - bytes_after / bytes_before:.0%} smaller)")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--dry-run", action="store_true")
+  parser.add_argument("--batch-size", type=int, default=500)
+  args = parser.parse_args()
+  migrate(args.dry_run, args.batch_size)
@@ -0,0 +1,90 @@
+"""
+Migrates question_answer rows from the original JSON blob (with every relevant article embedded) to the normalized
+format: end output, citations and citation PMIDs in question_answer, relevant PMIDs in question_answer_article.
+
+Embedded articles missing from article_analysis are upserted first, so every link resolves. They are written to the
+typed article columns, which opening the storage adds to a legacy article_analysis table, so this migration does not
+depend on migrate_article_analysis.py having run; the two can run in either order. Links reference question_answer.id,
+so a legacy question_answer table without an id column is reported before anything is written, with the statement
+that adds it. Rows that are already migrated are skipped, so the migration can be re-run safely.
+
+Usage (from dietnerd-backend/):
+    python migrate_question_answer.py --dry-run
+    python migrate_question_answer.py
+"""
+import argparse
+import json
+import sys
+
+from storage import ANSWER_FORMAT, get_storage, normalize_answer
+
+
+def article_analysis_row(article):
+  """
+  Converts an embedded relevant article to an article_analysis row.
+
+  Parameters:
+  - article (dict): A relevant article from a stored answer (processed or matched).
+
+  Returns:
+  - row (tuple): (PMID, article dictionary)
+  """
+  pmid = str(article.get('PMID') or article.get('article_id'))
+  article_json = {
+        'url': article.get('url'),
+        'PMID': pmid,
+        'PMCID': article.get('PMCID'),
+        'summary': article.get('summary'),
+        'citation': article.get('citation'),
+        'article_type': article.get('article_type') or article.get('publication_type')
+  }
+  return (pmid, article_json)
+
+
+def migrate(dry_run=False, batch_size=100):
+  """
+  Migrates every legacy question_answer row and prints the storage saved.
+
+  Parameters:
+  - dry_run (bool): Only report what would be written.
+  - batch_size (int): Rows read per query.
+  """
+  storage = get_storage('ATT81274.env')
+  storage.open()
+  storage.create_schema()
+  try:
+    storage.fetch_answer_rows("")
+  except Exception as e:
+    sys.exit(f"Cannot read question_answer.id ({e}). Add the column first, e.g. on MySQL:\n"
+             f"  ALTER TABLE question_answer ADD COLUMN id INT NOT NULL AUTO_INCREMENT UNIQUE;")
+
+  migrated = skipped = 0
+  bytes_before = bytes_after = 0
+  for question, answer, answer_id in storage.iter_answers(batch_size):
+    obj = json.loads(answer)
+    if obj.get('format') == ANSWER_FORMAT:
+      skipped += 1
+      continue
+
+    articles = [article for article in (obj.get('relevant_articles') or obj.get('relevent_articles') or []) if article]
+    normalized, pmids = normalize_answer(obj)
+    bytes_before += len(answer.encode())
+    # Each link row stores an id, a PMID and a position
+    bytes_after += len(normalized.encode()) + len(pmids) * 16
+
+    if not dry_run:
+      storage.upsert_articles([article_analysis_row(article) for article in articles])
+      storage.write_answers([(question, normalized, pmids)], replace=True)
+    migrated += 1
+
+  print(f"Migrated: {migrated}, already migrated: {skipped}")
+  if migrated:
+    print(f"Answer bytes: {bytes_before:,} -> {bytes_after:,} ({1 - bytes_after / bytes_before:.0%} smaller)")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--dry-run", action="store_true")
+  parser.add_argument("--batch-size", type=int, default=100)
+  args = parser.parse_args()
+  migrate(args.dry_run, args.batch_size)
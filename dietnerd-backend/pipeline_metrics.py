@@ -0,0 +1,249 @@
+"""
+Per-stage instrumentation of the question pipeline.
+
+process_user_query runs inside `question(...)`, each of its stages inside `stage(...)`, and the slow steps below them
+(esearch, efetch, every LLM call, every full-text source, database reads and writes) inside `step(...)` or a
+`@timed(...)` function. Every measurement goes to the process-wide histograms exported on /metrics and to the record
+of the current question, which is logged as one JSON line when the question finishes, fails or is refused:
+
+    {"session_id": ..., "question": ..., "status": "ok", "total_seconds": 41.2,
+     "stages": {"query_generation": 3.1, ...}, "steps": {"esearch": {"count": 5, "seconds": 2.4}, ...},
+     "articles": {"retrieved": 38, "relevant": 21, ...}, "llm": {"gpt-4-turbo": {"calls": 19, ...}}, "cost_usd": 0.61}
+
+The current record is held in a context variable. Work submitted to thread pools must be wrapped with `in_context`
+to be counted towards the question that submitted it.
+
+Configuration (env):
+- PIPELINE_RECORD_PATH: JSON-lines file the per-question records are also appended to (default unset, they are only
+  logged). The file is not rotated.
+- LLM_PRICES: JSON object overriding the USD prices per million tokens, e.g. {"gpt-4-turbo": [10, 30]} (prompt, completion).
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+PIPELINE_RECORD_PATH = os.getenv('PIPELINE_RECORD_PATH')
+
+# USD per million (prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo-0125": (0.5, 1.5),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+MODEL_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv('LLM_PRICES', '{}')).items()})
+
+STAGE_SECONDS = metrics.histogram("dietnerd_pipeline_stage_seconds", "Duration of each pipeline stage.", ("stage",))
+STEP_SECONDS = metrics.histogram("dietnerd_pipeline_step_seconds", "Duration of each sub-step of the pipeline (NCBI requests, full-text sources, database calls).", ("step",))
+QUESTION_SECONDS = metrics.histogram("dietnerd_pipeline_question_seconds", "Duration of a whole question, by outcome.", ("status",))
+ARTICLES = metrics.counter("dietnerd_pipeline_articles_total", "Articles per pipeline outcome (retrieved, relevant, irrelevant, dropped, matched, processed, failed, ranked_out, early_exit, new).", ("outcome",))
+LLM_SECONDS = metrics.histogram("dietnerd_llm_call_seconds", "Latency of each LLM call.", ("call", "model"))
+LLM_TOKENS = metrics.counter("dietnerd_llm_tokens_total", "LLM tokens used, by model and kind (prompt, completion).", ("model", "kind"))
+LLM_COST = metrics.counter("dietnerd_llm_cost_usd_total", "Estimated LLM cost in USD, by model.", ("model",))
+LLM_ERRORS = metrics.counter("dietnerd_llm_errors_total", "LLM calls that raised, by call and model.", ("call", "model"))
+
+_current = contextvars.ContextVar("pipeline_question", default=None)
+_record_lock = threading.Lock()
+
+
+class QuestionRecord:
+    """
+    Measurements of one question. Updated from the pipeline thread and from the thread pools it submits to.
+    """
+
+    def __init__(self, question, session_id):
+        self.question = question
+        self.session_id = session_id
+        self.started = time.time()
+        self.status = "running"
+        self.error = None
+        self.failed_stage = None
+        self.stages = {}
+        self.steps = {}
+        self.articles = {}
+        self.llm = {}
+        # Added to the priority of every LLM call of the question (see llm_gateway.py), e.g. for warmer.py
+        self.priority = 0
+        self._lock = threading.Lock()
+
+    def add_step(self, step, seconds):
+        with self._lock:
+            entry = self.steps.setdefault(step, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+    def add_llm(self, model, seconds, prompt_tokens, completion_tokens, cost):
+        with self._lock:
+            entry = self.llm.setdefault(model, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["cost_usd"] += cost
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "session_id": self.session_id,
+                "question": self.question,
+                "started": self.started,
+                "status": self.status,
+                "error": self.error,
+                "failed_stage": self.failed_stage,
+                "total_seconds": round(time.time() - self.started, 3),
+                "stages": {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+                "steps": {step: {"count": entry["count"], "seconds": round(entry["seconds"], 3)} for step, entry in self.steps.items()},
+                "articles": dict(self.articles),
+                "llm": {model: dict(entry, seconds=round(entry["seconds"], 3), cost_usd=round(entry["cost_usd"], 6)) for model, entry in self.llm.items()},
+                "cost_usd": round(sum(entry["cost_usd"] for entry in self.llm.values()), 6),
+            }
+
+
+def current():
+    """
+    Returns the QuestionRecord of the running question, or None outside a question.
+    """
+    return _current.get()
+
+
+def write_record(record):
+    line = json.dumps(record.as_dict(), default=str)
+    logging.getLogger("dietnerd.pipeline").info(line)
+    if PIPELINE_RECORD_PATH:
+        try:
+            with _record_lock, open(PIPELINE_RECORD_PATH, "a") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logging.warning("Could not write pipeline record to %s: %s", PIPELINE_RECORD_PATH, e)
+
+
+@contextlib.contextmanager
+def question(user_query, session_id):
+    """
+    Tracks one run of the pipeline and writes its record when it ends, whether it finished, was refused or raised.
+    The block can set record.status to "refused" (or any other outcome); it is "ok" otherwise.
+
+    Yields:
+    - record (QuestionRecord): The record of the question.
+    """
+    record = QuestionRecord(user_query, session_id)
+    token = _current.set(record)
+    try:
+        yield record
+        if record.status == "running":
+            record.status = "ok"
+    except BaseException as e:
+        record.status = "error"
+        record.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        QUESTION_SECONDS.observe(time.time() - record.started, status=record.status)
+        write_record(record)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times one pipeline stage. A stage that raises is still recorded, as the record's failed_stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record = current()
+        if record is not None and record.failed_stage is None:
+            record.failed_stage = name
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        record = current()
+        if record is not None:
+            record.stages[name] = record.stages.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def step(name):
+    """
+    Times one sub-step, e.g. an efetch request or a full-text download.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STEP_SECONDS.observe(seconds, step=name)
+        record = current()
+        if record is not None:
+            record.add_step(name, seconds)
+
+
+def timed(name):
+    """
+    Decorator form of `step`.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with step(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_articles(outcome, amount):
+    ARTICLES.inc(amount, outcome=outcome)
+    record = current()
+    if record is not None:
+        with record._lock:
+            record.articles[outcome] = record.articles.get(outcome, 0) + amount
+
+
+def llm_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def record_llm_call(call, model, seconds, usage):
+    """
+    Records the latency, token usage and estimated cost of one LLM call.
+
+    Parameters:
+    - call (str): Which call this was, e.g. "relevance" or "synthesis".
+    - model (str): The requested model.
+    - seconds (float): Latency of the call.
+    - usage (CompletionUsage): The usage block of the response, or None.
+    """
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    cost = llm_cost(model, prompt_tokens, completion_tokens)
+    LLM_SECONDS.observe(seconds, call=call, model=model)
+    LLM_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens, model=model, kind="completion")
+    LLM_COST.inc(cost, model=model)
+    record = current()
+    if record is not None:
+        record.add_step(f"llm_{call}", seconds)
+        record.add_llm(model, seconds, prompt_tokens, completion_tokens, cost)
+
+
+def in_context(function):
+    """
+    Binds a function to the current question, for work submitted to a thread pool.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
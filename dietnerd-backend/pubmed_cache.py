@@ -0,0 +1,158 @@
+"""
+Two-level cache in front of NCBI E-utilities for article retrieval.
+
+- esearch ID lists are cached in memory per exact query string, with a short TTL, because popular generated queries
+  repeat across users but search results do change as PubMed grows.
+- efetch records are stored per PMID in the pubmed_record table, with a long TTL, because a published record rarely
+  changes. Each record is kept as the raw <PubmedArticle> XML (zlib-compressed) and parsed again on load (see
+  pubmed_parser.py), so cached articles are exactly the records of a fresh efetch. The efetch prolog (XML declaration
+  and DOCTYPE) is not kept: the parser ignores the DTD and the records are UTF-8 either way.
+
+collect_articles only fetches PMIDs that are missing from the store, and reports its NCBI requests per question.
+
+Configuration (env):
+- ESEARCH_CACHE_SIZE: query strings kept (default 5000).
+- ESEARCH_CACHE_TTL: seconds an ID list is kept (default 3600).
+- PUBMED_RECORD_TTL: seconds a stored record is used before it is fetched again (default 30 days).
+"""
+import logging
+import os
+import re
+import threading
+import time
+from cachetools import TTLCache
+
+import metrics
+from pubmed_parser import parse_articles
+from storage import compress_text, decompress_text
+
+PUBMED_RECORD_TTL = float(os.getenv('PUBMED_RECORD_TTL', 30 * 24 * 3600))
+
+_search_cache = TTLCache(maxsize=int(os.getenv('ESEARCH_CACHE_SIZE', 5000)), ttl=float(os.getenv('ESEARCH_CACHE_TTL', 3600)))
+_search_cache_lock = threading.Lock()
+
+NCBI_REQUESTS = metrics.counter("dietnerd_ncbi_requests_total", "Requests sent to NCBI E-utilities.", ("kind",))
+NCBI_REQUESTS_PER_QUESTION = metrics.histogram("dietnerd_ncbi_requests_per_question", "NCBI E-utilities requests made to collect the articles of one question.",
+                                               buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+PUBMED_CACHE = metrics.counter("dietnerd_pubmed_cache_total", "PubMed cache lookups, by cache level and result.", ("level", "result"))
+
+ARTICLE_PATTERN = re.compile(rb"<PubmedArticle\b[^>]*>.*?</PubmedArticle>", re.DOTALL)
+PMID_PATTERN = re.compile(rb"<PMID[^>]*>\s*(\d+)\s*</PMID>")
+SET_OPEN = b"<PubmedArticleSet>"
+SET_CLOSE = b"</PubmedArticleSet>"
+
+
+class NCBIRequestStats:
+    """
+    Counts the NCBI requests and cache hits of one collect_articles call.
+    """
+    __slots__ = ("esearch", "efetch", "esearch_cached", "records_cached", "records_fetched")
+
+    def __init__(self):
+        self.esearch = 0
+        self.efetch = 0
+        self.esearch_cached = 0
+        self.records_cached = 0
+        self.records_fetched = 0
+
+    @property
+    def requests(self):
+        return self.esearch + self.efetch
+
+    def report(self):
+        NCBI_REQUESTS_PER_QUESTION.observe(self.requests)
+        print(f"NCBI requests: {self.requests} ({self.esearch} esearch, {self.efetch} efetch); "
+              f"cached: {self.esearch_cached} searches, {self.records_cached} records; fetched {self.records_fetched} records")
+
+
+def get_search(query, stats=None):
+    """
+    Returns the cached PMIDs of an esearch query string, or None.
+    """
+    with _search_cache_lock:
+        pmids = _search_cache.get(query)
+    PUBMED_CACHE.inc(level="esearch", result="miss" if pmids is None else "hit")
+    if pmids is not None and stats is not None:
+        stats.esearch_cached += 1
+    return None if pmids is None else list(pmids)
+
+
+def put_search(query, pmids):
+    with _search_cache_lock:
+        _search_cache[query] = tuple(pmids)
+
+
+def split_articles(xml):
+    """
+    Splits an efetch response into single articles.
+
+    Parameters:
+    - xml (bytes): A PubmedArticleSet XML document.
+
+    Returns:
+    - articles (dict): PMID mapped to the XML of its <PubmedArticle> element.
+    """
+    if isinstance(xml, str):
+        xml = xml.encode()
+    articles = {}
+    for match in ARTICLE_PATTERN.finditer(xml):
+        article = match.group(0)
+        # The first PMID of an article is the MedlineCitation PMID; later ones are references
+        pmid = PMID_PATTERN.search(article)
+        if pmid:
+            articles[pmid.group(1).decode()] = article
+    return articles
+
+
+def load_records(storage, pmids):
+    """
+    Loads stored records that are younger than PUBMED_RECORD_TTL.
+
+    Parameters:
+    - storage (Storage): Storage backend holding the pubmed_record table.
+    - pmids (list): PMIDs to look up.
+
+    Returns:
+    - records (dict): PMID mapped to its article XML. Missing and expired PMIDs are left out.
+    """
+    if not pmids:
+        return {}
+    try:
+        rows = storage.select_pubmed_records([str(pmid) for pmid in pmids], time.time() - PUBMED_RECORD_TTL)
+    except Exception as e:
+        logging.warning("Could not load stored PubMed records: %s", e)
+        rows = []
+    records = {pmid: decompress_text(record).encode() for pmid, record in rows}
+    PUBMED_CACHE.inc(len(records), level="record", result="hit")
+    PUBMED_CACHE.inc(len(pmids) - len(records), level="record", result="miss")
+    return records
+
+
+def save_records(storage, articles):
+    """
+    Stores freshly fetched records, replacing older copies.
+
+    Parameters:
+    - storage (Storage): Storage backend holding the pubmed_record table.
+    - articles (dict): PMID mapped to article XML, as returned by split_articles.
+    """
+    now = time.time()
+    rows = [(pmid, compress_text(article.decode()), now) for pmid, article in articles.items()]
+    try:
+        storage.write_pubmed_records(rows)
+    except Exception as e:
+        logging.warning("Could not store PubMed records: %s", e)
+
+
+def parse_records(records):
+    """
+    Parses stored records into PubMedArticle records.
+
+    Parameters:
+    - records (dict): PMID mapped to article XML.
+
+    Returns:
+    - articles (dict): PMID mapped to its PubMedArticle.
+    """
+    document = SET_OPEN + b"".join(records.values()) + SET_CLOSE
+    return {article.pmid: article for article in parse_articles(document)}
@@ -0,0 +1,506 @@
+"""
+Local PubMed mirror for offline retrieval.
+
+PubMed baseline and update files (https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/, pubmed*.xml.gz) are loaded into a
+SQLite database with an FTS5 index over title, abstract, MeSH headings and publication types:
+
+    python pubmed_mirror.py ingest pubmed25n0001.xml.gz pubmed25n0002.xml.gz ...
+    python pubmed_mirror.py search '(resveratrol OR "trans-3,5,4'"'"'-trihydroxystilbene") AND human'
+
+Files are ingested in the given order, so update files must come after the baseline; DeleteCitation entries remove
+articles. Each article is kept as its raw <PubmedArticle> XML, like the records of pubmed_cache.py, so search results
+parse into the same records as a live efetch.
+
+The boolean queries of query_generation are translated into FTS5 queries (see translate_query). Results are ranked
+by BM25, which stands in for PubMed's relevance sort, so the top 10 can differ from a live search.
+
+Configuration (env):
+- PUBMED_SOURCE: live (default), mirror, or mirror_then_live, which falls back to E-utilities for queries the mirror
+  returns nothing for and for PMIDs it does not hold. Checked at startup (see check_source): any other value, or a
+  mirror that cannot be opened in mirror mode, stops the server.
+- PUBMED_MIRROR_PATH: mirror database file (default pubmed_mirror.sqlite3).
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import metrics
+from storage import compress_text, decompress_text
+
+PUBMED_SOURCE = os.getenv('PUBMED_SOURCE', 'live')
+PUBMED_MIRROR_PATH = os.getenv('PUBMED_MIRROR_PATH', 'pubmed_mirror.sqlite3')
+PUBMED_SOURCES = ('live', 'mirror', 'mirror_then_live')
+
+MIRROR_SEARCHES = metrics.counter("dietnerd_pubmed_mirror_searches_total", "Searches answered by the local PubMed mirror, by whether they found articles.", ("result",))
+MIRROR_SEARCH_LATENCY = metrics.histogram("dietnerd_pubmed_mirror_search_seconds", "Latency of a search against the local PubMed mirror.",
+                                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+# PubMed field tags mapped to the FTS5 columns they search
+FIELD_COLUMNS = {
+    "title/abstract": "title abstract", "tiab": "title abstract",
+    "title": "title", "ti": "title",
+    "abstract": "abstract", "ab": "abstract",
+    "mesh terms": "mesh", "mesh": "mesh", "mh": "mesh", "majr": "mesh", "mesh major topic": "mesh",
+    "publication type": "publication_type", "pt": "publication_type",
+    "all fields": None, "all": None, "text word": None, "tw": None,
+}
+DATE_FIELDS = {"publication date", "dp", "pdat", "date - publication"}
+BOOLEAN_OPERATORS = {"AND", "OR", "NOT"}
+TOKEN_PATTERN = re.compile(r'\s*(?:(?P<paren>[()])|"(?P<phrase>[^"]*)"(?P<pwild>\*)?|(?P<word>[^\s()"\[]+))\s*(?:\[(?P<field>[^\]]*)\])?')
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if not match or match.end() == position:
+            raise QueryError(f"Cannot parse query at: {query[position:]!r}")
+        position = match.end()
+        field = match.group("field").strip().lower() if match.group("field") else None
+        if match.group("paren"):
+            tokens.append(("paren", match.group("paren"), field, False))
+        elif match.group("phrase") is not None:
+            tokens.append(("term", match.group("phrase") + (match.group("pwild") or ""), field, True))
+        elif match.group("word") in BOOLEAN_OPERATORS and field is None:
+            tokens.append(("op", match.group("word"), None, False))
+        else:
+            # PubMed reads unquoted words before a field tag as one phrase, e.g. vitamin d[tiab]
+            words = [match.group("word")]
+            while field is not None and tokens and tokens[-1][0] == "term" and tokens[-1][2] is None and not tokens[-1][3]:
+                words.insert(0, tokens.pop()[1])
+            tokens.append(("term", " ".join(words), field, False))
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive-descent parser for PubMed boolean queries. PubMed evaluates operators left to right with no precedence,
+    and adjacent terms without an operator are ANDed.
+
+    Nodes: ("term", text, field, quoted), ("and" | "or" | "not", left, right).
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def parse(self):
+        node = self.expression()
+        if self.peek() is not None:
+            raise QueryError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def expression(self):
+        node = self.operand()
+        while True:
+            token = self.peek()
+            if token is None or token[:2] == ("paren", ")"):
+                return node
+            if token[0] == "op":
+                self.position += 1
+                node = (token[1].lower(), node, self.operand())
+            else:
+                node = ("and", node, self.operand())
+
+    def operand(self):
+        token = self.peek()
+        if token is None:
+            raise QueryError("Unexpected end of query")
+        self.position += 1
+        if token[:2] == ("paren", "("):
+            node = self.expression()
+            if self.peek() is None or self.peek()[:2] != ("paren", ")"):
+                raise QueryError("Unbalanced parentheses")
+            self.position += 1
+            return node
+        if token[0] != "term":
+            raise QueryError(f"Unexpected {token[1]!r}")
+        return token
+
+
+def _fts_term(text, field):
+    """
+    Returns the FTS5 expression of one term, or None if it cannot be searched in the index and should match everything.
+    """
+    if field in DATE_FIELDS:
+        return None
+    prefix = text.endswith("*")
+    words = text.rstrip("*").strip()
+    if not re.search(r"\w", words):
+        return None
+    phrase = '"' + words.replace('"', '""') + '"' + (" *" if prefix else "")
+    if field is None or field not in FIELD_COLUMNS:
+        # Untagged terms (and tags the mirror does not index) search every column, like PubMed's All Fields
+        return phrase
+    columns = FIELD_COLUMNS[field]
+    return phrase if columns is None else "{" + columns + "} : " + phrase
+
+
+def _compile(node):
+    kind = node[0]
+    if kind == "term":
+        return _fts_term(node[1], node[2])
+    left, right = _compile(node[1]), _compile(node[2])
+    if kind == "and":
+        if left is None or right is None:
+            return left if right is None else right
+        return f"({left} AND {right})"
+    if kind == "or":
+        # A term that matches everything makes the whole OR match everything
+        if left is None or right is None:
+            return None
+        return f"({left} OR {right})"
+    if right is None:
+        return left
+    # FTS5 has no unary NOT, so "everything NOT x" is not expressible; drop the exclusion
+    return None if left is None else f"({left} NOT {right})"
+
+
+def _year_range(node):
+    """
+    Returns the (first, last) publication years of a date term, or None.
+    """
+    if node[0] != "term" or node[2] not in DATE_FIELDS:
+        return None
+    years = re.findall(r"\d{4}", node[1])
+    if not years:
+        return None
+    return (int(years[0]), int(years[-1]) if len(years) > 1 else 9999 if ":" in node[1] else int(years[0]))
+
+
+def _top_level_terms(node):
+    if node[0] == "and":
+        return _top_level_terms(node[1]) + _top_level_terms(node[2])
+    return [node]
+
+
+def translate_query(query):
+    """
+    Translates a PubMed boolean query into an FTS5 match expression.
+
+    Supports AND, OR, NOT, parentheses, quoted phrases, trailing * wildcards and the field tags in FIELD_COLUMNS.
+    Date ranges ([Publication Date], [dp]) are applied as a publication year filter when they are ANDed at the top
+    level of the query; other date terms such as "recent"[Publication Date] and unknown tags are relaxed to match
+    everything.
+
+    Parameters:
+    - query (str): A PubMed query, as generated by query_generation.
+
+    Returns:
+    - match (str): FTS5 match expression, or None if the query puts no constraint on the text.
+    - years (tuple): (first, last) publication year, or None.
+    """
+    tree = _Parser(_tokenize(query)).parse()
+    years = None
+    for node in _top_level_terms(tree):
+        year_range = _year_range(node)
+        if year_range is not None:
+            years = year_range if years is None else (max(years[0], year_range[0]), min(years[1], year_range[1]))
+    return _compile(tree), years
+
+
+def _text(element):
+    return "".join(element.itertext()).strip() if element is not None else ""
+
+
+def _publication_year(citation):
+    pub_date = citation.find("Article/Journal/JournalIssue/PubDate")
+    if pub_date is None:
+        return None
+    year = pub_date.findtext("Year") or pub_date.findtext("MedlineDate") or ""
+    match = re.search(r"\d{4}", year)
+    return int(match.group(0)) if match else None
+
+
+class PubMedMirror:
+    """
+    SQLite store of PubMed articles with an FTS5 index.
+
+    Tables:
+    - source_file (file_id PRIMARY KEY, name UNIQUE, articles, ingested_at): ingested files.
+    - article (pmid PRIMARY KEY, file_id, year, record): zlib-compressed <PubmedArticle> XML.
+    - article_fts (title, abstract, mesh, publication_type): FTS5 index, rowid = PMID.
+
+    Parameters:
+    - path (str): Database file.
+    """
+
+    def __init__(self, path=PUBMED_MIRROR_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS source_file (
+                                     file_id INTEGER PRIMARY KEY,
+                                     name TEXT NOT NULL UNIQUE,
+                                     articles INTEGER NOT NULL DEFAULT 0,
+                                     ingested_at REAL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS article (
+                                     pmid INTEGER PRIMARY KEY,
+                                     file_id INTEGER NOT NULL,
+                                     year INTEGER,
+                                     record BLOB NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS article_year ON article (year)")
+            connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS article_fts USING fts5(
+                                     title, abstract, mesh, publication_type, tokenize = 'porter unicode61')""")
+
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM article").fetchone()[0]
+
+    def ingested_files(self):
+        return {name for name, in self.connection().execute("SELECT name FROM source_file WHERE ingested_at IS NOT NULL")}
+
+    def ingest(self, path, batch_size=2000, force=False):
+        """
+        Loads one PubMed baseline or update file. Files that were ingested before are skipped unless force is set.
+
+        Parameters:
+        - path (str): A pubmed*.xml or pubmed*.xml.gz file.
+        - batch_size (int): Articles written per transaction.
+        - force (bool): Ingest the file again.
+
+        Returns:
+        - stats (dict): Articles added or replaced, citations deleted, and seconds taken.
+        """
+        name = os.path.basename(path)
+        if not force and name in self.ingested_files():
+            print(f"Skipping {name}: already ingested")
+            return {"articles": 0, "deleted": 0, "seconds": 0.0}
+
+        start = time.perf_counter()
+        connection = self.connection()
+        with connection:
+            connection.execute("INSERT INTO source_file (name) VALUES (?) ON CONFLICT(name) DO NOTHING", (name,))
+        file_id = connection.execute("SELECT file_id FROM source_file WHERE name = ?", (name,)).fetchone()[0]
+
+        articles = deleted = 0
+        batch = []
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            context = ET.iterparse(f, events=("start", "end"))
+            _, root = next(context)
+            for event, element in context:
+                if event != "end":
+                    continue
+                if element.tag == "PubmedArticle":
+                    row = self._article_row(element, file_id)
+                    if row is not None:
+                        batch.append(row)
+                    root.clear()
+                    if len(batch) >= batch_size:
+                        articles += self._write(batch)
+                        batch = []
+                elif element.tag == "DeleteCitation":
+                    articles += self._write(batch)
+                    batch = []
+                    deleted += self._delete([int(_text(pmid)) for pmid in element.iter("PMID")])
+                    root.clear()
+        articles += self._write(batch)
+
+        with connection:
+            connection.execute("UPDATE source_file SET articles = ?, ingested_at = ? WHERE file_id = ?", (articles, time.time(), file_id))
+        seconds = time.perf_counter() - start
+        print(f"Ingested {name}: {articles} articles, {deleted} deleted in {seconds:.1f}s ({articles / max(seconds, 1e-9):.0f} articles/s)")
+        return {"articles": articles, "deleted": deleted, "seconds": seconds}
+
+    @staticmethod
+    def _article_row(element, file_id):
+        citation = element.find("MedlineCitation")
+        if citation is None or citation.find("PMID") is None:
+            return None
+        pmid = int(_text(citation.find("PMID")))
+        abstract = " ".join(_text(part) for part in citation.iterfind("Article/Abstract/AbstractText"))
+        mesh = "; ".join(_text(heading) for heading in citation.iterfind("MeshHeadingList/MeshHeading/DescriptorName"))
+        publication_types = "; ".join(_text(kind) for kind in citation.iterfind("Article/PublicationTypeList/PublicationType"))
+        record = compress_text(ET.tostring(element, encoding="unicode"))
+        return pmid, file_id, _publication_year(citation), record, _text(citation.find("Article/ArticleTitle")), abstract, mesh, publication_types
+
+    def _write(self, rows):
+        if not rows:
+            return 0
+        pmids = [(row[0],) for row in rows]
+        with self.connection() as connection:
+            connection.executemany("DELETE FROM article_fts WHERE rowid = ?", pmids)
+            connection.executemany("INSERT OR REPLACE INTO article (pmid, file_id, year, record) VALUES (?, ?, ?, ?)", [row[:4] for row in rows])
+            connection.executemany("INSERT INTO article_fts (rowid, title, abstract, mesh, publication_type) VALUES (?, ?, ?, ?, ?)",
+                                   [(row[0],) + row[4:] for row in rows])
+        return len(rows)
+
+    def _delete(self, pmids):
+        if not pmids:
+            return 0
+        rows = [(pmid,) for pmid in pmids]
+        with self.connection() as connection:
+            connection.executemany("DELETE FROM article_fts WHERE rowid = ?", rows)
+            deleted = connection.executemany("DELETE FROM article WHERE pmid = ?", rows).rowcount
+        return deleted
+
+    def search(self, query, retmax=10):
+        """
+        Answers a PubMed query from the mirror.
+
+        Parameters:
+        - query (str): A PubMed boolean query.
+        - retmax (int): Maximum number of PMIDs returned.
+
+        Returns:
+        - pmids (list): PMIDs as strings, best BM25 match first. Empty if the query cannot be parsed or puts no
+          constraint on the text.
+        """
+        start = time.perf_counter()
+        try:
+            match, years = translate_query(query)
+        except QueryError as e:
+            logging.warning("Cannot translate query %r for the PubMed mirror: %s", query, e)
+            match, years = None, None
+        pmids = []
+        if match is not None:
+            sql = "SELECT article_fts.rowid FROM article_fts JOIN article ON article.pmid = article_fts.rowid WHERE article_fts MATCH ?"
+            params = [match]
+            if years is not None:
+                sql += " AND article.year BETWEEN ? AND ?"
+                params += list(years)
+            sql += " ORDER BY bm25(article_fts, 10.0, 1.0, 5.0, 1.0) LIMIT ?"
+            try:
+                pmids = [str(pmid) for pmid, in self.connection().execute(sql, params + [retmax])]
+            except sqlite3.OperationalError as e:
+                logging.warning("PubMed mirror rejected %r (from %r): %s", match, query, e)
+        MIRROR_SEARCHES.inc(result="found" if pmids else "empty")
+        MIRROR_SEARCH_LATENCY.observe(time.perf_counter() - start)
+        return pmids
+
+    def records(self, pmids):
+        """
+        Parameters:
+        - pmids (list): PMIDs to look up.
+
+        Returns:
+        - records (dict): PMID mapped to article XML, as used by pubmed_cache.parse_records.
+          PMIDs the mirror does not hold are left out.
+        """
+        records = {}
+        pmids = [int(pmid) for pmid in pmids]
+        for i in range(0, len(pmids), 500):
+            chunk = pmids[i:i + 500]
+            placeholders = ", ".join(["?"] * len(chunk))
+            rows = self.connection().execute(f"SELECT pmid, record FROM article WHERE pmid IN ({placeholders})", chunk)
+            for pmid, record in rows:
+                records[str(pmid)] = decompress_text(record).encode()
+        return records
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+class MirrorUnavailableError(RuntimeError):
+    pass
+
+
+def open_mirror(path=PUBMED_MIRROR_PATH):
+    """
+    Opens an existing mirror.
+
+    Raises:
+    - MirrorUnavailableError: If the file does not exist or is not a mirror database.
+    """
+    if not os.path.exists(path):
+        raise MirrorUnavailableError(f"The PubMed mirror {path} does not exist")
+    try:
+        mirror = PubMedMirror(path)
+        mirror.connection().execute("SELECT 1 FROM article_fts LIMIT 1").fetchall()
+    except sqlite3.Error as e:
+        raise MirrorUnavailableError(f"Cannot open the PubMed mirror {path}: {e}") from e
+    return mirror
+
+
+def get_mirror():
+    """
+    Returns the shared mirror, or None if PUBMED_SOURCE is live, or is mirror_then_live and the mirror cannot be opened.
+
+    Raises:
+    - MirrorUnavailableError: If PUBMED_SOURCE is mirror and the mirror cannot be opened, as retrieval must not go live.
+    """
+    global _mirror
+    if PUBMED_SOURCE == 'live':
+        return None
+    if _mirror is None:
+        with _mirror_lock:
+            if _mirror is None:
+                try:
+                    _mirror = open_mirror(PUBMED_MIRROR_PATH)
+                except MirrorUnavailableError as e:
+                    if not live_fallback():
+                        raise
+                    logging.warning("PUBMED_SOURCE is %s, falling back to E-utilities: %s", PUBMED_SOURCE, e)
+                    return None
+    return _mirror
+
+
+def check_source():
+    """
+    Checks PUBMED_SOURCE at startup and opens the mirror it uses.
+
+    Raises:
+    - ValueError: If PUBMED_SOURCE is not one of PUBMED_SOURCES.
+    - MirrorUnavailableError: If PUBMED_SOURCE is mirror and the mirror cannot be opened.
+    """
+    if PUBMED_SOURCE not in PUBMED_SOURCES:
+        raise ValueError(f"Unknown PUBMED_SOURCE: {PUBMED_SOURCE} (expected one of {', '.join(PUBMED_SOURCES)})")
+    get_mirror()
+
+
+def live_fallback():
+    """
+    Returns True if E-utilities may be used, i.e. PUBMED_SOURCE is live or mirror_then_live.
+    """
+    return PUBMED_SOURCE != 'mirror'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load PubMed baseline/update files into the local mirror, or search it.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest = subparsers.add_parser("ingest")
+    ingest.add_argument("files", nargs="+")
+    ingest.add_argument("--force", action="store_true", help="ingest files again")
+    search = subparsers.add_parser("search")
+    search.add_argument("query")
+    search.add_argument("--retmax", type=int, default=10)
+    parser.add_argument("--path", default=PUBMED_MIRROR_PATH)
+    args = parser.parse_args()
+
+    mirror = PubMedMirror(args.path)
+    if args.command == "ingest":
+        total = sum(mirror.ingest(path, force=args.force)["articles"] for path in args.files)
+        print(f"{total} articles written; the mirror holds {mirror.count()} articles")
+    else:
+        print(f"FTS5 query: {translate_query(args.query)}")
+        for pmid in mirror.search(args.query, args.retmax):
+            print(pmid)
+
+
+if __name__ == "__main__":
+    main()
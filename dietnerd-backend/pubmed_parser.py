@@ -0,0 +1,151 @@
+"""
+Streaming parser for PubMed efetch XML.
+
+Entrez.read builds a full DictElement/StringElement tree for every record, validated against the DTD, and the
+pipeline only uses a handful of its fields. parse_articles walks the XML with ElementTree.iterparse instead, frees
+each <PubmedArticle> once it is read, and emits a compact PubMedArticle record holding exactly what the pipeline
+uses: the abstract is reconstructed once, and the citation fields are kept for generate_ama_citation.
+
+    with open("efetch.xml", "rb") as f:
+        for article in parse_articles(f):
+            print(article.pmid, article.title)
+"""
+import io
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class PubMedArticle:
+    """
+    One PubMed article, as used by relevance classification and article processing.
+
+    Attributes:
+    - pmid (str): PubMed ID.
+    - title (str): Article title.
+    - abstract (str): Abstract sections joined by blank lines, each preceded by "<Label>:" if it has a label. Empty if the article has no abstract.
+    - publication_types (tuple): Publication types, e.g. ("Journal Article", "Randomized Controlled Trial").
+    - mesh (tuple): MeSH descriptor names.
+    - pmcid (str): PubMed Central ID, or None.
+    - doi (str): DOI from the article IDs, or from the DOI ELocationID, or None.
+    - pii (str): Publisher item identifier, or None.
+    - authors (tuple): (last name, initials) per author; either is None for collective authors.
+    - journal (str): Journal title.
+    - pub_year, pub_month, pub_day (str): Journal issue publication date parts, or None.
+    - volume, issue, pages (str): Citation fields, or "".
+    """
+    pmid: str
+    title: str = ""
+    abstract: str = ""
+    publication_types: tuple = ()
+    mesh: tuple = ()
+    pmcid: str = None
+    doi: str = None
+    pii: str = None
+    authors: tuple = ()
+    journal: str = ""
+    pub_year: str = None
+    pub_month: str = None
+    pub_day: str = None
+    volume: str = ""
+    issue: str = ""
+    pages: str = ""
+
+    @property
+    def url(self):
+        return f"https://pubmed.ncbi.nlm.nih.gov/{self.pmid}/"
+
+
+def _text(element):
+    return "".join(element.itertext()).strip() if element is not None else ""
+
+
+def _optional_text(element):
+    return _text(element) if element is not None else None
+
+
+def reconstruct_abstract(abstract_texts):
+    """
+    Joins <AbstractText> elements into one string, labelling structured abstract sections.
+
+    Parameters:
+    - abstract_texts (list): AbstractText elements.
+
+    Returns:
+    - abstract (str): The reconstructed abstract.
+    """
+    reconstructed_abstract = ""
+    for element in abstract_texts:
+        label = element.get("Label", "")
+        if reconstructed_abstract:
+            reconstructed_abstract += "\n\n"
+        if label:
+            reconstructed_abstract += f"{label}:\n"
+        reconstructed_abstract += _text(element)
+    return reconstructed_abstract
+
+
+def article_from_element(element):
+    """
+    Builds the record of one <PubmedArticle> element.
+
+    Returns:
+    - article (PubMedArticle): The record, or None if the element has no PMID.
+    """
+    citation = element.find("MedlineCitation")
+    if citation is None or citation.find("PMID") is None:
+        return None
+    article = citation.find("Article")
+    if article is None:
+        article = ET.Element("Article")
+    journal_issue = article.find("Journal/JournalIssue")
+    pub_date = journal_issue.find("PubDate") if journal_issue is not None else None
+
+    ids = {article_id.get("IdType"): _text(article_id) for article_id in element.iterfind("PubmedData/ArticleIdList/ArticleId")}
+    elocation_doi = next((_text(elocation) for elocation in article.iterfind("ELocationID") if elocation.get("EIdType") == "doi"), None)
+
+    return PubMedArticle(
+        pmid=_text(citation.find("PMID")),
+        title=_text(article.find("ArticleTitle")),
+        abstract=reconstruct_abstract(article.findall("Abstract/AbstractText")),
+        publication_types=tuple(_text(kind) for kind in article.iterfind("PublicationTypeList/PublicationType")),
+        mesh=tuple(_text(heading) for heading in citation.iterfind("MeshHeadingList/MeshHeading/DescriptorName")),
+        pmcid=ids.get("pmc"),
+        doi=ids.get("doi") or elocation_doi,
+        pii=ids.get("pii"),
+        authors=tuple((_optional_text(author.find("LastName")), _optional_text(author.find("Initials"))) for author in article.iterfind("AuthorList/Author")),
+        journal=_text(article.find("Journal/Title")),
+        pub_year=_optional_text(pub_date.find("Year")) if pub_date is not None else None,
+        pub_month=_optional_text(pub_date.find("Month")) if pub_date is not None else None,
+        pub_day=_optional_text(pub_date.find("Day")) if pub_date is not None else None,
+        volume=_text(journal_issue.find("Volume")) if journal_issue is not None else "",
+        issue=_text(journal_issue.find("Issue")) if journal_issue is not None else "",
+        pages=_text(article.find("Pagination/MedlinePgn")),
+    )
+
+
+def parse_articles(source):
+    """
+    Parses an efetch response or PubMed XML file incrementally.
+
+    Parameters:
+    - source (bytes | str | file): XML document, or a binary file-like object.
+
+    Yields:
+    - article (PubMedArticle): One record per <PubmedArticle>, in document order.
+    """
+    if isinstance(source, str):
+        source = source.encode()
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    context = ET.iterparse(source, events=("start", "end"))
+    root = None
+    for event, element in context:
+        if root is None:
+            root = element
+            continue
+        if event == "end" and element.tag == "PubmedArticle":
+            article = article_from_element(element)
+            root.clear()
+            if article is not None:
+                yield article
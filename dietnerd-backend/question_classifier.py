@@ -0,0 +1,372 @@
+"""
+Local fast path for the question validity check.
+
+`determine_question_validity` asks gpt-4-turbo whether a question is answerable ("True"), a recipe or meal plan request
+("False - Recipe") or about an animal ("False - Animal"), and almost every question is "True". A TF-IDF + logistic
+regression model trained on earlier LLM verdicts answers most checks locally in well under a millisecond. The LLM is
+only called when the model's confidence is below QUESTION_CLASSIFIER_THRESHOLD, and every LLM verdict is stored in
+the question_verdict table so the model can be retrained offline:
+
+    python question_classifier.py train
+
+The model file is reloaded automatically when it changes. Without a model file every check goes to the LLM.
+
+A logistic regression is confident about questions it knows nothing about: with no known terms the score is the
+intercept alone, i.e. the class prior, and almost every training question is "True". So the local answer is only
+used when most of the question's words are in the model's vocabulary, and the probabilities are calibrated with a
+temperature fitted on out-of-fold predictions at training time. `train` refuses to save a model until every label
+has QUESTION_CLASSIFIER_MIN_EXAMPLES examples; the shipped seed data alone (the gold-standard questions plus the
+prompt's few-shot examples) is not enough.
+
+Configuration (env):
+- QUESTION_CLASSIFIER_PATH: model file (default question_classifier.joblib).
+- QUESTION_CLASSIFIER_THRESHOLD: minimum predicted probability to answer locally (default 0.9).
+- QUESTION_CLASSIFIER_MIN_COVERAGE: minimum share of the question's words the model knows to answer locally (default 0.8).
+- QUESTION_CLASSIFIER_MIN_EXAMPLES: examples of each label needed to train a model (default 30).
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+QUESTION_CLASSIFIER_PATH = os.getenv('QUESTION_CLASSIFIER_PATH', 'question_classifier.joblib')
+QUESTION_CLASSIFIER_THRESHOLD = float(os.getenv('QUESTION_CLASSIFIER_THRESHOLD', 0.9))
+QUESTION_CLASSIFIER_MIN_COVERAGE = float(os.getenv('QUESTION_CLASSIFIER_MIN_COVERAGE', 0.8))
+QUESTION_CLASSIFIER_MIN_EXAMPLES = int(os.getenv('QUESTION_CLASSIFIER_MIN_EXAMPLES', 30))
+LABELS = ("True", "False - Recipe", "False - Animal")
+GOLD_STANDARD_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evaluation-datasets', 'automated_evaluatio_gold_standard_benchmark.csv')
+
+VALIDITY_CHECKS = metrics.counter("dietnerd_validity_checks_total", "Question validity checks, by where they were answered.", ("source",))
+VALIDITY_LATENCY = metrics.histogram("dietnerd_validity_check_seconds", "Latency of the question validity check.", ("source",))
+VALIDITY_SECONDS_SAVED = metrics.counter("dietnerd_validity_llm_seconds_saved_total", "Estimated LLM latency avoided by answering validity checks locally.")
+VALIDITY_LOCAL_SHARE = metrics.gauge("dietnerd_validity_local_share", "Share of validity checks answered by the local classifier.")
+
+# The few-shot examples of the LLM prompt, so a fresh model knows every label
+SEED_EXAMPLES = [
+    ("Can you help me create a weekly meal plan that includes balanced nutrients for a vegetarian diet?", "False - Recipe"),
+    ("How do I make a low-carb lasagna?", "False - Recipe"),
+    ("What are some ideas for healthy snacks I can prepare for my kids?", "True"),
+    ("What are some meals for someone with diabetes?", "True"),
+    ("What are the health benefits of intermittent fasting?", "True"),
+    ("What is the best diet for my cat?", "False - Animal"),
+    ("Can dogs eat raw meat?", "False - Animal"),
+]
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+def normalize_label(label):
+    """
+    Maps an LLM response onto one of the three labels, or None if it is not one of them.
+    """
+    label = label.strip().strip('"').strip()
+    for known in LABELS:
+        if label.lower() == known.lower():
+            return known
+    return None
+
+
+def load_seed_questions(path=GOLD_STANDARD_CSV):
+    """
+    Loads the questions of the gold-standard benchmark, which are all answerable.
+
+    Returns:
+    - examples (list): List of (question, "True") tuples, empty if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return []
+    import pandas as pd
+    questions = pd.read_csv(path)['QUESTION'].dropna().unique()
+    return [(question, "True") for question in questions]
+
+
+def new_model():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    return make_pipeline(
+        TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1),
+        LogisticRegression(C=10, class_weight='balanced', max_iter=1000))
+
+
+def softmax(scores, temperature=1.0):
+    """
+    Turns decision scores (one row per question, or one value per question for two classes) into probabilities.
+    """
+    import numpy as np
+    scores = np.asarray(scores, dtype=float) / temperature
+    if scores.ndim == 1:
+        positive = 1 / (1 + np.exp(-scores))
+        return np.column_stack([1 - positive, positive])
+    scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    return scores / scores.sum(axis=1, keepdims=True)
+
+
+def fit_temperature(questions, labels, folds=5):
+    """
+    Fits the temperature that minimizes the log loss of out-of-fold predictions, or returns 1 with too few examples.
+    """
+    import numpy as np
+    from sklearn.model_selection import StratifiedKFold, cross_val_predict
+
+    folds = min(folds, min(labels.count(label) for label in set(labels)))
+    if folds < 2:
+        return 1.0
+    scores = cross_val_predict(new_model(), questions, labels, method='decision_function',
+                               cv=StratifiedKFold(n_splits=folds, shuffle=True, random_state=0))
+    classes = sorted(set(labels))
+    truth = np.array([classes.index(label) for label in labels])
+
+    def log_loss(temperature):
+        probabilities = softmax(scores, temperature)[np.arange(len(truth)), truth]
+        return -np.log(np.clip(probabilities, 1e-12, 1)).mean()
+
+    return float(min(np.exp(np.linspace(np.log(0.25), np.log(20), 60)), key=log_loss))
+
+
+def train(examples, min_examples=QUESTION_CLASSIFIER_MIN_EXAMPLES):
+    """
+    Fits the classifier and calibrates its probabilities.
+
+    Parameters:
+    - examples (list): List of (question, label) tuples.
+    - min_examples (int): Examples of each label in LABELS needed to train.
+
+    Returns:
+    - model (Pipeline): Fitted TF-IDF + logistic regression pipeline, with the fitted temperature as `temperature_`.
+
+    Raises:
+    - ValueError: If a label has fewer than min_examples examples.
+    """
+    questions = [normalize_question(question) for question, label in examples]
+    labels = [label for question, label in examples]
+    missing = {label: labels.count(label) for label in LABELS if labels.count(label) < min_examples}
+    if missing:
+        raise ValueError(f"Not enough examples to train (need {min_examples} per label): {missing}")
+    model = new_model()
+    model.fit(questions, labels)
+    model.temperature_ = fit_temperature(questions, labels)
+    return model
+
+
+class CompiledModel:
+    """
+    Scores one question with the weights of a fitted pipeline, without sklearn's per-call input validation, which costs
+    over a millisecond for a single question. Gives the probabilities of model.predict_proba with the model's
+    calibration temperature applied.
+
+    Parameters:
+    - model (Pipeline): Fitted TF-IDF + logistic regression pipeline, as built by train.
+    """
+
+    def __init__(self, model):
+        import numpy as np
+        vectorizer, regression = model.steps[0][1], model.steps[-1][1]
+        self.classes_ = regression.classes_
+        self._analyzer = vectorizer.build_analyzer()
+        self._sublinear_tf = vectorizer.sublinear_tf
+        # Per term: its idf and its column of class weights
+        self._terms = {term: (vectorizer.idf_[index], regression.coef_[:, index]) for term, index in vectorizer.vocabulary_.items()}
+        self._intercept = regression.intercept_
+        self._temperature = getattr(model, 'temperature_', 1.0)
+        self._np = np
+
+    def coverage(self, question):
+        """
+        Returns the share of the question's words that are in the model's vocabulary.
+        """
+        words = [term for term in self._analyzer(question) if " " not in term]
+        return sum(word in self._terms for word in words) / len(words) if words else 0.0
+
+    def predict_proba(self, question):
+        np = self._np
+        counts = {}
+        for term in self._analyzer(question):
+            if term in self._terms:
+                counts[term] = counts.get(term, 0) + 1
+        scores = self._intercept.copy()
+        if counts:
+            weights = {term: ((1 + np.log(count)) if self._sublinear_tf else count) * self._terms[term][0] for term, count in counts.items()}
+            norm = np.sqrt(sum(weight * weight for weight in weights.values()))
+            for term, weight in weights.items():
+                scores = scores + (weight / norm) * self._terms[term][1]
+        if len(scores) == 1:
+            return softmax(scores, self._temperature)[0]
+        return softmax(scores[np.newaxis, :], self._temperature)[0]
+
+
+class QuestionClassifier:
+    """
+    Wraps a fitted model and reloads it when the model file changes.
+
+    Parameters:
+    - path (str): Model file written by `python question_classifier.py train`.
+    - threshold (float): Minimum predicted probability to answer locally.
+    - min_coverage (float): Minimum share of the question's words the model knows to answer locally.
+    """
+
+    def __init__(self, path=QUESTION_CLASSIFIER_PATH, threshold=QUESTION_CLASSIFIER_THRESHOLD, min_coverage=QUESTION_CLASSIFIER_MIN_COVERAGE):
+        self.path = path
+        self.threshold = threshold
+        self.min_coverage = min_coverage
+        self._model = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def model(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    import joblib
+                    try:
+                        self._model = CompiledModel(joblib.load(self.path))
+                        logging.info("Loaded question classifier from %s", self.path)
+                    except Exception as e:
+                        logging.warning("Could not load question classifier from %s: %s", self.path, e)
+                        self._model = None
+                    self._mtime = mtime
+        return self._model
+
+    def predict(self, question):
+        """
+        Returns:
+        - label (str): The most likely label, or None if no model is available or the question is mostly unknown words.
+        - confidence (float): Its calibrated probability.
+        """
+        model = self.model()
+        if model is None:
+            return None, 0.0
+        return predict_with(model, normalize_question(question), self.min_coverage)
+
+
+def predict_with(model, question, min_coverage=QUESTION_CLASSIFIER_MIN_COVERAGE):
+    """
+    Returns the most likely label of a normalized question and its probability, or (None, 0.0) if too few of its
+    words are in the model's vocabulary for the probability to mean anything.
+    """
+    if model.coverage(question) < min_coverage:
+        return None, 0.0
+    probabilities = model.predict_proba(question)
+    best = probabilities.argmax()
+    return model.classes_[best], float(probabilities[best])
+
+
+classifier = QuestionClassifier()
+
+_stats_lock = threading.Lock()
+_average_llm_latency = None
+
+
+def _local_share():
+    local = VALIDITY_CHECKS.value(source="local")
+    total = local + VALIDITY_CHECKS.value(source="llm")
+    return local / total if total else 0.0
+
+
+VALIDITY_LOCAL_SHARE.set_function(_local_share)
+
+
+def check_question_validity(question, llm_check, storage=None):
+    """
+    Answers the validity check locally when the classifier is confident, and asks the LLM otherwise.
+
+    Parameters:
+    - question (str): The user's question.
+    - llm_check (function): The LLM check, normally determine_question_validity.
+    - storage (Storage): Where LLM verdicts are stored for retraining. Not stored if None.
+
+    Returns:
+    - question_validity (str): "True", "False - Recipe" or "False - Animal", as returned by determine_question_validity.
+    """
+    global _average_llm_latency
+    start = time.perf_counter()
+    label, confidence = classifier.predict(question)
+    if label is not None and confidence >= classifier.threshold:
+        VALIDITY_CHECKS.inc(source="local")
+        VALIDITY_LATENCY.observe(time.perf_counter() - start, source="local")
+        if _average_llm_latency is not None:
+            VALIDITY_SECONDS_SAVED.inc(_average_llm_latency)
+        return label
+
+    question_validity = llm_check(question)
+    elapsed = time.perf_counter() - start
+    VALIDITY_CHECKS.inc(source="llm")
+    VALIDITY_LATENCY.observe(elapsed, source="llm")
+    with _stats_lock:
+        _average_llm_latency = elapsed if _average_llm_latency is None else 0.9 * _average_llm_latency + 0.1 * elapsed
+    verdict = normalize_label(question_validity)
+    if storage is not None and verdict is not None:
+        try:
+            storage.record_verdict(question, verdict)
+        except Exception as e:
+            logging.warning("Could not store validity verdict: %s", e)
+    return question_validity
+
+
+def evaluate(examples, threshold, folds=5, min_coverage=QUESTION_CLASSIFIER_MIN_COVERAGE):
+    """
+    Cross-validates the classifier at the given threshold and vocabulary coverage, as check_question_validity uses it.
+
+    Returns:
+    - report (dict): Share of checks that would be answered locally and the accuracy of those local answers.
+    """
+    from sklearn.model_selection import StratifiedKFold
+
+    labels = [label for question, label in examples]
+    folds = min(folds, min(labels.count(label) for label in set(labels)))
+    if folds < 2:
+        return None
+    local = correct = 0
+    for train_index, test_index in StratifiedKFold(n_splits=folds, shuffle=True, random_state=0).split(examples, labels):
+        model = CompiledModel(train([examples[i] for i in train_index], min_examples=0))
+        for question, label in (examples[i] for i in test_index):
+            predicted, confidence = predict_with(model, normalize_question(question), min_coverage)
+            if predicted is not None and confidence >= threshold:
+                local += 1
+                correct += predicted == label
+    return {"local_share": local / len(examples), "local_accuracy": correct / local if local else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local question validity classifier from stored LLM verdicts.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--credentials", default="ATT81274.env")
+    parser.add_argument("--output", default=QUESTION_CLASSIFIER_PATH)
+    parser.add_argument("--seed-csv", default=GOLD_STANDARD_CSV)
+    parser.add_argument("--threshold", type=float, default=QUESTION_CLASSIFIER_THRESHOLD)
+    parser.add_argument("--min-examples", type=int, default=QUESTION_CLASSIFIER_MIN_EXAMPLES)
+    args = parser.parse_args()
+
+    from storage import get_storage
+    verdicts = get_storage(args.credentials).list_verdicts()
+    examples = SEED_EXAMPLES + load_seed_questions(args.seed_csv) + [(question, label) for question, label in verdicts]
+    counts = {label: sum(1 for example in examples if example[1] == label) for label in sorted({example[1] for example in examples})}
+    print(f"{len(examples)} examples ({len(verdicts)} stored verdicts): {counts}")
+
+    report = evaluate(examples, args.threshold)
+    if report is not None:
+        accuracy = "n/a" if report["local_accuracy"] is None else f"{report['local_accuracy']:.1%}"
+        print(f"cross-validated at threshold {args.threshold}: {report['local_share']:.1%} answered locally, {accuracy} of them correct")
+    if args.command == "train":
+        import joblib
+        try:
+            model = train(examples, args.min_examples)
+        except ValueError as e:
+            print(f"Not saving a model: {e}")
+            raise SystemExit(1)
+        joblib.dump(model, args.output)
+        print(f"Saved model to {args.output} (temperature {model.temperature_:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Incremental refresh of stored answers, so aging answers pick up new evidence without rerunning the whole pipeline.
+
+Stored answers in question_answer never change, and regenerating one with the pipeline reclassifies and
+resummarizes every article again. A refresh reruns only query generation and retrieval (esearch results expire after
+ESEARCH_CACHE_TTL, article records come from the pubmed_record cache) and diffs the retrieved PMIDs against the ones
+the answer already knows: its relevant articles and the articles settled when it was answered, i.e. classified
+irrelevant, matched or processed (screened_pmids, stored with answers since this job exists). Only the new PMIDs are classified, only the new
+relevant articles are matched against article_analysis or processed, and synthesis reruns only if that added evidence;
+otherwise just the answer's refresh time and screened PMIDs are updated. A refresh therefore costs two query
+generation calls plus work proportional to the number of new papers.
+
+Answers older than REFRESH_MAX_AGE_DAYS are refreshed oldest first, answers without a refresh time (written before
+it was stored) before all others. Each refresh is recorded by pipeline_metrics like a question, with the session id
+"refresh-<uuid>", and its LLM calls queue REFRESH_PRIORITY levels behind user calls in the gateway.
+
+Usage (from dietnerd-backend/):
+    python refresh.py --limit 20
+    python refresh.py --question "Is coffee healthy?"
+    python refresh.py --dry-run
+
+Configuration (env):
+- REFRESH_MAX_AGE_DAYS: age from which an answer is refreshed (default 30).
+- REFRESH_PRIORITY: priority levels added to the refresh's LLM calls (default 3).
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+
+import evidence_ranking
+import metrics
+import pipeline_metrics
+from helper_functions import (SYNTHESIS_CITATION_MODE, article_matching, build_output_record, collect_articles,
+                              concurrent_article_processing, concurrent_relevance_classification,
+                              connect_to_reliability_analysis_db, dict_to_tuple, env, generate_final_response,
+                              generate_final_response_structured, match_citations_with_articles, query_generation,
+                              split_end_output)
+from storage import ANSWER_FORMAT, get_storage
+
+REFRESH_MAX_AGE_DAYS = float(os.getenv('REFRESH_MAX_AGE_DAYS', 30))
+REFRESH_PRIORITY = int(os.getenv('REFRESH_PRIORITY', 3))
+
+REFRESH_ANSWERS = metrics.counter("dietnerd_refresh_answers_total", "Refreshed answers, by outcome (updated, unchanged, error).", ("outcome",))
+REFRESH_NEW_ARTICLES = metrics.histogram("dietnerd_refresh_new_articles", "Retrieved articles a refresh had not screened before, per answer.",
+                                         buckets=(0, 1, 2, 5, 10, 20, 30, 50))
+
+
+def refreshable(answer):
+    # Legacy answers embed their articles; migrate_question_answer.py converts them first
+    return answer.get('format') == ANSWER_FORMAT
+
+
+def aging_answers(storage, max_age_days=REFRESH_MAX_AGE_DAYS, now=None):
+    """
+    Returns the stored answers due for a refresh, oldest first.
+
+    Parameters:
+    - storage (Storage): Storage backend.
+    - max_age_days (float): Age from which an answer is refreshed.
+    - now (float): The current Unix time.
+
+    Returns:
+    - answers (list): (question, answer dictionary, answer id) tuples.
+    """
+    now = time.time() if now is None else now
+    due = []
+    for question, answer, answer_id in storage.iter_answers():
+        answer = json.loads(answer)
+        if not refreshable(answer):
+            continue
+        if now - (answer.get('answered_at') or 0) >= max_age_days * 86400:
+            due.append((question, answer, answer_id))
+    due.sort(key=lambda row: row[1].get('answered_at') or 0)
+    return due
+
+
+def load_articles(pmids):
+    """
+    Loads processed articles from article_analysis in the shape article_matching returns them.
+    """
+    reliability_analysis_df = connect_to_reliability_analysis_db(pmids)
+    reliability_analysis_df = reliability_analysis_df.astype(object).where(reliability_analysis_df.notnull(), None)
+    articles_by_pmid = {str(article['article_id']): article for article in reliability_analysis_df.to_dict(orient='records')}
+    return [articles_by_pmid[pmid] for pmid in pmids if pmid in articles_by_pmid]
+
+
+def refresh_answer(question, answer, answer_id, storage, dry_run=False):
+    """
+    Refreshes one stored answer with the articles retrieved since it was answered.
+
+    Parameters:
+    - question (str): The stored question.
+    - answer (dict): The stored answer, as built by normalize_answer.
+    - answer_id (int): Id of the answer, to look up its relevant PMIDs.
+    - storage (Storage): Storage backend.
+    - dry_run (bool): Only report the new articles; nothing is classified, processed or written.
+
+    Returns:
+    - outcome (str): "updated" if the evidence changed and the answer was resynthesized, "unchanged" otherwise.
+    """
+    relevant_pmids = storage.fetch_answer_pmids(answer_id)
+    known = set(relevant_pmids) | set(answer.get('screened_pmids') or [])
+
+    with pipeline_metrics.question(question, f"refresh-{uuid.uuid4()}") as record:
+        record.priority = REFRESH_PRIORITY
+        with pipeline_metrics.stage("query_generation"):
+            general_query, query_contention, query_list = query_generation(question)
+        with pipeline_metrics.stage("retrieval"):
+            articles_collected = collect_articles(query_list)
+        new_articles = [article for article in articles_collected if str(article.pmid) not in known]
+        pipeline_metrics.count_articles("retrieved", len(articles_collected))
+        pipeline_metrics.count_articles("new", len(new_articles))
+        REFRESH_NEW_ARTICLES.observe(len(new_articles))
+        print(f"{question!r}: {len(new_articles)} new of {len(articles_collected)} retrieved articles")
+        if dry_run:
+            return "unchanged"
+
+        with pipeline_metrics.stage("relevance_classification"):
+            relevant_articles, irrelevant_articles = concurrent_relevance_classification(new_articles, question)
+        pipeline_metrics.count_articles("relevant", len(relevant_articles))
+        pipeline_metrics.count_articles("irrelevant", len(irrelevant_articles))
+        # Only articles that are settled count as screened: ranked-out articles and ones whose classification or
+        # processing failed are left for the next refresh to retrieve and try again
+        screened = {str(article.pmid) for article in irrelevant_articles}
+
+        new_summaries = []
+        if relevant_articles:
+            with pipeline_metrics.stage("article_processing"):
+                reliability_analysis_df = connect_to_reliability_analysis_db([article.pmid for article in relevant_articles])
+                reliability_analysis_df = reliability_analysis_df.astype(object).where(reliability_analysis_df.notnull(), None)
+                matched_articles, articles_to_process = article_matching(relevant_articles, reliability_analysis_df)
+                articles_to_process, ranked_out = evidence_ranking.select_articles(articles_to_process, question)
+                processed = [summary for summary in concurrent_article_processing(articles_to_process) if summary]
+                # Written right away, so the refreshed answer's links resolve
+                storage.upsert_articles(dict_to_tuple(processed))
+                new_summaries = processed + matched_articles
+                screened.update(str(summary.get('PMID') or summary.get('article_id')) for summary in new_summaries)
+            pipeline_metrics.count_articles("matched", len(matched_articles))
+            pipeline_metrics.count_articles("processed", len(processed))
+            pipeline_metrics.count_articles("ranked_out", len(ranked_out))
+        screened_pmids = sorted(known | screened)
+
+        if not new_summaries:
+            # Same evidence: keep the answer, only remember what was screened
+            answer = dict(answer, answered_at=time.time(), screened_pmids=screened_pmids)
+            storage.write_answers([(question, json.dumps(answer), relevant_pmids)], replace=True)
+            record.status = "unchanged"
+            return "unchanged"
+
+        all_relevant_articles = new_summaries + load_articles(relevant_pmids)
+        with pipeline_metrics.stage("synthesis"):
+            if SYNTHESIS_CITATION_MODE == 'pmid':
+                final_output, citations, updated_citations = generate_final_response_structured(all_relevant_articles, question)
+            else:
+                final_output = generate_final_response(all_relevant_articles, question)
+                main_output, citations = split_end_output(final_output)
+                updated_citations = match_citations_with_articles(citations, all_relevant_articles)
+        total_runtime = sum(record.stages.values())
+        storage.upsert_answers([(question, build_output_record(final_output, all_relevant_articles, total_runtime, citations,
+                                                               updated_citations, screened_pmids))], replace=True)
+        record.status = "updated"
+        return "updated"
+
+
+def refresh(questions=None, limit=None, max_age_days=REFRESH_MAX_AGE_DAYS, dry_run=False):
+    """
+    Refreshes the given questions, or the aging answers oldest first.
+
+    Parameters:
+    - questions (list): Questions to refresh regardless of age.
+    - limit (int): Most answers refreshed.
+    - max_age_days (float): Age from which an answer is refreshed.
+    - dry_run (bool): Only report the new articles of each answer.
+
+    Returns:
+    - outcomes (dict): Answers per outcome.
+    """
+    storage = get_storage(env)
+    storage.open()
+    if questions:
+        due = [(question, json.loads(answer), answer_id) for question in questions
+               for _, answer, answer_id in storage.fetch_answer_rows(question) if refreshable(json.loads(answer))]
+    else:
+        due = aging_answers(storage, max_age_days)
+    outcomes = {}
+    for question, answer, answer_id in due[:limit]:
+        try:
+            outcome = refresh_answer(question, answer, answer_id, storage, dry_run)
+        except Exception:
+            logging.exception("Refreshing %r failed", question)
+            outcome = "error"
+        if not dry_run:
+            REFRESH_ANSWERS.inc(outcome=outcome)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print(f"Refreshed {sum(outcomes.values())} of {len(due)} due answers: {outcomes}")
+    return outcomes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--question", action="append", help="refresh this question regardless of age (repeatable)")
+    parser.add_argument("--limit", type=int, help="most answers refreshed")
+    parser.add_argument("--max-age-days", type=float, default=REFRESH_MAX_AGE_DAYS)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    refresh(args.question, args.limit, args.max_age_days, args.dry_run)
@@ -0,0 +1,211 @@
+"""
+In-memory hub that delivers pipeline progress updates to the browser over SSE.
+
+A session is created by `/process_query` before its job starts, so updates published before the browser connects to
+`/sse` are buffered instead of dropped. Each session keeps the last SESSION_BUFFER_SIZE events, numbered from 1, and a
+subscriber that reconnects with a Last-Event-ID header is replayed everything after that id. `publish` may be called
+from worker threads: delivery is handed to the server's event loop with `call_soon_threadsafe`, because asyncio
+queues are not thread-safe. Sessions are evicted once nobody has been subscribed or published to them for
+SESSION_TTL seconds.
+
+Configuration (env):
+- SESSION_BUFFER_SIZE: events kept per session for replay (default 100).
+- SESSION_TTL: seconds an idle session is kept before it is evicted (default 600).
+- SESSION_SWEEP_INTERVAL: seconds between eviction sweeps (default 30).
+- SSE_HEARTBEAT_INTERVAL: seconds between keepalive comments on an open SSE stream (default 15).
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+
+SSE_HEARTBEAT_INTERVAL = int(os.getenv('SSE_HEARTBEAT_INTERVAL', 15))
+
+SESSIONS = metrics.gauge("dietnerd_sse_sessions", "SSE sessions held by the session hub.")
+SESSION_SUBSCRIBERS = metrics.gauge("dietnerd_sse_subscribers", "Open SSE connections subscribed to a session.")
+SESSION_BUFFERED_EVENTS = metrics.gauge("dietnerd_sse_buffered_events", "Events held in session replay buffers.")
+SESSION_BUFFERED_BYTES = metrics.gauge("dietnerd_sse_buffered_bytes", "Serialized size of the events held in session replay buffers.")
+SESSION_EVENTS = metrics.counter("dietnerd_sse_events_total", "Events published to SSE sessions.")
+SESSION_REPLAYED = metrics.counter("dietnerd_sse_replayed_events_total", "Buffered events replayed to late or reconnecting subscribers.")
+SESSION_DROPPED = metrics.counter("dietnerd_sse_dropped_events_total", "Events published to a session that does not exist or was already evicted.")
+SESSION_EVICTED = metrics.counter("dietnerd_sse_evicted_sessions_total", "Sessions evicted by the idle sweep.", ("state",))
+
+
+def is_final(data):
+    """
+    Returns True for the final update of a session, which carries the answer.
+    """
+    return isinstance(data, dict) and "end_output" in data
+
+
+class Session:
+    """
+    Replay buffer and subscriber list of one session. Only touched from the event loop thread.
+    """
+    __slots__ = ("session_id", "events", "next_id", "subscribers", "last_activity", "done", "buffered_bytes")
+
+    def __init__(self, session_id, buffer_size):
+        self.session_id = session_id
+        self.events = deque(maxlen=buffer_size)
+        self.next_id = 1
+        self.subscribers = set()
+        self.last_activity = time.time()
+        self.done = False
+        self.buffered_bytes = 0
+
+    def append(self, payload, final):
+        if len(self.events) == self.events.maxlen:
+            self.buffered_bytes -= len(self.events[0][1])
+        event = (self.next_id, payload, final)
+        self.events.append(event)
+        self.buffered_bytes += len(payload)
+        self.next_id += 1
+        self.last_activity = time.time()
+        self.done = self.done or final
+        return event
+
+    def replay(self, last_event_id):
+        return [event for event in self.events if event[0] > last_event_id]
+
+
+class SessionHub:
+    """
+    Buffers and fans out SSE events per session.
+
+    Parameters:
+    - buffer_size (int): Events kept per session for replay.
+    - ttl (float): Seconds an idle session is kept before it is evicted.
+    - sweep_interval (float): Seconds between eviction sweeps.
+    """
+
+    def __init__(self, buffer_size=100, ttl=600, sweep_interval=30):
+        self.buffer_size = buffer_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._sessions = {}
+        self._loop = None
+        self._loop_thread = None
+        SESSIONS.set_function(lambda: len(self._sessions))
+        SESSION_SUBSCRIBERS.set_function(lambda: sum(len(session.subscribers) for session in list(self._sessions.values())))
+        SESSION_BUFFERED_EVENTS.set_function(lambda: sum(len(session.events) for session in list(self._sessions.values())))
+        SESSION_BUFFERED_BYTES.set_function(lambda: sum(session.buffered_bytes for session in list(self._sessions.values())))
+
+    def bind_loop(self, loop):
+        """
+        Sets the event loop that owns the sessions. Must be called from that loop's thread, normally at startup.
+        """
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+
+    def _call_in_loop(self, function, *args):
+        if self._loop is None or threading.get_ident() == self._loop_thread:
+            function(*args)
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(function, *args)
+
+    def create(self, session_id):
+        """
+        Registers a session so updates published before the browser subscribes are buffered.
+        """
+        self._call_in_loop(self._create, session_id)
+
+    def _create(self, session_id):
+        if session_id not in self._sessions:
+            self._sessions[session_id] = Session(session_id, self.buffer_size)
+
+    def discard(self, session_id):
+        """
+        Removes a session whose job was never started.
+        """
+        self._call_in_loop(self._sessions.pop, session_id, None)
+
+    def exists(self, session_id):
+        return session_id in self._sessions
+
+    def publish(self, session_id, data):
+        """
+        Publishes one update to a session. Safe to call from any thread.
+
+        Parameters:
+        - session_id (str): The session to publish to.
+        - data (str or dict): The update. A dictionary with "end_output" is the final update and closes the stream.
+        """
+        payload = json.dumps({"update": data})
+        self._call_in_loop(self._publish, session_id, payload, is_final(data))
+
+    def _publish(self, session_id, payload, final):
+        session = self._sessions.get(session_id)
+        if session is None:
+            SESSION_DROPPED.inc()
+            logging.warning("Dropped update for unknown session %s", session_id)
+            return
+        event = session.append(payload, final)
+        SESSION_EVENTS.inc()
+        for subscriber in session.subscribers:
+            subscriber.put_nowait(event)
+
+    async def subscribe(self, session_id, last_event_id=0):
+        """
+        Yields SSE events of a session, starting after `last_event_id`, until the final update has been sent.
+
+        Parameters:
+        - session_id (str): The session to subscribe to.
+        - last_event_id (int): Id of the last event the client received, from the Last-Event-ID header.
+
+        Returns:
+        - events (async generator): Dictionaries with "id", "event" and "data", as sent by EventSourceResponse.
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            return
+        subscriber = asyncio.Queue()
+        session.subscribers.add(subscriber)
+        session.last_activity = time.time()
+        try:
+            backlog = session.replay(last_event_id)
+            SESSION_REPLAYED.inc(len(backlog))
+            for event in backlog:
+                subscriber.put_nowait(event)
+            while True:
+                event_id, payload, final = await subscriber.get()
+                yield {"id": str(event_id), "event": "message", "data": payload}
+                if final:
+                    break
+        finally:
+            session.subscribers.discard(subscriber)
+            session.last_activity = time.time()
+
+    def evict_idle(self, now=None):
+        """
+        Evicts sessions without subscribers that have been idle for longer than the TTL.
+
+        Returns:
+        - evicted (int): Number of sessions evicted.
+        """
+        now = now or time.time()
+        expired = [session for session in self._sessions.values() if not session.subscribers and now - session.last_activity > self.ttl]
+        for session in expired:
+            del self._sessions[session.session_id]
+            SESSION_EVICTED.inc(state="done" if session.done else "abandoned")
+        return len(expired)
+
+    async def run_sweeper(self):
+        """
+        Evicts idle sessions every `sweep_interval` seconds. Run as a task on the server loop.
+        """
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            evicted = self.evict_idle()
+            if evicted:
+                logging.info("Evicted %s idle SSE sessions", evicted)
+
+
+hub = SessionHub(
+    buffer_size=int(os.getenv('SESSION_BUFFER_SIZE', 100)),
+    ttl=float(os.getenv('SESSION_TTL', 600)),
+    sweep_interval=float(os.getenv('SESSION_SWEEP_INTERVAL', 30)))
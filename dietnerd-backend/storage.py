@@ -0,0 +1,795 @@
+"""
+Storage backends for the article_analysis and question_answer tables.
+
+Every read and write path goes through a Storage object instead of hard-coding mysql.connector, so the pipeline can run
+against an embedded SQLite file when no MySQL server is available (local runs, benchmarks).
+
+Configuration (env):
+- STORAGE_BACKEND: "mysql" (default) or "sqlite".
+- SQLITE_PATH: database file used by the SQLite backend (default dietnerd.sqlite3).
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+
+from database import get_connection, init_pool
+
+
+class Storage:
+    """
+    Interface of a storage backend.
+
+    Tables:
+    - article_analysis (article_id PRIMARY KEY, url, pmcid, citation, article_type, summary, extra, article_json): processed
+      articles, keyed by PMID. Metadata is kept in typed columns and the summary is zlib-compressed, so reads only fetch
+      and decode the fields they ask for. article_json is only set on rows written before the columns existed.
+    - question_answer (question UNIQUE, answer, id PRIMARY KEY): final outputs, keyed by question. The answer holds only
+      the end output, citations and the PMID of each citation (see normalize_answer).
+    - question_answer_article (question_id, article_id, position): the relevant articles of each answer, by PMID.
+    - question_verdict (question PRIMARY KEY, label): validity labels returned by the LLM, the training set of the local
+      question classifier (see question_classifier.py).
+    - pubmed_record (pmid PRIMARY KEY, record, fetched_at): raw efetch XML per PMID (see pubmed_cache.py).
+    - question_log (question, source, asked_at): questions users submitted or searched for, mined by warmer.py.
+
+    Upserts keep the existing row when the key already exists, matching the original
+    "ON DUPLICATE KEY UPDATE <key> = VALUES(<key>)" queries, unless replace=True.
+    """
+
+    def open(self):
+        """
+        Acquires the backend's resources at startup, e.g. the MySQL connection pool.
+        """
+
+    def create_schema(self):
+        """
+        Creates the tables and indexes if they do not exist, and upgrades a legacy article_analysis table.
+        """
+        raise NotImplementedError
+
+    def upsert_articles(self, data, replace=False):
+        """
+        Parameters:
+        - data (list): List of (PMID, article dictionary) tuples, as built by dict_to_tuple.
+        - replace (bool): Overwrite articles that already exist.
+        """
+        self.write_articles([article_to_columns(pmid, article) for pmid, article in data], replace)
+
+    def get_articles(self, pmids=None, fields=None):
+        """
+        Parameters:
+        - pmids (list): PMIDs to look up. If None, every row is returned.
+        - fields (list): Article fields to return, from ARTICLE_FIELDS. If None, every field is returned,
+          including any extra fields stored with the article. PMID is always returned.
+
+        Returns:
+        - articles (list): List of article dictionaries.
+        """
+        columns = article_columns(fields)
+        if pmids is not None:
+            pmids = [str(pmid) for pmid in pmids]
+            if not pmids:
+                return []
+        return [columns_to_article(columns, row, fields) for row in self.select_articles(columns, pmids)]
+
+    def write_articles(self, rows, replace=False):
+        """
+        Parameters:
+        - rows (list): Column tuples in ARTICLE_WRITE_COLUMNS order, as built by article_to_columns.
+        - replace (bool): Overwrite articles that already exist.
+        """
+        raise NotImplementedError
+
+    def upgrade_article_schema(self):
+        """
+        Adds the typed and compressed columns to an article_analysis table that only has (article_id, article_json),
+        and makes article_json nullable. Does nothing on an upgraded table, so it runs with every create_schema; rows
+        keep their article_json until migrate_article_analysis.py rewrites them.
+        """
+        raise NotImplementedError
+
+    def select_articles(self, columns, pmids=None):
+        """
+        Parameters:
+        - columns (list): article_analysis columns to select.
+        - pmids (list): PMIDs to look up. If None, every row is returned.
+
+        Returns:
+        - rows (list): List of column tuples.
+        """
+        raise NotImplementedError
+
+    def upsert_answers(self, data, replace=False):
+        """
+        Parameters:
+        - data (list): List of (question, final output object) tuples.
+        - replace (bool): Overwrite answers that already exist.
+        """
+        self.write_answers([(question,) + normalize_answer(obj) for question, obj in data], replace)
+
+    def get_answer(self, question, include_articles=False):
+        """
+        Parameters:
+        - question (str): The exact question.
+        - include_articles (bool): Join the full article_analysis records of every relevant article into the answer.
+
+        Returns:
+        - rows (list): List of (question, answer JSON string, id) tuples.
+        """
+        rows = []
+        for question, answer, answer_id in self.fetch_answer_rows(question):
+            answer = json.loads(answer)
+            if answer.get('format') != ANSWER_FORMAT:
+                rows.append((question, json.dumps(expand_legacy_answer(answer, include_articles)), answer_id))
+                continue
+            pmids = self.fetch_answer_pmids(answer_id)
+            wanted = set(answer['citation_pmids'].values()) | (set(pmids) if include_articles else set())
+            fields = None if include_articles else ['PMCID', 'url', 'summary']
+            articles_by_pmid = {article['PMID']: article for article in self.get_articles(sorted(wanted), fields)}
+            rows.append((question, json.dumps(expand_answer(answer, pmids, articles_by_pmid, include_articles)), answer_id))
+        return rows
+
+    def write_answers(self, rows, replace=False):
+        """
+        Parameters:
+        - rows (list): List of (question, answer JSON string, PMID list) tuples, as built by normalize_answer.
+        - replace (bool): Overwrite answers that already exist.
+        """
+        raise NotImplementedError
+
+    def fetch_answer_rows(self, question):
+        """
+        Returns:
+        - rows (list): Stored (question, answer, id) rows of the question, without joining articles.
+        """
+        raise NotImplementedError
+
+    def fetch_answer_pmids(self, answer_id):
+        """
+        Returns:
+        - pmids (list): PMIDs linked to the answer, in their original order.
+        """
+        raise NotImplementedError
+
+    def iter_answers(self, batch_size=100):
+        """
+        Yields every stored (question, answer, id) row without joining articles, in id order.
+        """
+        raise NotImplementedError
+
+    def list_questions(self):
+        """
+        Returns:
+        - questions (list): Every stored question, the corpus for the similarity search.
+        """
+        raise NotImplementedError
+
+    def record_verdict(self, question, label):
+        """
+        Stores the LLM's validity label for a question, replacing any earlier label.
+        """
+        raise NotImplementedError
+
+    def list_verdicts(self):
+        """
+        Returns:
+        - verdicts (list): Every stored (question, label) tuple.
+        """
+        raise NotImplementedError
+
+    def log_questions(self, rows):
+        """
+        Parameters:
+        - rows (list): List of (question, source, Unix time) tuples, e.g. ("Is coffee healthy?", "submit", 1718000000.0).
+        """
+        raise NotImplementedError
+
+    def select_question_log(self, asked_after=0):
+        """
+        Returns:
+        - rows (list): Every logged (question, source, Unix time) tuple asked after `asked_after`.
+        """
+        raise NotImplementedError
+
+    def delete_question_log(self, asked_before):
+        """
+        Deletes the logged questions asked before `asked_before` (Unix time).
+        """
+        raise NotImplementedError
+
+    def write_pubmed_records(self, rows):
+        """
+        Parameters:
+        - rows (list): List of (PMID, compressed article XML, fetch time) tuples. Existing records are replaced.
+        """
+        raise NotImplementedError
+
+    def select_pubmed_records(self, pmids, fetched_after=0):
+        """
+        Parameters:
+        - pmids (list): PMIDs to look up.
+        - fetched_after (float): Only return records fetched after this Unix time.
+
+        Returns:
+        - rows (list): List of (PMID, compressed article XML) tuples.
+        """
+        raise NotImplementedError
+
+
+class MySQLStorage(Storage):
+    """
+    MySQL backend using the shared connection pool.
+
+    Parameters:
+    - credentials (str): Name of env file, only read if the connection pool has not been created yet.
+    - article_table (str): Name of the article analysis table.
+    - answer_table (str): Name of the question-answer table.
+    """
+
+    verdict_table = 'question_verdict'
+    pubmed_table = 'pubmed_record'
+    question_log_table = 'question_log'
+
+    def __init__(self, credentials=None, article_table='article_analysis', answer_table='question_answer'):
+        self.credentials = credentials
+        self.article_table = article_table
+        self.answer_table = answer_table
+
+    def open(self):
+        init_pool(self.credentials)
+        self.create_schema()
+
+    @property
+    def link_table(self):
+        return f"{self.answer_table}_article"
+
+    @contextmanager
+    def _cursor(self):
+        with get_connection(self.credentials) as connection:
+            cursor = connection.cursor()
+            try:
+                yield cursor
+                connection.commit()
+            finally:
+                cursor.close()
+
+    def _execute(self, sql, params=(), many=False, fetch=False, commit=False):
+        with get_connection(self.credentials) as connection:
+            cursor = connection.cursor()
+            try:
+                if many:
+                    cursor.executemany(sql, params)
+                else:
+                    cursor.execute(sql, params)
+                result = cursor.fetchall() if fetch else None
+                if commit:
+                    connection.commit()
+                return result
+            finally:
+                cursor.close()
+
+    def create_schema(self):
+        self._execute(f"""CREATE TABLE IF NOT EXISTS {self.article_table} (
+                            article_id VARCHAR(20) NOT NULL,
+                            url VARCHAR(255) NULL,
+                            pmcid VARCHAR(20) NULL,
+                            citation TEXT NULL,
+                            article_type TEXT NULL,
+                            summary MEDIUMBLOB NULL,
+                            extra MEDIUMTEXT NULL,
+                            article_json LONGTEXT NULL,
+                            PRIMARY KEY (article_id))""", commit=True)
+        self._execute(f"""CREATE TABLE IF NOT EXISTS {self.answer_table} (
+                            question VARCHAR(768) NOT NULL,
+                            answer LONGTEXT NOT NULL,
+                            id INT NOT NULL AUTO_INCREMENT,
+                            PRIMARY KEY (id),
+                            UNIQUE KEY uq_{self.answer_table}_question (question))""", commit=True)
+        self._execute(f"""CREATE TABLE IF NOT EXISTS {self.link_table} (
+                            question_id INT NOT NULL,
+                            article_id VARCHAR(20) NOT NULL,
+                            position SMALLINT NOT NULL,
+                            PRIMARY KEY (question_id, article_id),
+                            KEY ix_{self.link_table}_article (article_id))""", commit=True)
+        self._execute(f"""CREATE TABLE IF NOT EXISTS {self.verdict_table} (
+                            question VARCHAR(768) NOT NULL,
+                            label VARCHAR(32) NOT NULL,
+                            PRIMARY KEY (question))""", commit=True)
+        self._execute(f"""CREATE TABLE IF NOT EXISTS {self.pubmed_table} (
+                            pmid VARCHAR(20) NOT NULL,
+                            record MEDIUMBLOB NOT NULL,
+                            fetched_at DOUBLE NOT NULL,
+                            PRIMARY KEY (pmid))""", commit=True)
+        self._execute(f"""CREATE TABLE IF NOT EXISTS {self.question_log_table} (
+                            question VARCHAR(768) NOT NULL,
+                            source VARCHAR(16) NOT NULL,
+                            asked_at DOUBLE NOT NULL,
+                            KEY ix_{self.question_log_table}_asked_at (asked_at))""", commit=True)
+        self.upgrade_article_schema()
+
+    def write_articles(self, rows, replace=False):
+        if not rows:
+            return
+        placeholders = ", ".join(["%s"] * len(ARTICLE_WRITE_COLUMNS))
+        if replace:
+            update = ", ".join(f"{column} = VALUES({column})" for column in ARTICLE_WRITE_COLUMNS[1:]) + ", article_json = NULL"
+        else:
+            update = "article_id = VALUES(article_id)"
+        self._execute(f"INSERT INTO {self.article_table} ({', '.join(ARTICLE_WRITE_COLUMNS)}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {update}",
+                      list(rows), many=True, commit=True)
+
+    def upgrade_article_schema(self):
+        rows = self._execute("SELECT COLUMN_NAME, IS_NULLABLE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                             (self.article_table,), fetch=True)
+        existing = {row[0]: row[1] for row in rows}
+        definitions = {
+            'url': 'VARCHAR(255) NULL',
+            'pmcid': 'VARCHAR(20) NULL',
+            'citation': 'TEXT NULL',
+            'article_type': 'TEXT NULL',
+            'summary': 'MEDIUMBLOB NULL',
+            'extra': 'MEDIUMTEXT NULL',
+        }
+        changes = [f"ADD COLUMN {column} {definition}" for column, definition in definitions.items() if column not in existing]
+        if existing.get('article_json') == 'NO':
+            changes.append("MODIFY article_json LONGTEXT NULL")
+        if changes:
+            logging.info("Upgrading %s: %s", self.article_table, ", ".join(changes))
+            self._execute(f"ALTER TABLE {self.article_table} {', '.join(changes)}", commit=True)
+
+    def select_articles(self, columns, pmids=None):
+        sql = f"SELECT {', '.join(columns)} FROM {self.article_table}"
+        if pmids is None:
+            return self._execute(sql, fetch=True)
+        placeholders = ", ".join(["%s"] * len(pmids))
+        return self._execute(f"{sql} WHERE article_id IN ({placeholders})", pmids, fetch=True)
+
+    def write_answers(self, rows, replace=False):
+        if not rows:
+            return
+        if replace:
+            sql = f"INSERT INTO {self.answer_table} (question, answer) VALUES (%s, %s) ON DUPLICATE KEY UPDATE answer = VALUES(answer)"
+        else:
+            sql = f"INSERT INTO {self.answer_table} (question, answer) VALUES (%s, %s) ON DUPLICATE KEY UPDATE question = VALUES(question)"
+        with self._cursor() as cursor:
+            for question, answer, pmids in rows:
+                cursor.execute(sql, (question, answer))
+                # rowcount is 0 when an existing answer was kept
+                if cursor.rowcount == 0:
+                    continue
+                cursor.execute(f"SELECT id FROM {self.answer_table} WHERE question = %s", (question,))
+                answer_id = cursor.fetchall()[0][0]
+                cursor.execute(f"DELETE FROM {self.link_table} WHERE question_id = %s", (answer_id,))
+                if pmids:
+                    cursor.executemany(f"INSERT INTO {self.link_table} (question_id, article_id, position) VALUES (%s, %s, %s)",
+                                       [(answer_id, pmid, position) for position, pmid in enumerate(pmids)])
+
+    def fetch_answer_rows(self, question):
+        return self._execute(f"SELECT question, answer, id FROM {self.answer_table} WHERE question = %s", (question,), fetch=True)
+
+    def fetch_answer_pmids(self, answer_id):
+        rows = self._execute(f"SELECT article_id FROM {self.link_table} WHERE question_id = %s ORDER BY position", (answer_id,), fetch=True)
+        return [row[0] for row in rows]
+
+    def iter_answers(self, batch_size=100):
+        last_id = 0
+        while True:
+            rows = self._execute(f"SELECT question, answer, id FROM {self.answer_table} WHERE id > %s ORDER BY id LIMIT %s", (last_id, batch_size), fetch=True)
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][2]
+
+    def list_questions(self):
+        return [row[0] for row in self._execute(f"SELECT question FROM {self.answer_table}", fetch=True)]
+
+    def record_verdict(self, question, label):
+        self._execute(f"INSERT INTO {self.verdict_table} (question, label) VALUES (%s, %s) ON DUPLICATE KEY UPDATE label = VALUES(label)",
+                      (question, label), commit=True)
+
+    def list_verdicts(self):
+        return self._execute(f"SELECT question, label FROM {self.verdict_table}", fetch=True)
+
+    def log_questions(self, rows):
+        if not rows:
+            return
+        self._execute(f"INSERT INTO {self.question_log_table} (question, source, asked_at) VALUES (%s, %s, %s)",
+                      [(question[:768], source, asked_at) for question, source, asked_at in rows], many=True, commit=True)
+
+    def select_question_log(self, asked_after=0):
+        return self._execute(f"SELECT question, source, asked_at FROM {self.question_log_table} WHERE asked_at > %s", (asked_after,), fetch=True)
+
+    def delete_question_log(self, asked_before):
+        self._execute(f"DELETE FROM {self.question_log_table} WHERE asked_at < %s", (asked_before,), commit=True)
+
+    def write_pubmed_records(self, rows):
+        if not rows:
+            return
+        self._execute(f"""INSERT INTO {self.pubmed_table} (pmid, record, fetched_at) VALUES (%s, %s, %s)
+                          ON DUPLICATE KEY UPDATE record = VALUES(record), fetched_at = VALUES(fetched_at)""",
+                      list(rows), many=True, commit=True)
+
+    def select_pubmed_records(self, pmids, fetched_after=0):
+        if not pmids:
+            return []
+        placeholders = ", ".join(["%s"] * len(pmids))
+        rows = self._execute(f"SELECT pmid, record FROM {self.pubmed_table} WHERE pmid IN ({placeholders}) AND fetched_at > %s",
+                             list(pmids) + [fetched_after], fetch=True)
+        return [(pmid, bytes(record)) for pmid, record in rows]
+
+
+class SQLiteStorage(Storage):
+    """
+    Embedded SQLite backend. Each thread gets its own connection; the file is opened in WAL mode so readers do not
+    block the writer.
+
+    Parameters:
+    - path (str): Path of the SQLite database file.
+    - article_table (str): Name of the article analysis table.
+    - answer_table (str): Name of the question-answer table.
+    """
+
+    verdict_table = 'question_verdict'
+    pubmed_table = 'pubmed_record'
+    question_log_table = 'question_log'
+
+    def __init__(self, path='dietnerd.sqlite3', article_table='article_analysis', answer_table='question_answer'):
+        self.path = path
+        self.article_table = article_table
+        self.answer_table = answer_table
+        self._local = threading.local()
+        self.create_schema()
+
+    @property
+    def link_table(self):
+        return f"{self.answer_table}_article"
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def create_schema(self):
+        with self.connection() as connection:
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.article_table} (
+                                     article_id TEXT NOT NULL PRIMARY KEY,
+                                     url TEXT,
+                                     pmcid TEXT,
+                                     citation TEXT,
+                                     article_type TEXT,
+                                     summary BLOB,
+                                     extra TEXT,
+                                     article_json TEXT)""")
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.answer_table} (
+                                     question TEXT NOT NULL UNIQUE,
+                                     answer TEXT NOT NULL,
+                                     id INTEGER PRIMARY KEY AUTOINCREMENT)""")
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.link_table} (
+                                     question_id INTEGER NOT NULL,
+                                     article_id TEXT NOT NULL,
+                                     position INTEGER NOT NULL,
+                                     PRIMARY KEY (question_id, article_id)) WITHOUT ROWID""")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.link_table}_article ON {self.link_table} (article_id)")
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.verdict_table} (
+                                     question TEXT NOT NULL PRIMARY KEY,
+                                     label TEXT NOT NULL)""")
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.pubmed_table} (
+                                     pmid TEXT NOT NULL PRIMARY KEY,
+                                     record BLOB NOT NULL,
+                                     fetched_at REAL NOT NULL)""")
+            connection.execute(f"""CREATE TABLE IF NOT EXISTS {self.question_log_table} (
+                                     question TEXT NOT NULL,
+                                     source TEXT NOT NULL,
+                                     asked_at REAL NOT NULL)""")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.question_log_table}_asked_at ON {self.question_log_table} (asked_at)")
+        self.upgrade_article_schema()
+
+    def write_articles(self, rows, replace=False):
+        if not rows:
+            return
+        placeholders = ", ".join(["?"] * len(ARTICLE_WRITE_COLUMNS))
+        if replace:
+            conflict = "DO UPDATE SET " + ", ".join(f"{column} = excluded.{column}" for column in ARTICLE_WRITE_COLUMNS[1:]) + ", article_json = NULL"
+        else:
+            conflict = "DO NOTHING"
+        with self.connection() as connection:
+            connection.executemany(f"INSERT INTO {self.article_table} ({', '.join(ARTICLE_WRITE_COLUMNS)}) VALUES ({placeholders}) ON CONFLICT(article_id) {conflict}", list(rows))
+
+    def upgrade_article_schema(self):
+        connection = self.connection()
+        columns = {row[1] for row in connection.execute(f"PRAGMA table_info({self.article_table})")}
+        if 'summary' in columns:
+            return
+        # SQLite cannot drop NOT NULL from article_json, so the table is rebuilt
+        with connection:
+            connection.execute(f"ALTER TABLE {self.article_table} RENAME TO {self.article_table}_legacy")
+        self.create_schema()
+        with connection:
+            connection.execute(f"INSERT INTO {self.article_table} (article_id, article_json) SELECT article_id, article_json FROM {self.article_table}_legacy")
+            connection.execute(f"DROP TABLE {self.article_table}_legacy")
+
+    def select_articles(self, columns, pmids=None):
+        connection = self.connection()
+        sql = f"SELECT {', '.join(columns)} FROM {self.article_table}"
+        if pmids is None:
+            return connection.execute(sql).fetchall()
+        rows = []
+        # Stay below SQLite's limit on bound parameters
+        for i in range(0, len(pmids), 500):
+            chunk = pmids[i:i + 500]
+            placeholders = ", ".join(["?"] * len(chunk))
+            rows.extend(connection.execute(f"{sql} WHERE article_id IN ({placeholders})", chunk).fetchall())
+        return rows
+
+    def write_answers(self, rows, replace=False):
+        if not rows:
+            return
+        if replace:
+            sql = f"INSERT INTO {self.answer_table} (question, answer) VALUES (?, ?) ON CONFLICT(question) DO UPDATE SET answer = excluded.answer"
+        else:
+            sql = f"INSERT INTO {self.answer_table} (question, answer) VALUES (?, ?) ON CONFLICT(question) DO NOTHING"
+        with self.connection() as connection:
+            for question, answer, pmids in rows:
+                # rowcount is 0 when an existing answer was kept
+                if connection.execute(sql, (question, answer)).rowcount == 0:
+                    continue
+                answer_id = connection.execute(f"SELECT id FROM {self.answer_table} WHERE question = ?", (question,)).fetchone()[0]
+                connection.execute(f"DELETE FROM {self.link_table} WHERE question_id = ?", (answer_id,))
+                connection.executemany(f"INSERT INTO {self.link_table} (question_id, article_id, position) VALUES (?, ?, ?)",
+                                       [(answer_id, pmid, position) for position, pmid in enumerate(pmids)])
+
+    def fetch_answer_rows(self, question):
+        return self.connection().execute(f"SELECT question, answer, id FROM {self.answer_table} WHERE question = ?", (question,)).fetchall()
+
+    def fetch_answer_pmids(self, answer_id):
+        rows = self.connection().execute(f"SELECT article_id FROM {self.link_table} WHERE question_id = ? ORDER BY position", (answer_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def iter_answers(self, batch_size=100):
+        last_id = 0
+        while True:
+            rows = self.connection().execute(f"SELECT question, answer, id FROM {self.answer_table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][2]
+
+    def list_questions(self):
+        return [row[0] for row in self.connection().execute(f"SELECT question FROM {self.answer_table}").fetchall()]
+
+    def record_verdict(self, question, label):
+        with self.connection() as connection:
+            connection.execute(f"INSERT INTO {self.verdict_table} (question, label) VALUES (?, ?) ON CONFLICT(question) DO UPDATE SET label = excluded.label",
+                               (question, label))
+
+    def list_verdicts(self):
+        return self.connection().execute(f"SELECT question, label FROM {self.verdict_table}").fetchall()
+
+    def log_questions(self, rows):
+        if not rows:
+            return
+        with self.connection() as connection:
+            connection.executemany(f"INSERT INTO {self.question_log_table} (question, source, asked_at) VALUES (?, ?, ?)", list(rows))
+
+    def select_question_log(self, asked_after=0):
+        return self.connection().execute(f"SELECT question, source, asked_at FROM {self.question_log_table} WHERE asked_at > ?", (asked_after,)).fetchall()
+
+    def delete_question_log(self, asked_before):
+        with self.connection() as connection:
+            connection.execute(f"DELETE FROM {self.question_log_table} WHERE asked_at < ?", (asked_before,))
+
+    def write_pubmed_records(self, rows):
+        if not rows:
+            return
+        with self.connection() as connection:
+            connection.executemany(f"""INSERT INTO {self.pubmed_table} (pmid, record, fetched_at) VALUES (?, ?, ?)
+                                      ON CONFLICT(pmid) DO UPDATE SET record = excluded.record, fetched_at = excluded.fetched_at""",
+                                   list(rows))
+
+    def select_pubmed_records(self, pmids, fetched_after=0):
+        rows = []
+        # Stay below SQLite's limit on bound parameters
+        for i in range(0, len(pmids), 500):
+            chunk = list(pmids[i:i + 500])
+            placeholders = ", ".join(["?"] * len(chunk))
+            rows.extend(self.connection().execute(f"SELECT pmid, record FROM {self.pubmed_table} WHERE pmid IN ({placeholders}) AND fetched_at > ?",
+                                                  chunk + [fetched_after]).fetchall())
+        return rows
+
+
+# Article fields mapped to their article_analysis columns
+ARTICLE_COLUMNS = {
+    'PMID': 'article_id',
+    'url': 'url',
+    'PMCID': 'pmcid',
+    'citation': 'citation',
+    'article_type': 'article_type',
+    'summary': 'summary',
+}
+ARTICLE_FIELDS = tuple(ARTICLE_COLUMNS)
+ARTICLE_WRITE_COLUMNS = ('article_id', 'url', 'pmcid', 'citation', 'article_type', 'summary', 'extra')
+
+
+def compress_text(text):
+    return None if text is None else zlib.compress(text.encode('utf-8'), 6)
+
+
+def decompress_text(data):
+    return None if data is None else zlib.decompress(data).decode('utf-8')
+
+
+def article_to_columns(pmid, article):
+    """
+    Splits an article dictionary into article_analysis columns. Fields without a column of their own are kept as JSON
+    in the extra column.
+
+    Parameters:
+    - pmid (str): PubMed ID of the article.
+    - article (dict): The article dictionary.
+
+    Returns:
+    - row (tuple): Column values in ARTICLE_WRITE_COLUMNS order.
+    """
+    extra = {key: value for key, value in article.items() if key not in ARTICLE_COLUMNS}
+    return (str(pmid),
+            article.get('url'),
+            None if article.get('PMCID') is None else str(article.get('PMCID')),
+            article.get('citation'),
+            json.dumps(article.get('article_type')),
+            compress_text(article.get('summary')),
+            json.dumps(extra) if extra else None)
+
+
+def article_columns(fields=None):
+    """
+    Returns the article_analysis columns needed to read the given fields.
+    article_json is always selected so rows written before the columns existed can still be read.
+    """
+    if fields is None:
+        return list(ARTICLE_WRITE_COLUMNS) + ['article_json']
+    unknown = set(fields) - set(ARTICLE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown article fields: {sorted(unknown)}")
+    return ['article_id'] + [ARTICLE_COLUMNS[field] for field in fields if field != 'PMID'] + ['article_json']
+
+
+def columns_to_article(columns, row, fields=None):
+    """
+    Builds an article dictionary from selected article_analysis columns, decoding only what was selected.
+    """
+    values = dict(zip(columns, row))
+    if values['article_json'] is not None:
+        article = json.loads(values['article_json'])
+        article['PMID'] = values['article_id']
+        if fields is not None:
+            article = {field: article.get(field) for field in ['PMID'] + list(fields)}
+        return article
+
+    article = {'PMID': values['article_id']}
+    for field, column in ARTICLE_COLUMNS.items():
+        if column not in values or field == 'PMID':
+            continue
+        if column == 'summary':
+            article[field] = decompress_text(values[column])
+        elif column == 'article_type':
+            article[field] = None if values[column] is None else json.loads(values[column])
+        else:
+            article[field] = values[column]
+    if values.get('extra'):
+        article.update(json.loads(values['extra']))
+    return article
+
+
+ANSWER_FORMAT = 2
+
+
+def normalize_answer(obj):
+    """
+    Splits a final output object into the stored answer and the list of relevant PMIDs.
+    Article summaries are not stored with the answer; they are joined in from article_analysis on read.
+
+    Parameters:
+    - obj (dict): The final output object, as built by build_output_record.
+
+    Returns:
+    - answer (str): Answer JSON string with the end output, citations and the PMID of each citation.
+    - pmids (list): PMIDs of all relevant articles, in their original order.
+    """
+    pmids = []
+    for article in obj.get('relevant_articles') or obj.get('relevent_articles') or []:
+        if not article:
+            continue
+        pmid = str(article.get('PMID') or article.get('article_id'))
+        if pmid not in pmids:
+            pmids.append(pmid)
+    citation_pmids = {citation: str(article.get('PMID')) for citation, article in (obj.get('citations_obj') or {}).items()}
+    answer = {
+        "format": ANSWER_FORMAT,
+        "end_output": obj.get('end_output'),
+        "citations": obj.get('citations', []),
+        "citation_pmids": citation_pmids,
+        "total_runtime": obj.get('total_runtime'),
+    }
+    # Kept for refresh.py, not returned by /db_get
+    for key in ('answered_at', 'screened_pmids'):
+        if obj.get(key) is not None:
+            answer[key] = obj[key]
+    return json.dumps(answer), pmids
+
+
+def expand_answer(answer, pmids, articles_by_pmid, include_articles=False):
+    """
+    Rebuilds the final output object returned by /db_get from a normalized answer.
+
+    Parameters:
+    - answer (dict): The stored answer, as built by normalize_answer.
+    - pmids (list): PMIDs of all relevant articles.
+    - articles_by_pmid (dict): article_analysis records of (at least) the cited articles, keyed by PMID.
+    - include_articles (bool): Include the full records of every relevant article.
+
+    Returns:
+    - obj (dict): The final output object with citations_obj rebuilt from article_analysis.
+    """
+    citations_obj = {}
+    for citation, pmid in answer['citation_pmids'].items():
+        article = articles_by_pmid.get(pmid)
+        if article is None:
+            continue
+        citations_obj[citation] = {
+            "PMID": article.get("PMID"),
+            "PMCID": article.get("PMCID"),
+            "URL": article.get("url"),
+            "Summary": article.get("summary")
+        }
+    obj = {
+        "end_output": answer['end_output'],
+        "citations": answer['citations'],
+        "citations_obj": citations_obj,
+        "pmids": pmids,
+        "total_runtime": answer.get('total_runtime'),
+        "answered_at": answer.get('answered_at'),
+    }
+    if include_articles:
+        obj["relevant_articles"] = [articles_by_pmid[pmid] for pmid in pmids if pmid in articles_by_pmid]
+    return obj
+
+
+def expand_legacy_answer(answer, include_articles=False):
+    """
+    Returns a not yet migrated answer blob, dropping the embedded articles unless they were asked for.
+    """
+    if not include_articles:
+        answer.pop('relevant_articles', None)
+        answer.pop('relevent_articles', None)
+    return answer
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage(credentials=None):
+    """
+    Returns the process-wide storage backend selected by STORAGE_BACKEND.
+
+    Parameters:
+    - credentials (str): Name of env file with MySQL credentials, only used by the MySQL backend.
+    """
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            backend = os.getenv('STORAGE_BACKEND', 'mysql').lower()
+            if backend == 'sqlite':
+                _storage = SQLiteStorage(os.getenv('SQLITE_PATH', 'dietnerd.sqlite3'))
+            elif backend == 'mysql':
+                _storage = MySQLStorage(credentials)
+            else:
+                raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+        return _storage
@@ -0,0 +1,86 @@
+"""
+Chooses the model that writes each article's reliability summary.
+
+process_article used to summarize every article with gpt-4-turbo, including the many articles where only the
+abstract is available and there is little for the 9- or 13-point prompt to analyze. The routes below are checked in
+order and the first one that matches the article's content picks the model; articles no route matches get
+DEFAULT_SUMMARY_MODEL. The chosen model is stored with the article as summary_model.
+
+A route is a dictionary with a "model" and any of these conditions:
+- "full_text" (bool): whether the content is the full text rather than the abstract;
+- "max_chars" / "min_chars" (int): bounds on the length of the content;
+- "review" (bool): whether the article got the literature review prompt rather than the study prompt.
+
+With SUMMARY_CAPTURE_PATH set, process_article also appends the input and output of every summary to that JSON-lines
+file, so benchmarks/summary_cascade_benchmark.py can compare models on the same inputs offline.
+
+Configuration (env):
+- SUMMARY_ROUTES: JSON list of routes replacing the defaults below; "[]" summarizes everything with the default model.
+- SUMMARY_DEFAULT_MODEL: model of articles no route matches (default gpt-4-turbo).
+- SUMMARY_CAPTURE_PATH: JSON-lines file capturing summary inputs and outputs (default unset, nothing is captured).
+"""
+import json
+import logging
+import os
+import threading
+
+import metrics
+
+DEFAULT_SUMMARY_MODEL = os.getenv('SUMMARY_DEFAULT_MODEL', 'gpt-4-turbo')
+DEFAULT_ROUTES = [
+    # Abstracts are a few hundred words: a small model extracts what little there is to extract
+    {"full_text": False, "model": "gpt-4o-mini"},
+    {"full_text": True, "max_chars": 6000, "model": "gpt-4o-mini"},
+]
+SUMMARY_ROUTES = DEFAULT_ROUTES if os.getenv('SUMMARY_ROUTES') is None else json.loads(os.getenv('SUMMARY_ROUTES'))
+SUMMARY_CAPTURE_PATH = os.getenv('SUMMARY_CAPTURE_PATH')
+
+SUMMARY_MODEL = metrics.counter("dietnerd_summary_model_total", "Article summaries by chosen model and content type.", ("model", "content"))
+
+_capture_lock = threading.Lock()
+
+
+def route_matches(route, full_text, length, review):
+    if "full_text" in route and route["full_text"] != full_text:
+        return False
+    if "review" in route and route["review"] != review:
+        return False
+    if "max_chars" in route and length > route["max_chars"]:
+        return False
+    if "min_chars" in route and length < route["min_chars"]:
+        return False
+    return True
+
+
+def choose_summary_model(full_text, content, review, routes=None):
+    """
+    Picks the model for one article's reliability summary.
+
+    Parameters:
+    - full_text (bool): Whether the content is the full text rather than the abstract.
+    - content (str): The text that will be summarized.
+    - review (bool): Whether the article gets the literature review prompt.
+    - routes (list): Routes to check instead of SUMMARY_ROUTES.
+
+    Returns:
+    - model (str): The model to call.
+    """
+    routes = SUMMARY_ROUTES if routes is None else routes
+    model = next((route["model"] for route in routes if route_matches(route, full_text, len(content), review)), DEFAULT_SUMMARY_MODEL)
+    SUMMARY_MODEL.inc(model=model, content="full_text" if full_text else "abstract")
+    return model
+
+
+def capture_summary(pmid, full_text, review, system_prompt, content, model, summary):
+    """
+    Appends one summary's input and output to SUMMARY_CAPTURE_PATH, if it is set.
+    """
+    if not SUMMARY_CAPTURE_PATH:
+        return
+    line = json.dumps({"pmid": pmid, "full_text": full_text, "review": review, "system_prompt": system_prompt,
+                       "content": content, "model": model, "summary": summary})
+    try:
+        with _capture_lock, open(SUMMARY_CAPTURE_PATH, "a") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logging.warning("Could not capture summary input to %s: %s", SUMMARY_CAPTURE_PATH, e)
@@ -0,0 +1,345 @@
+"""
+Answers popular and trending questions off-peak, so the users who ask them next get the stored answer from /db_get.
+
+Only an exact match in question_answer is answered instantly; every other question waits minutes for the pipeline.
+The API logs every question submitted to the pipeline and every similarity search to the question_log table, through
+the write-behind queue. When the warmer is enabled, it checks every WARMER_INTERVAL seconds whether the deployment is
+idle: the hour is inside WARMER_HOURS, the broker has no user job running or queued (across every API process with the
+TCP broker), and no question was submitted to this process for WARMER_IDLE_SECONDS. If so, it mines the log of the
+last WARMER_LOOKBACK_HOURS:
+
+- questions are grouped by their normalized text (case, whitespace, trailing punctuation), and each group is asked in
+  its most frequent phrasing, since /db_get matches the stored question exactly;
+- a similarity search and a submission of the same question less than WARMER_DEDUPE_SECONDS apart count as one ask,
+  since the website searches for similar answers before it submits;
+- groups with a stored answer, asked fewer than WARMER_MIN_ASKS times, refused by the validity check (question_verdict)
+  or already tried in the last WARMER_RETRY_HOURS are skipped;
+- the rest are ranked by asks + WARMER_TREND_WEIGHT x asks in the last WARMER_TREND_HOURS, so a question that is
+  suddenly popular goes ahead of one that was asked as often over the whole week.
+
+The top questions are submitted to the broker as background jobs, at most WARMER_CONCURRENCY at a time, and run
+through the pipeline, validity check included, on whichever pipeline thread takes them. Background jobs only start
+when no user job is waiting, their LLM calls queue WARMER_PRIORITY levels behind user calls in the gateway, their
+progress updates are not published, and their answers are stored in question_answer like any other. A warm job's only
+update is its final one, which reports its outcome, run time and cost back to the warmer. No new question starts once
+the day's WARMER_DAILY_BUDGET_USD or WARMER_DAILY_MINUTES is spent, or as soon as a user submits a question; questions
+already running finish at their low priority.
+
+Budgets and retry times are kept in memory, so run the warmer on one API process only.
+
+Configuration (env):
+- WARMER_ENABLED: "1" to run the warmer in this process (default off).
+- WARMER_INTERVAL: seconds between idle checks (default 60).
+- WARMER_HOURS: local hours in which the warmer may start questions, e.g. "1-6" or "22-6" (default any hour).
+- WARMER_IDLE_SECONDS: seconds without a submitted question before the warmer starts one (default 300).
+- WARMER_CONCURRENCY: warm pipelines run at once (default 1).
+- WARMER_DAILY_BUDGET_USD: estimated LLM cost the warmer may spend per day (default 5).
+- WARMER_DAILY_MINUTES: pipeline minutes the warmer may spend per day (default 60).
+- WARMER_LOOKBACK_HOURS: age of the oldest logged question mined; older entries are deleted (default 168).
+- WARMER_TREND_HOURS: window of asks that count as trending (default 24).
+- WARMER_TREND_WEIGHT: extra weight of a trending ask (default 2).
+- WARMER_MIN_ASKS: asks a question needs to be warmed (default 2).
+- WARMER_DEDUPE_SECONDS: window in which a similarity search and a submission of a question are one ask (default 900).
+- WARMER_RETRY_HOURS: hours before a question that was tried is tried again (default 24).
+- WARMER_PRIORITY: priority levels added to the warmer's LLM calls (default 3).
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+import metrics
+import pipeline_metrics
+from job_scheduler import QueueFullError
+from question_classifier import normalize_question
+from session_hub import is_final
+
+WARM_SESSION_PREFIX = "warm-"
+WARMER_PRIORITY = int(os.getenv('WARMER_PRIORITY', 3))
+
+WARMER_COVERAGE = metrics.gauge("dietnerd_warmer_coverage_ratio", "Share of logged asks in the lookback window whose question has a stored answer.")
+WARMER_CANDIDATES = metrics.gauge("dietnerd_warmer_candidates", "Frequently asked questions without a stored answer.")
+WARMER_QUESTIONS = metrics.counter("dietnerd_warmer_questions_total", "Questions run by the warmer, by outcome (ok, refused, error).", ("status",))
+WARMER_SECONDS = metrics.counter("dietnerd_warmer_pipeline_seconds_total", "Pipeline time spent by the warmer.")
+WARMER_COST = metrics.counter("dietnerd_warmer_cost_usd_total", "Estimated LLM cost of the warmer's pipelines.")
+WARMER_SKIPPED = metrics.counter("dietnerd_warmer_skipped_checks_total", "Idle checks that started no question, by reason.", ("reason",))
+
+
+def normalize(question):
+    return normalize_question(question).rstrip("?!. ")
+
+
+def in_hours(hours, hour):
+    """
+    Returns whether a local hour is inside a "start-end" window; the window may wrap around midnight.
+    """
+    if not hours:
+        return True
+    start, end = (int(part) for part in hours.split("-"))
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+def find_candidates(log_rows, answered, refused, now, trend_seconds, trend_weight=2.0, min_asks=2, dedupe_seconds=900):
+    """
+    Ranks logged questions without a stored answer.
+
+    Parameters:
+    - log_rows (list): Logged (question, source, Unix time) tuples.
+    - answered (set): Normalized questions with a stored answer.
+    - refused (set): Normalized questions the validity check refused.
+    - now (float): The current Unix time.
+    - trend_seconds (float): Window of asks that count as trending.
+    - trend_weight (float): Extra weight of a trending ask.
+    - min_asks (int): Asks a question needs to be a candidate.
+    - dedupe_seconds (float): Window in which asks of the same question from different sources are one ask.
+
+    Returns:
+    - candidates (list): (score, normalized question, phrasing to ask) tuples, best first.
+    - coverage (float): Share of the logged asks whose question has a stored answer, or None if nothing was logged.
+    """
+    groups = {}
+    # Normalized question -> (source, time) of its asks not yet paired with an ask from another source
+    unpaired = {}
+    for question, source, asked_at in sorted(log_rows, key=lambda row: row[2]):
+        key = normalize(question)
+        if not key:
+            continue
+        pending = unpaired.setdefault(key, [])
+        pending[:] = [ask for ask in pending if asked_at - ask[1] <= dedupe_seconds]
+        paired = next((ask for ask in pending if ask[0] != source), None)
+        if paired is not None:
+            # Most likely the same user, searching for similar answers and then submitting
+            pending.remove(paired)
+            continue
+        pending.append((source, asked_at))
+        group = groups.setdefault(key, {"asks": 0, "recent": 0, "phrasings": Counter()})
+        group["asks"] += 1
+        group["recent"] += asked_at >= now - trend_seconds
+        group["phrasings"][question.strip()] += 1
+    asks = sum(group["asks"] for group in groups.values())
+    covered = sum(group["asks"] for key, group in groups.items() if key in answered)
+    candidates = [(group["asks"] + trend_weight * group["recent"], key, group["phrasings"].most_common(1)[0][0])
+                  for key, group in groups.items()
+                  if key not in answered and key not in refused and group["asks"] >= min_asks]
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+    return candidates, (covered / asks if asks else None)
+
+
+class Warmer:
+    """
+    Background thread that submits candidate questions to the broker while the deployment is idle.
+
+    Parameters:
+    - broker (Broker): The broker of user questions, to check their load and to submit warm jobs.
+    - storage (Storage): Storage backend with the question log, answers and verdicts.
+    - loop (AbstractEventLoop): The event loop the broker's coroutines run on.
+    - config (dict): Overrides of the WARMER_* settings, by lowercase name without the prefix, e.g. {"concurrency": 2}.
+    """
+
+    def __init__(self, broker, storage, loop, **config):
+        self.broker = broker
+        self.storage = storage
+        self.loop = loop
+        self.interval = float(config.get("interval", os.getenv('WARMER_INTERVAL', 60)))
+        self.hours = config.get("hours", os.getenv('WARMER_HOURS', ''))
+        self.idle_seconds = float(config.get("idle_seconds", os.getenv('WARMER_IDLE_SECONDS', 300)))
+        self.concurrency = int(config.get("concurrency", os.getenv('WARMER_CONCURRENCY', 1)))
+        self.daily_budget = float(config.get("daily_budget_usd", os.getenv('WARMER_DAILY_BUDGET_USD', 5)))
+        self.daily_seconds = 60 * float(config.get("daily_minutes", os.getenv('WARMER_DAILY_MINUTES', 60)))
+        self.lookback_seconds = 3600 * float(config.get("lookback_hours", os.getenv('WARMER_LOOKBACK_HOURS', 168)))
+        self.trend_seconds = 3600 * float(config.get("trend_hours", os.getenv('WARMER_TREND_HOURS', 24)))
+        self.trend_weight = float(config.get("trend_weight", os.getenv('WARMER_TREND_WEIGHT', 2)))
+        self.min_asks = int(config.get("min_asks", os.getenv('WARMER_MIN_ASKS', 2)))
+        self.dedupe_seconds = float(config.get("dedupe_seconds", os.getenv('WARMER_DEDUPE_SECONDS', 900)))
+        self.retry_seconds = 3600 * float(config.get("retry_hours", os.getenv('WARMER_RETRY_HOURS', 24)))
+        self.last_activity = time.time()
+        self._day = None
+        self._spent_usd = 0.0
+        self._spent_seconds = 0.0
+        # Normalized question -> when the warmer last started it
+        self._tried = {}
+        self._running = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="warmer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def note_activity(self):
+        """
+        Records that a user submitted a question, which keeps the warmer from starting new ones for a while.
+        """
+        self.last_activity = time.time()
+
+    def busy_reason(self, now):
+        """
+        Returns why no question can start right now, or None if one can.
+        """
+        if not in_hours(self.hours, datetime.datetime.fromtimestamp(now).hour):
+            return "hours"
+        if now - self.last_activity < self.idle_seconds or self.broker.load():
+            return "users"
+        with self._lock:
+            day = datetime.date.fromtimestamp(now)
+            if day != self._day:
+                self._day, self._spent_usd, self._spent_seconds = day, 0.0, 0.0
+            if self._spent_usd >= self.daily_budget or self._spent_seconds >= self.daily_seconds:
+                return "budget"
+            if self._running >= self.concurrency:
+                return "concurrency"
+        return None
+
+    def candidates(self, now):
+        """
+        Mines the question log, updates the coverage metrics and returns the questions worth warming.
+
+        Returns:
+        - candidates (list): (score, normalized question, phrasing to ask) tuples, best first.
+        """
+        self.storage.delete_question_log(now - self.lookback_seconds)
+        answered = {normalize(question) for question in self.storage.list_questions()}
+        refused = {normalize(question) for question, label in self.storage.list_verdicts() if label.startswith('False')}
+        candidates, coverage = find_candidates(self.storage.select_question_log(now - self.lookback_seconds), answered, refused,
+                                               now, self.trend_seconds, self.trend_weight, self.min_asks, self.dedupe_seconds)
+        if coverage is not None:
+            WARMER_COVERAGE.set(coverage)
+        WARMER_CANDIDATES.set(len(candidates))
+        with self._lock:
+            return [candidate for candidate in candidates if now - self._tried.get(candidate[1], 0) >= self.retry_seconds]
+
+    def check(self):
+        """
+        Starts as many candidate questions as the idle state, budgets and concurrency allow.
+
+        Returns:
+        - started (list): The questions started.
+        """
+        now = time.time()
+        reason = self.busy_reason(now)
+        if reason is not None:
+            WARMER_SKIPPED.inc(reason=reason)
+            return []
+        candidates = self.candidates(now)
+        if not candidates:
+            WARMER_SKIPPED.inc(reason="no_candidates")
+            return []
+        started = []
+        for score, key, question in candidates:
+            if self.busy_reason(time.time()) is not None:
+                break
+            with self._lock:
+                self._tried[key] = now
+                self._running += 1
+            logging.info("Warming %r (score %.1f)", question, score)
+            asyncio.run_coroutine_threadsafe(self._warm(question), self.loop)
+            started.append(question)
+        return started
+
+    async def _warm(self, question):
+        """
+        Submits one question as a background job and waits for its report to charge it to the day's budgets.
+        """
+        session_id = f"{WARM_SESSION_PREFIX}{uuid.uuid4()}"
+        start = time.time()
+        report = {}
+        try:
+            await self.broker.submit(session_id, question, True, background=True)
+            async for event in self.broker.subscribe(session_id):
+                update = json.loads(event["data"])["update"]
+                if is_final(update):
+                    # Without a report the job failed, e.g. its pipeline thread was lost
+                    report = update.get("warm") or {}
+        except QueueFullError:
+            logging.warning("Could not warm %r: the background queue is full", question)
+        except Exception:
+            logging.exception("Warming %r failed", question)
+        finally:
+            seconds = report.get("seconds", time.time() - start)
+            cost = report.get("cost_usd", 0.0)
+            WARMER_QUESTIONS.inc(status=report.get("status", "error"))
+            WARMER_SECONDS.inc(seconds)
+            WARMER_COST.inc(cost)
+            with self._lock:
+                self._running -= 1
+                self._spent_seconds += seconds
+                self._spent_usd += cost
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logging.exception("Warmer check failed")
+
+
+_warmer = None
+
+
+def start(broker, storage):
+    """
+    Starts the process-wide warmer if WARMER_ENABLED is set. Called from the server's event loop at startup.
+
+    Parameters:
+    - broker (Broker): The started broker.
+    - storage (Storage): Storage backend.
+    """
+    global _warmer
+    if os.getenv('WARMER_ENABLED', '0') != '1':
+        return None
+    if _warmer is None:
+        _warmer = Warmer(broker, storage, asyncio.get_running_loop())
+        logging.info("Started the warmer (hours %s, budget $%s and %s minutes per day)",
+                     _warmer.hours or "any", _warmer.daily_budget, _warmer.daily_seconds / 60)
+    _warmer.start()
+    return _warmer
+
+
+def stop():
+    if _warmer is not None:
+        _warmer.stop()
+
+
+def note_activity():
+    if _warmer is not None:
+        _warmer.note_activity()
+
+
+def is_warm_session(session_id):
+    return session_id.startswith(WARM_SESSION_PREFIX)
+
+
+def answer(handler, question, session_id, publish):
+    """
+    Runs a warm job on a pipeline thread, in whichever process took it, and reports back to the warmer that submitted it.
+
+    Parameters:
+    - handler (function): The pipeline, called as handler(user_query, session_id, record, validate) inside
+      pipeline_metrics.question, like main.run_pipeline.
+    - question (str): The question to answer.
+    - session_id (str): The warm job's session.
+    - publish (function): Publishes to a session, as Broker.publish.
+    """
+    start = time.time()
+    record = None
+    try:
+        with pipeline_metrics.question(question, session_id) as record:
+            record.priority = WARMER_PRIORITY
+            handler(question, session_id, record, True)
+    except Exception:
+        logging.exception("Warming %r failed", question)
+    finally:
+        report = {"status": record.status if record is not None else "error", "seconds": time.time() - start,
+                  "cost_usd": record.as_dict()["cost_usd"] if record is not None else 0.0}
+        publish(session_id, {"end_output": None, "warm": report})
@@ -0,0 +1,294 @@
+"""
+Write-behind persistence for article analyses and final answers.
+
+`process_user_query` hands its writes to a background writer thread instead of waiting for the MySQL commits, so the
+final SSE update is sent as soon as the answer is ready. The writer batches `article_analysis` upserts across sessions
+and flushes when either WRITE_BEHIND_BATCH_SIZE items are pending or WRITE_BEHIND_FLUSH_INTERVAL seconds have passed.
+Failed batches are retried with exponential backoff on the writer thread. The buffer is bounded: when it stays full
+for a second, the caller writes the row itself, in a single attempt without backoff so that a pipeline thread never
+sleeps through retries while the database is down. Rows that fail that attempt are dropped, logged and counted in
+dietnerd_write_behind_dropped_total. `stop` spends at most its timeout draining the buffer.
+
+Configuration (env):
+- WRITE_BEHIND_BATCH_SIZE: maximum rows per flush (default 50).
+- WRITE_BEHIND_FLUSH_INTERVAL: seconds before a partial batch is flushed (default 2).
+- WRITE_BEHIND_MAX_PENDING: maximum buffered rows (default 1000).
+- WRITE_BEHIND_MAX_RETRIES: attempts per batch before it is dropped and logged (default 5).
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import metrics
+
+WRITE_BEHIND_PENDING = metrics.gauge("dietnerd_write_behind_pending", "Rows buffered in the write-behind queue.")
+WRITE_BEHIND_LAG = metrics.gauge("dietnerd_write_behind_lag_seconds", "Age of the oldest row not yet written by the write-behind queue.")
+WRITE_BEHIND_FLUSH = metrics.histogram("dietnerd_write_behind_flush_seconds", "Time spent flushing one write-behind batch.", ("kind",))
+WRITE_BEHIND_ROWS = metrics.counter("dietnerd_write_behind_rows_total", "Rows written by the write-behind queue.", ("kind",))
+WRITE_BEHIND_RETRIES = metrics.counter("dietnerd_write_behind_retries_total", "Failed write-behind flushes that were retried.", ("kind",))
+WRITE_BEHIND_DROPPED = metrics.counter("dietnerd_write_behind_dropped_total", "Rows dropped because every write-behind attempt for them failed.", ("kind",))
+WRITE_BEHIND_OVERFLOW = metrics.counter("dietnerd_write_behind_overflow_total", "Rows the caller tried to write itself, once, because the write-behind buffer was full.", ("kind",))
+
+ARTICLE = "article"
+ANSWER = "answer"
+QUESTION = "question"
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """
+    Background writer thread that batches rows and flushes them with the given functions.
+
+    Parameters:
+    - flush_functions (dict): Maps a row kind ("article", "answer", "question") to a function that writes a list of rows and raises on failure.
+    - batch_size (int): Maximum rows per flush.
+    - flush_interval (float): Seconds before a partial batch is flushed.
+    - max_pending (int): Maximum buffered rows.
+    - max_retries (int): Attempts per batch before it is dropped.
+    """
+
+    def __init__(self, flush_functions, batch_size=50, flush_interval=2.0, max_pending=1000, max_retries=5):
+        self.flush_functions = flush_functions
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._enqueued_at = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        WRITE_BEHIND_PENDING.set_function(self._queue.qsize)
+        WRITE_BEHIND_LAG.set_function(self.lag)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def submit(self, kind, row):
+        """
+        Buffers one row for writing. If the buffer stays full for a second, the row is written synchronously in a
+        single attempt, and dropped if that fails.
+
+        Parameters:
+        - kind (str): "article", "answer" or "question".
+        - row (tuple): The row passed to the flush function of this kind.
+        """
+        self.start()
+        deadline = time.time() + 1
+        while True:
+            with self._lock:
+                try:
+                    self._queue.put_nowait((kind, row))
+                    self._enqueued_at.append(time.time())
+                    return
+                except queue.Full:
+                    pass
+            if time.time() >= deadline:
+                break
+            time.sleep(0.05)
+        WRITE_BEHIND_OVERFLOW.inc(kind=kind)
+        logging.warning("Write-behind buffer is full, writing %s synchronously", kind)
+        self._flush(kind, [row], attempts=1)
+
+    def lag(self):
+        """
+        Returns the age in seconds of the oldest row that has not been written yet.
+        """
+        with self._lock:
+            if not self._enqueued_at:
+                return 0.0
+            return time.time() - self._enqueued_at[0]
+
+    def stop(self, timeout=30):
+        """
+        Flushes every buffered row and stops the writer thread.
+
+        Parameters:
+        - timeout (float): Seconds to spend in total; rows still buffered then are left unwritten.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        deadline = time.time() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout / 2)
+        except queue.Full:
+            # The writer is stuck, e.g. retrying a failing flush: write what is buffered from this thread instead
+            logging.warning("Write-behind buffer is full, flushing %s rows synchronously", self._queue.qsize())
+            self._flush_pending(deadline)
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass
+        self._thread.join(max(0, deadline - time.time()))
+        if self._thread.is_alive():
+            logging.error("Write-behind queue did not drain within %ss, %s rows pending", timeout, self._queue.qsize())
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                wait = None if deadline is None else max(0, deadline - time.time())
+                try:
+                    item = self._queue.get(timeout=wait)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            if batch:
+                self._flush_batch(batch)
+
+    def _flush_pending(self, deadline):
+        batch = []
+        while time.time() < deadline:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush_batch(batch, deadline)
+                batch = []
+        if batch:
+            self._flush_batch(batch, deadline)
+
+    def _flush_batch(self, batch, deadline=None):
+        rows_by_kind = {}
+        for kind, row in batch:
+            rows_by_kind.setdefault(kind, []).append(row)
+        for kind, rows in rows_by_kind.items():
+            self._flush(kind, rows, deadline=deadline)
+        with self._lock:
+            for _ in batch:
+                self._enqueued_at.popleft()
+
+    def _flush(self, kind, rows, attempts=None, deadline=None):
+        """
+        Writes rows, retrying with exponential backoff, and drops them once the attempts or the time are used up.
+
+        Parameters:
+        - kind (str): "article", "answer" or "question".
+        - rows (list): Rows for the flush function of this kind.
+        - attempts (int): Attempts before the rows are dropped. Defaults to max_retries.
+        - deadline (float): Unix time after which no retry starts.
+        """
+        attempts = attempts or self.max_retries
+        wait = 1
+        for attempt in range(1, attempts + 1):
+            start = time.time()
+            try:
+                self.flush_functions[kind](rows)
+                WRITE_BEHIND_FLUSH.observe(time.time() - start, kind=kind)
+                WRITE_BEHIND_ROWS.inc(len(rows), kind=kind)
+                return
+            except Exception as e:
+                logging.warning("Write-behind flush of %s %s rows failed (attempt %s/%s): %s", len(rows), kind, attempt, attempts, e)
+                if attempt == attempts or (deadline is not None and time.time() + wait > deadline):
+                    break
+                WRITE_BEHIND_RETRIES.inc(kind=kind)
+                time.sleep(wait)
+                wait *= 2
+        WRITE_BEHIND_DROPPED.inc(len(rows), kind=kind)
+        logging.error("Dropped %s %s rows after %s attempts", len(rows), kind, attempt)
+
+
+def dedupe_articles(rows):
+    """
+    Keeps the last row per PMID so overlapping sessions upsert each article once per batch.
+
+    Parameters:
+    - rows (list): List of (PMID, article dictionary) tuples.
+
+    Returns:
+    - rows (list): De-duplicated list of (PMID, article dictionary) tuples.
+    """
+    return list({pmid: (pmid, article_json) for pmid, article_json in rows}.values())
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer(credentials):
+    """
+    Returns the process-wide writer, creating it on first use.
+
+    Parameters:
+    - credentials (str): Name of env file with host, port, user, password, database.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            # Imported here so the writer can be configured without importing the whole pipeline
+            from helper_functions import upload_articles_to_db, upload_answers_to_db
+            from storage import get_storage
+            _writer = WriteBehindWriter(
+                flush_functions={
+                    ARTICLE: lambda rows: upload_articles_to_db(credentials, 'article_analysis', dedupe_articles(rows), raise_errors=True),
+                    ANSWER: lambda rows: upload_answers_to_db(credentials, rows, raise_errors=True),
+                    QUESTION: lambda rows: get_storage(credentials).log_questions(rows),
+                },
+                batch_size=int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 50)),
+                flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 2)),
+                max_pending=int(os.getenv('WRITE_BEHIND_MAX_PENDING', 1000)),
+                max_retries=int(os.getenv('WRITE_BEHIND_MAX_RETRIES', 5)))
+            atexit.register(_writer.stop)
+        return _writer
+
+
+def enqueue_articles(relevant_article_summaries, credentials):
+    """
+    Queues processed article summaries for an upsert into article_analysis.
+
+    Parameters:
+    - relevant_article_summaries (list): List of relevant article summaries.
+    - credentials (str): Name of env file with host, port, user, password, database.
+    """
+    from helper_functions import dict_to_tuple
+    writer = get_writer(credentials)
+    for row in dict_to_tuple([article for article in relevant_article_summaries if article]):
+        writer.submit(ARTICLE, row)
+
+
+def enqueue_answer(user_query, return_obj, credentials):
+    """
+    Queues a final output object for an upsert into question_answer.
+
+    Parameters:
+    - user_query (str): The user's query.
+    - return_obj (dict): The final output object, as built by build_output_record.
+    - credentials (str): Name of env file with host, port, user, password, database.
+    """
+    get_writer(credentials).submit(ANSWER, (user_query, return_obj))
+
+
+def enqueue_question(question, source, credentials):
+    """
+    Queues one asked question for the question_log table (see warmer.py).
+
+    Parameters:
+    - question (str): The question as the user typed it.
+    - source (str): Where it was asked: "submit" or "similar".
+    - credentials (str): Name of env file with host, port, user, password, database.
+    """
+    get_writer(credentials).submit(QUESTION, (question, source, time.time()))
+
+
+def drain(timeout=30):
+    """
+    Flushes and stops the writer, if one was started.
+    """
+    if _writer is not None:
+        _writer.stop(timeout)
@@ -427,10 +427,11 @@ const generatePDF = () => {
     };
 };
 /**
- * Runs the generation process for the given user query.
+ * Runs the generation process for the given user query. The server checks the question's validity while the
+ * pipeline starts, and ends the stream early with a refusal if the question cannot be answered.
  *
  * @param {string} userQuery - The user query to generate the search phrases for.
- * @return {Promise<void>} - A promise that resolves when the generation process is complete.
+ * @return {Promise<Object>} - A promise that resolves to the final update when the generation process is complete.
  */
 async function runGeneration(userQuery) {
     const answerElement = document.getElementById('output');
@@ -439,7 +440,7 @@ async function runGeneration(userQuery) {
     return new Promise(async (resolve, reject) => {
         try {
             // First, send the query and get the session_id
-            const response = await fetch(`${baseURL}/process_query`, {
+            const response = await fetch(`${baseURL}/submit`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -447,6 +448,10 @@ async function runGeneration(userQuery) {
                 body: JSON.stringify({ user_query: userQuery }),
             });
             const data = await response.json();
+            if (!response.ok) {
+                // 429 when the server's question queue is full
+                throw new Error(data.detail || `Request failed with status ${response.status}`);
+            }
             const sessionId = data.session_id;
 
             answerElement.innerText += `Got session_id: ${sessionId}\n`;
@@ -465,7 +470,7 @@ async function runGeneration(userQuery) {
                     if (data.update.end_output) {
                         console.log("Received final update. Closing EventSource.");
                         eventSource.close();
-                        resolve(); // Resolve the promise when we get the final output
+                        resolve(data.update); // Resolve the promise when we get the final output
                     } else {
                         answerElement.innerText += `${data.update}\n`;
                     }
@@ -557,14 +562,11 @@ document.getElementById('submit').addEventListener('click', async (event) => {
                     hintElement.textContent = ''
                     answerElement.innerHTML = `<textarea readonly placeholder="Answer will load here, please wait. This may take a minute. Please do not close or refresh this page...."></textarea>`;
                     referencesElement.innerHTML = `<label for="references" class="visually-hidden">References will appear here...</label><textarea id="references" readonly placeholder="References will appear here..."></textarea>`;
-                    const checkValid = await check_valid(question);
-                    const checkValidResponse = checkValid["response"];
-                    console.log("Check valid response: " + checkValidResponse);
-                    if (checkValidResponse != "good") {
-                        answerElement.innerText = checkValidResponse;
+                    const finalUpdate = await runGeneration(question);
+                    if (finalUpdate.refusal || finalUpdate.error) {
+                        answerElement.innerText = finalUpdate.end_output;
                         return;
                     }
-                    await runGeneration(question)
                     document.getElementById('question').value = question;
                     document.getElementById('submit').click();
 